@@ -0,0 +1,8 @@
+"""
+Package: benchmarks
+Performance benchmarks for the shopcart service
+
+Each module can be run on its own, e.g.:
+  python -m benchmarks.replace_items
+They use the database configured by DATABASE_URI.
+"""
@@ -0,0 +1,118 @@
+"""
+Benchmark for the ASGI deployment mode
+
+Starts the service under gunicorn twice, once with sync workers (service:app)
+and once with uvicorn workers (service.asgi:app), and hammers
+GET /api/shopcarts/<customer_id> from many concurrent connections. Prints
+requests per second and latency percentiles for every mode.
+
+Usage:
+  python -m benchmarks.asgi_throughput --workers 2 --concurrency 50 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+from service import app  # noqa: F401  pylint: disable=unused-import
+from service.models import db, Cart, ShopCart
+
+FIRST_CUSTOMER_ID = 987600000
+MODES = {
+    "wsgi": ["service:app"],
+    "asgi": ["-k", "uvicorn.workers.UvicornWorker", "service.asgi:app"],
+}
+
+
+def seed(carts, items):
+    """Creates carts with items to read"""
+    for customer_id in range(FIRST_CUSTOMER_ID, FIRST_CUSTOMER_ID + carts):
+        ShopCart.clear_cart(customer_id, delete_cart=True)
+        Cart(customer_id=customer_id).create()
+        ShopCart.replace_items(customer_id, [
+            ShopCart(customer_id=customer_id, product_id=pid, quantities=1) for pid in range(items)
+        ])
+
+
+def cleanup(carts):
+    """Removes the carts created by seed()"""
+    for customer_id in range(FIRST_CUSTOMER_ID, FIRST_CUSTOMER_ID + carts):
+        ShopCart.clear_cart(customer_id, delete_cart=True)
+    db.session.remove()
+
+
+def start_server(mode, port, workers):
+    """Starts gunicorn in a mode and waits until it answers /health"""
+    command = [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--bind", f"127.0.0.1:{port}",
+               "--log-level", "warning", *MODES[mode]]
+    server = subprocess.Popen(command, env=dict(os.environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+async def load(port, carts, concurrency, duration):
+    """Runs concurrency clients for duration seconds, returns the latencies and the error count"""
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                customer_id = FIRST_CUSTOMER_ID + random.randrange(carts)
+                start = time.perf_counter()
+                resp = await client.get(f"/api/shopcarts/{customer_id}")
+                if resp.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def main():
+    """Runs the benchmark and prints one row per mode"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--carts", type=int, default=100)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    seed(args.carts, args.items)
+    try:
+        print(f"{'mode':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for mode in args.modes:
+            server = start_server(mode, args.port, args.workers)
+            try:
+                latencies, errors = asyncio.run(load(args.port, args.carts, args.concurrency, args.duration))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000 if latencies else 0
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+            print(f"{mode:>6} {len(latencies) / args.duration:>9.0f} {p50:>8.1f} {p99:>8.1f} {errors:>7}")
+    finally:
+        cleanup(args.carts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark for the read only list path
+
+Compares the ORM path the list routes used to take (ShopCart objects,
+serialize(), then marshal()) with the Core path (ItemRecord tuples
+rendered straight to the response dict) for growing cart sizes. Prints
+rows per second and the peak bytes allocated while rendering one cart.
+
+Usage:
+  python -m benchmarks.read_path --sizes 10 100 1000 --repeat 20
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+from flask_restx import marshal
+from service import app
+from service.models import db, Cart, ShopCart
+from service.routes import render_shopcart, shopcart_model
+
+CUSTOMER_ID = 987654322
+
+
+def orm_path(customer_id):
+    """ShopCart objects, serialize() and marshal()"""
+    return marshal([item.serialize() for item in ShopCart.find_items(customer_id)], shopcart_model)
+
+
+def core_path(customer_id):
+    """ItemRecord tuples rendered straight to dicts"""
+    return [render_shopcart(record) for record in ShopCart.read_items(customer_id)]
+
+
+def measure(func, size, repeat):
+    """Returns rows per second and peak bytes allocated of func for a cart of size items"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(CUSTOMER_ID)
+        timings.append(time.perf_counter() - start)
+        db.session.remove()
+    tracemalloc.start()
+    func(CUSTOMER_ID)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+    return size / statistics.median(timings), peak
+
+
+def main():
+    """Runs the benchmark and prints one row per cart size"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    ShopCart.clear_cart(CUSTOMER_ID, delete_cart=True)
+    Cart(customer_id=CUSTOMER_ID).create()
+    try:
+        with app.test_request_context():
+            print(f"{'items':>8} {'orm rows/s':>12} {'core rows/s':>12} {'orm bytes':>10} {'core bytes':>10}")
+            for size in args.sizes:
+                items = [ShopCart(customer_id=CUSTOMER_ID, product_id=pid, quantities=1) for pid in range(size)]
+                ShopCart.replace_items(CUSTOMER_ID, items)
+                orm_rate, orm_bytes = measure(orm_path, size, args.repeat)
+                core_rate, core_bytes = measure(core_path, size, args.repeat)
+                print(f"{size:>8} {orm_rate:>12.0f} {core_rate:>12.0f} {orm_bytes:>10} {core_bytes:>10}")
+    finally:
+        ShopCart.clear_cart(CUSTOMER_ID, delete_cart=True)
+        db.session.remove()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for full cart replacement
+
+Compares the old per-item write path (clear the cart, then one commit per
+item) with ShopCart.replace_items(), which deletes and inserts in a single
+transaction, for growing cart sizes.
+
+Usage:
+  python -m benchmarks.replace_items --sizes 10 50 200 1000 --repeat 5
+"""
+import argparse
+import statistics
+import time
+from service import app  # noqa: F401  pylint: disable=unused-import
+from service.models import db, Cart, ShopCart
+
+CUSTOMER_ID = 987654321
+
+
+def per_item_replace(customer_id, items):
+    """The write path PUT /api/shopcarts/<id>?update=true used to take"""
+    ShopCart.clear_cart(customer_id, delete_cart=False)
+    for item in items:
+        ShopCart(customer_id=customer_id, product_id=item.product_id,
+                 quantities=item.quantities).create()
+
+
+def bulk_replace(customer_id, items):
+    """The single transaction write path"""
+    ShopCart.replace_items(customer_id, items)
+
+
+def measure(func, size, repeat):
+    """Returns the median latency in milliseconds of func for a cart of size items"""
+    timings = []
+    for _ in range(repeat):
+        items = [ShopCart(customer_id=CUSTOMER_ID, product_id=pid, quantities=1) for pid in range(size)]
+        start = time.perf_counter()
+        func(CUSTOMER_ID, items)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    """Runs the benchmark and prints one row per cart size"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    ShopCart.clear_cart(CUSTOMER_ID, delete_cart=True)
+    Cart(customer_id=CUSTOMER_ID).create()
+    try:
+        print(f"{'items':>8} {'per-item ms':>12} {'bulk ms':>10} {'speedup':>8}")
+        for size in args.sizes:
+            slow = measure(per_item_replace, size, args.repeat)
+            fast = measure(bulk_replace, size, args.repeat)
+            print(f"{size:>8} {slow:>12.2f} {fast:>10.2f} {slow / fast:>7.1f}x")
+    finally:
+        ShopCart.clear_cart(CUSTOMER_ID, delete_cart=True)
+        db.session.remove()
+
+
+if __name__ == "__main__":
+    main()
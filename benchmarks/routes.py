@@ -0,0 +1,488 @@
+"""
+Load and latency benchmark of the REST routes
+
+Drives every route of service/routes.py with a weighted mix of requests
+from concurrent clients, either in process through the Flask test client
+or over HTTP against a local gunicorn. Every combination of target, mix,
+cart size and concurrency runs for --duration seconds and reports the
+throughput and the p50/p95/p99 latency, overall and per route.
+
+--save writes the results as JSON, commit it as a baseline so that a
+regression shows up in its diff. --compare prints the change against a
+baseline and, with --fail-over, exits with 1 when the throughput dropped
+or the p95 latency grew by more than that many percent. The numbers are
+absolute, so a baseline records the environment it was measured in, and
+--compare exits with 2 before running anything when this one differs,
+e.g. in CPUs or Python version: save a baseline of this machine first.
+
+Usage:
+  python -m benchmarks.routes --targets client --mixes browse checkout --sizes 5 50 --concurrency 1 8
+  python -m benchmarks.routes --targets http --workers 2 --save benchmarks/baselines/http.json
+  python -m benchmarks.routes --compare benchmarks/baselines/routes.json --fail-over 20
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import httpx
+from service import app
+from service.models import db, Cart, ShopCart
+from benchmarks.asgi_throughput import start_server
+
+FIRST_CUSTOMER_ID = 987500000
+# carts created and deleted by the mixes, apart from the seeded ones
+FIRST_SCRATCH_CUSTOMER_ID = 987600000
+SCRATCH_CUSTOMERS = 50
+# products added and deleted by the mixes, above the seeded product ids
+FIRST_SCRATCH_PRODUCT_ID = 100000
+SCRATCH_PRODUCTS = 20
+
+
+######################################################################
+#  O P E R A T I O N S
+######################################################################
+class Operation:
+    """ One route of the service, how to call it and which answers are a success """
+
+    def __init__(self, route, build, expected=(200,)):
+        self.route = route
+        self.build = build
+        self.expected = frozenset(expected)
+
+
+def cart_url(load):
+    """ A seeded cart """
+    return f"/api/shopcarts/{load.customer_id()}"
+
+
+def scratch_item_url(load):
+    """ An item of a seeded cart that the mixes add and delete """
+    product_id = FIRST_SCRATCH_PRODUCT_ID + load.rng.randrange(SCRATCH_PRODUCTS)
+    return f"{cart_url(load)}/items/{product_id}"
+
+
+def cart_items(load, customer_id):
+    """ The items a seeded cart was created with """
+    return [{"customer_id": customer_id, "product_id": product_id, "quantities": 1} for product_id in range(load.size)]
+
+
+def replace_cart(load):
+    """ PUT the seeded items back into a seeded cart """
+    customer_id = load.customer_id()
+    body = {"customer_id": customer_id, "items": cart_items(load, customer_id)}
+    return "PUT", f"/api/shopcarts/{customer_id}?update=True", {"json": body}
+
+
+def add_item(load):
+    """ POST an item that may already be there """
+    customer_id = load.customer_id()
+    product_id = FIRST_SCRATCH_PRODUCT_ID + load.rng.randrange(SCRATCH_PRODUCTS)
+    body = {"customer_id": customer_id, "product_id": product_id, "quantities": 1}
+    return "POST", f"/api/shopcarts/{customer_id}/items", {"json": body}
+
+
+def update_item(load):
+    """ PUT the quantities of a seeded item """
+    customer_id = load.customer_id()
+    product_id = load.rng.randrange(load.size)
+    body = {"customer_id": customer_id, "product_id": product_id, "quantities": str(load.rng.randint(1, 9))}
+    return "PUT", f"/api/shopcarts/{customer_id}/items/{product_id}", {"json": body}
+
+
+def batch_items(load):
+    """ PATCH the quantities of a few seeded items """
+    products = load.rng.sample(range(load.size), min(load.size, 5))
+    operations = [{"op": "set", "product_id": product_id, "quantities": load.rng.randint(1, 9)} for product_id in products]
+    return "PATCH", f"{cart_url(load)}/items", {"json": {"operations": operations}}
+
+
+def bulk_read(load):
+    """ GET up to 20 seeded carts at once """
+    customer_ids = [str(load.customer_id()) for _ in range(20)]
+    return "GET", f"/api/shopcarts?customer_ids={','.join(customer_ids)}", {}
+
+
+def create_cart(load):
+    """ POST a scratch cart that may already be there """
+    customer_id = FIRST_SCRATCH_CUSTOMER_ID + load.rng.randrange(SCRATCH_CUSTOMERS)
+    return "POST", "/api/shopcarts", {"json": {"customer_id": customer_id, "product_id": -1, "quantities": 1}}
+
+
+def scratch_cart_url(load):
+    """ A scratch cart that may or may not be there """
+    return f"/api/shopcarts/{FIRST_SCRATCH_CUSTOMER_ID + load.rng.randrange(SCRATCH_CUSTOMERS)}"
+
+
+OPERATIONS = {
+    "index": Operation("GET /", lambda load: ("GET", "/", {})),
+    "health": Operation("GET /health", lambda load: ("GET", "/health", {})),
+    "health_pool": Operation("GET /health/pool", lambda load: ("GET", "/health/pool", {})),
+    "health_cache": Operation("GET /health/cache", lambda load: ("GET", "/health/cache", {})),
+    "health_write_buffer": Operation("GET /health/write-buffer", lambda load: ("GET", "/health/write-buffer", {})),
+    "list_carts": Operation("GET /api/shopcarts", lambda load: ("GET", "/api/shopcarts?limit=50", {})),
+    "stream_carts": Operation("GET /api/shopcarts?stream=true", lambda load: ("GET", "/api/shopcarts?stream=true", {})),
+    "bulk_read": Operation("GET /api/shopcarts?customer_ids=", bulk_read),
+    "create_cart": Operation("POST /api/shopcarts", create_cart, expected=(201, 409)),
+    "read_cart": Operation("GET /api/shopcarts/<customer_id>", lambda load: ("GET", cart_url(load), {})),
+    "replace_cart": Operation("PUT /api/shopcarts/<customer_id>?update=True", replace_cart),
+    "clear_cart": Operation("PUT /api/shopcarts/<customer_id>?update=False",
+                            lambda load: ("PUT", f"{scratch_cart_url(load)}?update=False", {}), expected=(200, 409)),
+    "delete_cart": Operation("DELETE /api/shopcarts/<customer_id>",
+                             lambda load: ("DELETE", scratch_cart_url(load), {}), expected=(204,)),
+    "list_items": Operation("GET /api/shopcarts/<customer_id>/items",
+                            lambda load: ("GET", f"{cart_url(load)}/items?min_quantity=1", {})),
+    "add_item": Operation("POST /api/shopcarts/<customer_id>/items", add_item, expected=(201, 409)),
+    "batch_items": Operation("PATCH /api/shopcarts/<customer_id>/items", batch_items),
+    "read_item": Operation("GET /api/shopcarts/<customer_id>/items/<product_id>",
+                           lambda load: ("GET", f"{cart_url(load)}/items/{load.rng.randrange(load.size)}", {})),
+    # 409 when another client changed the item between the read and the write of the route
+    "update_item": Operation("PUT /api/shopcarts/<customer_id>/items/<product_id>", update_item, expected=(200, 409)),
+    "delete_item": Operation("DELETE /api/shopcarts/<customer_id>/items/<product_id>",
+                             lambda load: ("DELETE", scratch_item_url(load), {}), expected=(204,)),
+    # 404 when a concurrent cart PUT deleted the item row it waited for
+    "increment_item": Operation("POST /api/shopcarts/<customer_id>/items/<product_id>/increment",
+                                lambda load: ("POST", f"{cart_url(load)}/items/{load.rng.randrange(load.size)}/increment",
+                                              {"json": {"delta": 1}}), expected=(200, 404)),
+}
+
+# Weights of the operations in each mix
+MIXES = {
+    # storefront pages: carts and items are read far more often than written
+    "browse": {
+        "read_cart": 30, "list_items": 15, "read_item": 20, "bulk_read": 5, "list_carts": 5,
+        "update_item": 5, "increment_item": 5, "add_item": 3, "delete_item": 2, "health": 2,
+    },
+    # checkout: the cart is edited and read back
+    "checkout": {
+        "read_cart": 15, "update_item": 20, "increment_item": 15, "batch_items": 10, "add_item": 10,
+        "delete_item": 10, "replace_cart": 5, "list_items": 5, "create_cart": 3, "clear_cart": 3, "delete_cart": 3,
+    },
+    # every route the same, to see them all
+    "all": {name: 1 for name in OPERATIONS},
+}
+
+
+######################################################################
+#  L O A D
+######################################################################
+class Load:
+    """ State of one client thread: its random generator and what it measured """
+
+    def __init__(self, seed, carts, size):
+        self.rng = random.Random(seed)
+        self.carts = carts
+        self.size = size
+        self.latencies = {}
+        self.errors = {}
+
+    def customer_id(self):
+        """ A random seeded customer """
+        return FIRST_CUSTOMER_ID + self.rng.randrange(self.carts)
+
+
+class ClientTarget:
+    """ Calls the Flask app in process through its test client """
+
+    name = "client"
+
+    def __init__(self, args):
+        self.args = args
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def session(self):
+        """ A client for one thread """
+        return app.test_client()
+
+    @staticmethod
+    def call(client, method, url, kwargs):
+        """ Sends a request, returns its status code once the body was read """
+        resp = client.open(url, method=method, **kwargs)
+        resp.get_data()
+        return resp.status_code
+
+    @staticmethod
+    def close(client):
+        """ Nothing to close """
+
+
+class HttpTarget:
+    """ Calls a gunicorn started for the run over HTTP """
+
+    name = "http"
+
+    def __init__(self, args):
+        self.args = args
+        self.server = None
+
+    def __enter__(self):
+        self.server = start_server(self.args.server, self.args.port, self.args.workers)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.terminate()
+        self.server.wait()
+        return False
+
+    def session(self):
+        """ A keep-alive connection for one thread """
+        return httpx.Client(base_url=f"http://127.0.0.1:{self.args.port}", timeout=30)
+
+    @staticmethod
+    def call(client, method, url, kwargs):
+        """ Sends a request, returns its status code once the body was read """
+        return client.request(method, url, **kwargs).status_code
+
+    @staticmethod
+    def close(client):
+        """ Closes the connection """
+        client.close()
+
+
+TARGETS = {ClientTarget.name: ClientTarget, HttpTarget.name: HttpTarget}
+
+
+def worker(target, load, mix, deadline):
+    """ Sends requests of the mix until the deadline """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    client = target.session()
+    try:
+        while time.monotonic() < deadline:
+            operation = OPERATIONS[load.rng.choices(names, weights)[0]]
+            method, url, kwargs = operation.build(load)
+            start = time.perf_counter()
+            try:
+                code = target.call(client, method, url, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                code = None
+            elapsed = time.perf_counter() - start
+            load.latencies.setdefault(operation.route, []).append(elapsed)
+            if code not in operation.expected:
+                load.errors[operation.route] = load.errors.get(operation.route, 0) + 1
+    finally:
+        target.close(client)
+
+
+def percentile(ordered, fraction):
+    """ Nearest rank percentile of sorted values """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies, errors, duration):
+    """ Request count, errors, throughput and latency percentiles in ms """
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput": round(len(ordered) / duration, 1),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+    }
+
+
+def run(target, mix_name, size, concurrency, args):
+    """ Runs one combination and returns its results """
+    mix = MIXES[mix_name]
+    loads = [Load(args.seed + index, args.carts, size) for index in range(concurrency)]
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=worker, args=(target, load, mix, deadline)) for load in loads]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    routes = {}
+    for load in loads:
+        for route, latencies in load.latencies.items():
+            routes.setdefault(route, []).extend(latencies)
+    errors = {route: sum(load.errors.get(route, 0) for load in loads) for route in routes}
+    result = {
+        "target": target.name,
+        "mix": mix_name,
+        "cart_size": size,
+        "concurrency": concurrency,
+        **summarize([value for values in routes.values() for value in values], sum(errors.values()), duration),
+        "routes": {route: summarize(latencies, errors[route], duration) for route, latencies in sorted(routes.items())},
+    }
+    return result
+
+
+######################################################################
+#  D A T A
+######################################################################
+def seed(carts, size):
+    """ Creates carts of size items for the mixes to work on """
+    for customer_id in range(FIRST_CUSTOMER_ID, FIRST_CUSTOMER_ID + carts):
+        ShopCart.clear_cart(customer_id, delete_cart=True)
+        Cart(customer_id=customer_id).create()
+        ShopCart.replace_items(customer_id, [
+            ShopCart(customer_id=customer_id, product_id=product_id, quantities=1) for product_id in range(size)
+        ])
+
+
+def cleanup(carts):
+    """ Removes the seeded and the scratch carts """
+    for customer_id in range(FIRST_CUSTOMER_ID, FIRST_CUSTOMER_ID + carts):
+        ShopCart.clear_cart(customer_id, delete_cart=True)
+    for customer_id in range(FIRST_SCRATCH_CUSTOMER_ID, FIRST_SCRATCH_CUSTOMER_ID + SCRATCH_CUSTOMERS):
+        ShopCart.clear_cart(customer_id, delete_cart=True)
+    db.session.remove()
+
+
+######################################################################
+#  R E P O R T S
+######################################################################
+def key(result):
+    """ What identifies a run across reports """
+    return (result["target"], result["mix"], result["cart_size"], result["concurrency"])
+
+
+def print_result(result, routes=False):
+    """ Prints one row per run, and one per route with routes """
+    print(f"{result['target']:>6} {result['mix']:>9} {result['cart_size']:>5} {result['concurrency']:>5} "
+          f"{result['throughput']:>9.1f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+          f"{result['errors']:>6}")
+    if routes:
+        for route, stats in result["routes"].items():
+            print(f"{'':>29} {stats['throughput']:>9.1f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+                  f"{stats['p99_ms']:>8.2f} {stats['errors']:>6}  {route}")
+
+
+def environment(args):
+    """ What the numbers of a run depend on besides the code """
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "store": app.config["CART_STORE"],
+        "duration": args.duration,
+        "carts": args.carts,
+        "workers": args.workers,
+        "server": args.server,
+    }
+
+
+def load_baseline(path):
+    """ Reads a baseline written by save() """
+    with open(path, encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)
+
+
+def comparable(baseline, args):
+    """ Tells which environment settings differ from the baseline, a missing one differs too """
+    recorded = baseline.get("environment", {})
+    different = {name: value for name, value in environment(args).items() if recorded.get(name) != value}
+    if not different:
+        return True
+    print(f"{args.compare} was measured in another environment, its numbers are not comparable:", file=sys.stderr)
+    for name, value in different.items():
+        print(f"  {name}: {recorded.get(name)} in the baseline, {value} here", file=sys.stderr)
+    print("Save a baseline of this environment with --save and compare with that one", file=sys.stderr)
+    return False
+
+
+def compare(results, baseline, baseline_path, fail_over):
+    """ Prints the change of every run against a baseline, returns False on a regression """
+    baseline = {key(result): result for result in baseline["runs"]}
+    ok = True
+    print(f"\nagainst {baseline_path}")
+    print(f"{'target':>6} {'mix':>9} {'size':>5} {'conc':>5} {'req/s':>9} {'p95':>8}")
+    for result in results:
+        old = baseline.get(key(result))
+        if old is None:
+            print(f"{result['target']:>6} {result['mix']:>9} {result['cart_size']:>5} {result['concurrency']:>5} "
+                  f"{'new':>9}")
+            continue
+        throughput = change(old["throughput"], result["throughput"])
+        p95 = change(old["p95_ms"], result["p95_ms"])
+        print(f"{result['target']:>6} {result['mix']:>9} {result['cart_size']:>5} {result['concurrency']:>5} "
+              f"{throughput:>+8.1f}% {p95:>+7.1f}%")
+        if fail_over is not None and (-throughput > fail_over or p95 > fail_over):
+            ok = False
+    return ok
+
+
+def change(old, new):
+    """ Change from old to new in percent """
+    return (new - old) / old * 100 if old else 0.0
+
+
+def save(results, path, args):
+    """ Writes the results as a stable, diff friendly JSON document """
+    document = {
+        "environment": environment(args),
+        "runs": sorted(results, key=key),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as out:
+        json.dump(document, out, indent=2, sort_keys=True)
+        out.write("\n")
+
+
+def main(argv=None):
+    """ Runs every combination, prints and saves the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), default=["client"])
+    parser.add_argument("--mixes", nargs="+", choices=list(MIXES), default=["browse", "checkout"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 50], help="Items in every seeded cart")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="Client threads")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds every combination runs")
+    parser.add_argument("--carts", type=int, default=100, help="Seeded carts")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random request mix")
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi", help="Server of the http target")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers of the http target")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--routes", action="store_true", help="Print the latency of every route")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline")
+    parser.add_argument("--fail-over", type=float, help="Exit with 1 on a regression of more than this percent")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        if not comparable(baseline, args):
+            return 2
+
+    results = []
+    print(f"{'target':>6} {'mix':>9} {'size':>5} {'conc':>5} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'errors':>6}")
+    try:
+        for size in args.sizes:
+            seed(args.carts, size)
+            db.session.remove()
+            for target_name in args.targets:
+                with TARGETS[target_name](args) as target:
+                    for mix_name in args.mixes:
+                        for concurrency in args.concurrency:
+                            result = run(target, mix_name, size, concurrency, args)
+                            print_result(result, routes=args.routes)
+                            results.append(result)
+    finally:
+        cleanup(args.carts)
+
+    if args.save:
+        save(results, args.save, args)
+    if baseline is not None and not compare(results, baseline, args.compare, args.fail_over):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+gunicorn settings
+
+With PROMETHEUS_MULTIPROC_DIR set, every worker writes its metrics to
+that directory and /metrics adds them up. The directory is emptied when
+gunicorn starts, and a worker that exits is dropped from the gauges.
+"""
+import os
+import shutil
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """ Starts from an empty metrics directory """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """ Removes the gauges of a worker that exited """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
@@ -8,12 +8,14 @@ import sys
 from flask import Flask
 from service import config
 from flask_restx import Api
-from service.common import log_handlers
+from service.common import log_handlers, startup
+from service.common.json_provider import OrjsonProvider, output_json
 
 # Create Flask application
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config.from_object(config)
+app.json = OrjsonProvider(app)
 
 # # Document the type of authorization required
 # authorizations = {
@@ -35,22 +37,33 @@ api = Api(app,
           doc='/apidocs', # default also could use doc='/apidocs/'
           prefix='/api'
          )
+# encode the API responses with the app JSON provider
+api.representation('application/json')(output_json)
 
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
-from service import routes,models  # noqa: E402, E261
+from service import routes, models, storage  # noqa: E402, E261
 # pylint: disable=wrong-import-position
 from service.common import error_handlers, cli_commands  # noqa: F401, E402
+from service.common.timing import init_timing  # noqa: E402
+from service.common.metrics import init_metrics  # noqa: E402
 
 # Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+with startup.step("init_logging"):
+    log_handlers.init_logging(app, "gunicorn.error")
+with startup.step("init_timing"):
+    init_timing(app)
+with startup.step("init_metrics"):
+    init_metrics(app)
 
 app.logger.info(70 * "*")
 app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
-    models.init_db(app)  # make our SQLAlchemy tables
+    # connects the database, and creates the tables with DB_AUTO_CREATE, unless carts are kept in memory
+    with startup.step("init_store"):
+        storage.init_store(app)
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,195 @@
+"""
+ASGI Application
+
+Serves the GET routes that storefronts poll from an async SQLAlchemy
+engine, so one worker keeps many Postgres round trips in flight instead of
+blocking on one. Every other request, including the Swagger docs, is
+handed to the Flask app on a thread pool, so the URL surface and the docs
+are exactly the ones of the WSGI mode.
+
+The async routes are instrumented like their Flask rules: they count in
+the request metrics under the same route template, send the Server-Timing
+header and timing log line with SERVER_TIMING on, and their statements
+reach the slow query log with the route as the caller.
+
+Run it with:
+  uvicorn --workers 2 service.asgi:app
+  gunicorn -k uvicorn.workers.UvicornWorker service.asgi:app
+"""
+import re
+import time
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags, quote_etag
+from service import app as flask_app
+from service.common import metrics, slow_query, timing
+from service.routes import MAX_INT_STRING, MIN_INT_STRING, cart_etag, render_shopcart
+from service.storage import WriteBehindCartStore
+from service.storage.aio import AsyncSqlCartReader, BufferedCartReader, InlineCartReader
+
+CART_PATH = re.compile(r"^/api/shopcarts/(\d+)/?$")
+ITEMS_PATH = re.compile(r"^/api/shopcarts/(\d+)/items/?$")
+ITEM_PATH = re.compile(r"^/api/shopcarts/(\d+)/items/(\d+)/?$")
+JSON_MIMETYPE = "application/json"
+MIN_QUANTITY = int(MIN_INT_STRING)
+MAX_QUANTITY = int(MAX_INT_STRING)
+
+
+class ShopcartASGI:
+    """
+    ASGI app with async versions of the read routes in front of the Flask app
+
+    A request only takes the async path when the Flask route would answer it
+    with 200 or 304. Anything else, e.g. a 404, a query string filter or an
+    X-Fields mask, falls back to Flask, which renders it the usual way.
+    """
+
+    def __init__(self, wsgi_app, reader, workers=10):
+        self.wsgi_app = wsgi_app
+        self.reader = reader
+        self.fallback = WSGIMiddleware(wsgi_app, workers=workers)
+        self.metrics = wsgi_app.extensions.get("metrics", False)
+        self.server_timing = wsgi_app.config.get("SERVER_TIMING", False)
+        # the rule of the Flask route each one stands in for, the label of its metrics
+        adapter = wsgi_app.url_map.bind("localhost")
+        self.routes = [
+            (pattern, handler, adapter.match(path, "GET", return_rule=True)[0].rule)
+            for pattern, handler, path in [
+                (CART_PATH, self.get_cart, "/api/shopcarts/1"),
+                (ITEMS_PATH, self.get_items, "/api/shopcarts/1/items"),
+                (ITEM_PATH, self.get_item, "/api/shopcarts/1/items/1"),
+            ]
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET":
+            response = await self.dispatch(scope)
+            if response is not None:
+                await send_response(send, *response)
+                return
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """ Opens the async engines at startup and closes them at shutdown """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        """ Connects the reader """
+        self.reader.connect(self.wsgi_app.config)
+
+    async def shutdown(self):
+        """ Closes the reader and writes out what the cart store still holds """
+        await self.reader.close()
+        self.wsgi_app.extensions["cart_store"].close()
+
+    async def dispatch(self, scope):
+        """ Runs the async route of the request, returns None to fall back to Flask """
+        headers = dict(scope["headers"])
+        if b"x-fields" in headers:
+            return None
+        for pattern, handler, rule in self.routes:
+            match = pattern.match(scope["path"])
+            if match:
+                return await self.instrumented(scope, rule, handler(scope, headers, *map(int, match.groups())))
+        return None
+
+    async def instrumented(self, scope, rule, route):
+        """ Awaits an async route with the timing, metrics and slow query caller of its Flask rule """
+        timer = timing.RequestTimer() if self.server_timing else None
+        start = time.perf_counter()
+        timer_token = timing.use_timer(timer)
+        route_token = slow_query.use_route(f"GET {rule}")
+        try:
+            response = await route
+        finally:
+            slow_query.reset_route(route_token)
+            timing.reset_timer(timer_token)
+        if response is None:
+            return None  # Flask answers it, and records it
+        total = time.perf_counter() - start
+        status, etag, body = response
+        extra_headers = []
+        if timer is not None:
+            extra_headers.append((b"server-timing", timer.server_timing(total).encode("latin-1")))
+            timing.log_timing("GET", scope["path"], status, timer, total)
+        if self.metrics:
+            metrics.observe_request("GET", rule, status, total)
+        return status, etag, body, extra_headers
+
+    ######################################################################
+    #  A S Y N C   R O U T E S
+    ######################################################################
+
+    async def get_cart(self, scope, headers, customer_id):
+        """ Async GET /api/shopcarts/<customer_id> """
+        items = await self.reader.read_by_customer_id(customer_id)
+        if not items and not await self.reader.check_exist_by_customer_id(customer_id):
+            return None
+        return self.conditional(headers, items, lambda: [render_shopcart(item) for item in items])
+
+    async def get_items(self, scope, headers, customer_id):
+        """ Async GET /api/shopcarts/<customer_id>/items, without filters """
+        if scope["query_string"]:
+            return None
+        items = await self.reader.read_by_customer_id(customer_id)
+        # the Flask route applies the default quantity range
+        items = [item for item in items if MIN_QUANTITY <= item.quantities <= MAX_QUANTITY]
+        if not items and not await self.reader.check_exist_by_customer_id(customer_id):
+            return None
+        return self.conditional(headers, items, lambda: [render_shopcart(item) for item in items])
+
+    async def get_item(self, scope, headers, customer_id, product_id):
+        """ Async GET /api/shopcarts/<customer_id>/items/<product_id> """
+        item = await self.reader.read_item(customer_id, product_id)
+        if item is None:
+            return None
+        return self.conditional(headers, [item], lambda: render_shopcart(item))
+
+    def conditional(self, headers, items, render):
+        """ Answers 304 when If-None-Match names the items, else renders them """
+        etag = cart_etag(items)
+        etag_header = quote_etag(etag)
+        if_none_match = parse_etags(headers.get(b"if-none-match", b"").decode("latin-1"))
+        if if_none_match.contains_weak(etag):
+            return 304, etag_header, b""
+        timer = timing.current_timer()
+        if timer is None:
+            return 200, etag_header, (self.wsgi_app.json.dumps(render()) + "\n").encode()
+        start = time.perf_counter()
+        data = render()
+        marshalled = time.perf_counter()
+        body = (self.wsgi_app.json.dumps(data) + "\n").encode()
+        timer.marshal += marshalled - start
+        timer.json += time.perf_counter() - marshalled
+        return 200, etag_header, body
+
+
+async def send_response(send, status, etag, body, extra_headers=()):
+    """ Sends a JSON response with an ETag """
+    headers = [(b"etag", etag.encode("latin-1")), *extra_headers]
+    if status != 304:
+        headers += [(b"content-type", JSON_MIMETYPE.encode()), (b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_app(wsgi_app=flask_app):
+    """ Builds the ASGI app around a Flask app, reading from its cart store """
+    store = wsgi_app.extensions["cart_store"]
+    reader = AsyncSqlCartReader() if store.name == "sql" else InlineCartReader(store)
+    if isinstance(store, WriteBehindCartStore) and store.name == "sql":
+        reader = BufferedCartReader(reader, store)
+    return ShopcartASGI(wsgi_app, reader, workers=wsgi_app.config["ASGI_WSGI_THREADS"])
+
+
+app = create_app()
@@ -0,0 +1,144 @@
+"""
+Cart Cache
+
+An in-process LRU cache of shopcart rows keyed by customer id, with a time
+to live for every entry and a cap on the memory it may use
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Rough size of one cached row: a tuple of four ints plus dict overhead
+ROW_BYTES = 200
+
+
+class CartCache:
+    """
+    Bounded LRU cache of the shopcart rows of each customer
+
+    Every customer has one entry holding any number of cached lookups,
+    e.g. the full item list or a single product, so all of them can be
+    dropped at once when the cart changes. Entries expire after ttl
+    seconds, and the least recently used ones are evicted when there are
+    more than max_customers entries or they hold more than max_bytes.
+    """
+
+    def __init__(self, max_customers=0, ttl=5.0, max_bytes=4 * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._epoch = 0
+        self.max_customers = max_customers
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        """ True when the cache may hold any entry """
+        return self.max_customers > 0
+
+    def configure(self, max_customers, ttl, max_bytes):
+        """ Changes the limits of the cache and empties it """
+        with self._lock:
+            self.max_customers = max_customers
+            self.ttl = ttl
+            self.max_bytes = max_bytes
+            self._entries.clear()
+            self._bytes = 0
+
+    def get(self, customer_id, key):
+        """
+        Looks up a cached value
+
+        Returns:
+            tuple: (True, value) on a hit, (False, None) on a miss
+        """
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is not None and entry["expires"] <= time.monotonic():
+                self._drop(customer_id)
+                self.expirations += 1
+                entry = None
+            if entry is None or key not in entry["values"]:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(customer_id)
+            self.hits += 1
+            return True, entry["values"][key]
+
+    def token(self):
+        """ Returns a token to take before reading the value that will be put """
+        return self._epoch
+
+    def put(self, customer_id, key, value, rows, token=None):
+        """
+        Caches value, which holds rows rows, under the entry of the customer
+
+        When a token is given the value is dropped if anything was
+        invalidated since it was taken, since the value may be stale.
+        """
+        size = max(rows, 1) * ROW_BYTES
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            if token is not None and token != self._epoch:
+                return
+            entry = self._entries.get(customer_id)
+            if entry is None:
+                entry = {"expires": time.monotonic() + self.ttl, "values": {}, "sizes": {}, "bytes": 0}
+                self._entries[customer_id] = entry
+            else:
+                self._entries.move_to_end(customer_id)
+            old_size = entry["sizes"].get(key, 0)
+            entry["values"][key] = value
+            entry["sizes"][key] = size
+            entry["bytes"] += size - old_size
+            self._bytes += size - old_size
+            while self._entries and (len(self._entries) > self.max_customers or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, customer_id):
+        """ Drops everything cached for a customer """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._epoch += 1
+            if customer_id in self._entries:
+                self._drop(customer_id)
+                self.invalidations += 1
+
+    def clear(self):
+        """ Empties the cache """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ Returns the size, limits and counters of the cache """
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "customers": len(self._entries),
+                "bytes": self._bytes,
+                "max_customers": self.max_customers,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _drop(self, customer_id):
+        """ Removes the entry of a customer, the lock must be held """
+        entry = self._entries.pop(customer_id)
+        self._bytes -= entry["bytes"]
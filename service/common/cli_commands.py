@@ -1,8 +1,12 @@
 """
 Flask CLI Command Extensions
 """
+import time
+import click
+from sqlalchemy import inspect
 from service import app
-from service.models import db
+from service.common import startup
+from service.models import db, add_version_column, legacy_shop_cart, migrate_legacy_batch
 
 
 ######################################################################
@@ -19,3 +23,97 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create the tables the service needs, once per deploy
+# Usage:
+#   flask db-init
+######################################################################
+@app.cli.command("db-init")
+def db_init():
+    """
+    Creates the missing tables and columns of the service, leaving the
+    existing ones and their rows alone. Run it before the workers start
+    when they run with DB_AUTO_CREATE=false.
+    """
+    db.create_all()
+    if add_version_column():
+        click.echo("Added cart_item.version_id")
+    click.echo("Database is up to date")
+
+
+######################################################################
+# Command to move the old shop_cart rows into cart and cart_item
+# Usage:
+#   flask db-migrate-carts [--batch-size 1000] [--after-id 0] [--pause 0]
+######################################################################
+@app.cli.command("db-migrate-carts")
+@click.option("--batch-size", default=1000, show_default=True, help="Legacy rows copied per transaction")
+@click.option("--after-id", default=0, show_default=True, help="Resume after this legacy shop_cart id")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches")
+def db_migrate_carts(batch_size, after_id, pause):
+    """
+    Copies the legacy shop_cart rows into the cart and cart_item tables.
+    Each batch is its own short transaction and no table is locked, so it
+    can run while the service is up. It can be stopped and resumed with
+    --after-id, and rows that were already copied are skipped.
+    """
+    if not inspect(db.engine).has_table(legacy_shop_cart.name):
+        click.echo("No legacy shop_cart table, nothing to migrate")
+        return
+    db.create_all()
+    total = 0
+    while True:
+        last_id, count = migrate_legacy_batch(after_id, batch_size)
+        if last_id is None:
+            break
+        total += count
+        after_id = last_id
+        click.echo(f"Migrated {total} rows, resume with --after-id {after_id}")
+        if pause:
+            time.sleep(pause)
+    click.echo(f"Migration complete, {total} rows migrated")
+
+
+######################################################################
+# Command to add the version_id column to an existing cart_item table
+# Usage:
+#   flask db-add-version-column
+######################################################################
+@app.cli.command("db-add-version-column")
+def db_add_version_column():
+    """
+    Adds cart_item.version_id, which ShopCart needs for optimistic
+    concurrency, to a database created before it existed. Every row
+    starts at version 1. Postgres stores the constant default in the
+    catalog, so the table is not rewritten.
+    """
+    if add_version_column():
+        click.echo("Added cart_item.version_id")
+    else:
+        click.echo("cart_item.version_id already exists")
+
+
+######################################################################
+# Command to show what makes the service slow to start
+# Usage:
+#   flask startup-profile [--top 20]
+######################################################################
+@app.cli.command("startup-profile")
+@click.option("--top", default=20, show_default=True, help="Slowest packages to show")
+def startup_profile(top):
+    """
+    Imports the service in a fresh interpreter, with the settings of this
+    environment, and prints how long it took: in total, for every init
+    step of service/__init__.py, and for the import of every package and
+    service module, slowest first.
+    """
+    report = startup.profile()
+    click.echo(f"Import and init: {report['total'] * 1000:8.1f} ms")
+    click.echo("\nInit steps")
+    for name, seconds in report["steps"].items():
+        click.echo(f"  {seconds * 1000:8.1f} ms  {name}")
+    click.echo("\nImports, own time of every package")
+    for name, seconds in report["imports"][:top]:
+        click.echo(f"  {seconds * 1000:8.1f} ms  {name}")
@@ -0,0 +1,70 @@
+"""
+JSON Provider
+
+Encodes the JSON responses of the app and of flask-restx with orjson when it
+is installed, and falls back to the standard library json otherwise
+"""
+import time
+from flask import current_app, make_response
+from flask.json.provider import DefaultJSONProvider
+from flask_restx.representations import output_json as restx_output_json
+from service.common.timing import current_timer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    DefaultJSONProvider that encodes with orjson when it is available
+
+    Dates, dataclasses and anything else orjson does not know go through
+    the same default() as Flask, so the output matches the stdlib provider.
+    Arguments orjson cannot honour, e.g. indent=4, use the stdlib encoder.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = self._orjson_option(kwargs)
+        if option is None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def _orjson_option(self, kwargs):
+        """ Returns the orjson options for the dumps() arguments, or None to use json """
+        if orjson is None:
+            return None
+        indent = kwargs.get("indent")
+        separators = kwargs.get("separators")
+        if set(kwargs) - {"indent", "separators"} or indent not in (None, 2) or separators not in (None, (",", ":")):
+            return None
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+
+def output_json(data, code, headers=None):
+    """
+    flask-restx representation for application/json using the app provider
+
+    Keeps the restx encoder in debug mode or when RESTX_JSON is configured,
+    since those ask for stdlib json options.
+    """
+    if current_app.debug or current_app.config.get("RESTX_JSON"):
+        return restx_output_json(data, code, headers)
+    timer = current_timer()
+    start = time.perf_counter() if timer else 0
+    resp = make_response(current_app.json.dumps(data) + "\n", code)
+    if timer:
+        timer.json += time.perf_counter() - start
+    resp.headers.extend(headers or {})
+    return resp
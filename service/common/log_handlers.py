@@ -19,18 +19,187 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+The records of the app are put on a queue and written to the gunicorn
+handlers by a background thread, so a request never waits for the log.
+Their messages are formatted on that thread too, log with %-style
+arguments rather than f-strings. Info and debug records can be sampled.
 """
+import atexit
+import datetime
+import json
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+# Arguments the background thread can format safely, anything else,
+# e.g. a model that may load an attribute, is formatted by the caller
+PLAIN_TYPES = (str, int, float, bool, type(None))
+# Attributes of every LogRecord, the others were passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+EXCEPTION_FORMATTER = logging.Formatter()
+
+# The handler of init_logging(), whose listener a forked child starts again
+_active = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object, with the fields passed as extra """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if orjson is not None:
+            return orjson.dumps(entry, default=str).decode()
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a share of the records of some levels
+
+    rates maps a level to the share that is kept, e.g. {logging.INFO: 0.1}
+    keeps every tenth info record. The records of the other levels are
+    all kept. It counts instead of drawing random numbers, so the share
+    is exact.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {level: rate for level, rate in rates.items() if rate < 1}
+        self._credit = dict.fromkeys(self.rates, 0.0)
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None:
+            return True
+        # approximate when threads race, it only decides which records are kept
+        credit = self._credit[record.levelno] + rate
+        if credit >= 1:
+            self._credit[record.levelno] = credit - 1
+            return True
+        self._credit[record.levelno] = credit
+        self.sampled_out += 1
+        return False
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Puts the records on a bounded queue that a QueueListener thread writes out
+
+    A full queue drops the record instead of blocking, dropped counts them.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.SimpleQueue())
+        self.targets = list(handlers)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = None
+
+    def start(self):
+        """ Starts the thread that writes the records to the handlers """
+        self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """ Writes out the queued records and stops the thread """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def after_fork(self):
+        """ Gives a forked child its own queue and thread, the parent writes what it queued """
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self.start()
+
+    def prepare(self, record):
+        # the stdlib formats the message here, on the thread that logs;
+        # only what the background thread cannot do safely is done now
+        if record.args and not all(isinstance(arg, PLAIN_TYPES) for arg in _arguments(record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # the traceback holds the frames, and everything they reference, until it is written
+            record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue is much faster than Queue, but has no maxsize
+        if self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+def _arguments(args):
+    """ The values of the arguments of a record, a tuple or a single mapping """
+    return args.values() if isinstance(args, dict) else args
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
+    global _active  # pylint: disable=global-statement
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for gunicorn_handler in gunicorn_logger.handlers:
+        gunicorn_handler.setFormatter(formatter)
+    if not gunicorn_logger.handlers:
+        # not under gunicorn, nothing to write to
+        app.logger.handlers = []
+        return
+
+    handler = LogQueueHandler(gunicorn_logger.handlers, app.config.get("LOG_QUEUE_SIZE", 10000))
+    handler.addFilter(SamplingFilter({
+        logging.INFO: app.config.get("LOG_SAMPLE_INFO", 1.0),
+        logging.DEBUG: app.config.get("LOG_SAMPLE_DEBUG", 1.0),
+    }))
+    handler.start()
+    atexit.register(handler.stop)
+    _active = handler
+    # the modules of the service log to flask.app, not to the logger of the app
+    for logger in (app.logger, logging.getLogger("flask.app")):
+        logger.propagate = False
+        logger.setLevel(gunicorn_logger.level)
+        logger.handlers = [handler]
     app.logger.info("Logging handler established")
+
+
+def _after_fork():
+    """ Starts the listener of the active handler in a forked child, e.g. a gunicorn --preload worker """
+    if _active is not None:
+        _active.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
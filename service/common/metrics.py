@@ -0,0 +1,148 @@
+"""
+Prometheus Metrics
+
+Counts the requests of every route by method and status, and keeps
+latency histograms of the routes and of the SQL statements. The
+connection pool and cart cache numbers are exported as gauges. GET
+/metrics serves them in the Prometheus text format.
+
+Under gunicorn every worker has its own numbers. Point the
+PROMETHEUS_MULTIPROC_DIR environment variable at an empty directory
+before the workers start (gunicorn.conf.py creates it and empties it
+on start) and every worker writes its samples there, so /metrics
+answers the sum over all workers, whichever worker serves the scrape.
+
+prometheus_client is optional; without it, or with METRICS_ENABLED off,
+nothing is registered and there is no /metrics route.
+"""
+import logging
+import os
+import time
+from flask import Response, g, request
+from service.common import statements
+from service.models import cart_cache
+from service.storage import get_store
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+    )
+except ImportError:  # pragma: no cover
+    Counter = None
+
+logger = logging.getLogger("flask.app")
+
+# Seconds, from a cached single row read to a slow bulk write
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+# Statement kinds of the query histogram, anything else is "OTHER"
+QUERY_KINDS = frozenset(["SELECT", "INSERT", "UPDATE", "DELETE", "WITH"])
+# A worker refreshes its pool and cache gauges at most this often
+GAUGE_INTERVAL = 1.0
+
+if Counter is not None:
+    REQUESTS = Counter("shopcart_http_requests", "Requests served", ["method", "route", "status"])
+    REQUEST_LATENCY = Histogram("shopcart_http_request_duration_seconds", "Time to build the response",
+                                ["method", "route"], buckets=REQUEST_BUCKETS)
+    QUERY_LATENCY = Histogram("shopcart_db_query_duration_seconds", "Time of a SQL statement",
+                              ["statement"], buckets=QUERY_BUCKETS)
+    POOL = Gauge("shopcart_db_pool_connections", "Connection pool usage, summed over the workers",
+                 ["engine", "state"], multiprocess_mode="livesum")
+    CACHE = Gauge("shopcart_cart_cache", "Cart cache size and counters, summed over the workers",
+                  ["stat"], multiprocess_mode="livesum")
+
+# (method, route, status) -> the counter and histogram of the labels, labels() is the slow part
+_children = {}
+_next_gauge_refresh = 0.0
+
+
+######################################################################
+#  R E C O R D I N G
+######################################################################
+
+def start_request():
+    """ Notes when a request started """
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(response):
+    """ Counts a response and observes its latency """
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    # the route template, so /api/shopcarts/1 and /api/shopcarts/2 share their series
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    observe_request(request.method, route, response.status_code, elapsed)
+    if time.monotonic() >= _next_gauge_refresh:
+        refresh_gauges()
+    return response
+
+
+def observe_request(method, route, status, elapsed):
+    """ Counts a response of a route template and observes its latency, also for the async routes """
+    key = (method, route, status)
+    children = _children.get(key)
+    if children is None:
+        children = _children[key] = (REQUESTS.labels(*key), REQUEST_LATENCY.labels(method, route))
+    children[0].inc()
+    children[1].observe(elapsed)
+
+
+def record_statement(conn, statement, parameters, elapsed, executemany):  # pylint: disable=unused-argument
+    """ Observes the latency of a SQL statement by its kind """
+    kind = statement.split(None, 1)[0].upper() if statement else ""
+    QUERY_LATENCY.labels(kind if kind in QUERY_KINDS else "OTHER").observe(elapsed)
+
+
+def refresh_gauges():
+    """ Copies the pool and cache numbers of this worker into the gauges """
+    global _next_gauge_refresh  # pylint: disable=global-statement
+    _next_gauge_refresh = time.monotonic() + GAUGE_INTERVAL
+    store = get_store()
+    if store.name == "sql":
+        status = store.pool_status()
+        engines = [("primary", status)] + [(f"replica{index}", replica) for index, replica in
+                                           enumerate(status.get("replicas", []))]
+        for engine, engine_status in engines:
+            for state, value in engine_status.items():
+                if isinstance(value, int):
+                    POOL.labels(engine, state).set(value)
+    for stat, value in cart_cache.stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            CACHE.labels(stat).set(value)
+
+
+######################################################################
+#  E N D P O I N T
+######################################################################
+
+def metrics():
+    """ The metrics of every worker in the Prometheus text format """
+    refresh_gauges()
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+def init_metrics(app):
+    """ Records the metrics of the app and serves them on /metrics """
+    if not app.config.get("METRICS_ENABLED"):
+        return
+    if Counter is None:
+        logger.warning("METRICS_ENABLED is set but prometheus_client is not installed, no /metrics")
+        return
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        # gunicorn.conf.py makes it for the workers, not for flask commands or uvicorn
+        os.makedirs(path, exist_ok=True)
+    statements.add_consumer(record_statement)
+    app.before_request(start_request)
+    app.after_request(record_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    # the ASGI app records the requests it answers without Flask when this is set
+    app.extensions["metrics"] = True
+    logger.info("Prometheus metrics on /metrics")
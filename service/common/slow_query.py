@@ -0,0 +1,261 @@
+"""
+Slow Query Log
+
+Logs every SQL statement that takes longer than a threshold as one
+structured warning: its duration, the route or thread that ran it, the
+SQL, and its bound parameters with anything but numbers redacted.
+
+With explain on, a slow SELECT is also run again as EXPLAIN (ANALYZE,
+BUFFERS) by a background thread, in a transaction that is rolled back,
+and the plan is logged under the same id. The request that ran the
+query never waits for it.
+
+A token bucket caps the records per minute and a short queue caps the
+pending EXPLAINs, so a storm of slow queries, e.g. a missing index,
+cannot flood the log or double the load of the database. The records
+that were dropped are counted in the next one that gets through.
+"""
+import contextvars
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from flask import has_request_context, request
+from service.common import statements
+
+logger = logging.getLogger("flask.app")
+
+# EXPLAINs waiting for the background thread, more are dropped
+EXPLAIN_QUEUE_SIZE = 8
+# statement_timeout of an EXPLAIN ANALYZE, it runs the query once more
+EXPLAIN_TIMEOUT_MS = 10000
+# Execution option that marks the connection of the EXPLAINs, whose own statements are not logged
+EXPLAIN_OPTION = "slow_query_explain"
+# Parameters and list items shown per record
+MAX_PARAMS = 20
+
+# The log that started an EXPLAIN thread, a forked child starts it again
+_active = None
+# The route of a request that the ASGI app answers without Flask
+_task_route = contextvars.ContextVar("slow_query_route", default=None)
+
+
+def redact(value):
+    """ Keeps numbers and None, replaces anything else by its type """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in itertools.islice(value.items(), MAX_PARAMS)}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value[:MAX_PARAMS]]
+    return f"<{type(value).__name__}>"
+
+
+def caller():
+    """ The route of the current request, or the name of the thread outside a request """
+    if has_request_context():
+        rule = request.url_rule
+        return f"{request.method} {rule.rule if rule is not None else request.path}"
+    return _task_route.get() or threading.current_thread().name
+
+
+def use_route(route):
+    """ Makes route the caller of the current task outside Flask, returns the token for reset_route() """
+    return _task_route.set(route)
+
+
+def reset_route(token):
+    """ Puts back the caller of the current task from before use_route() """
+    _task_route.reset(token)
+
+
+class SlowQueryLog:
+    """
+    Logs the statements of some engines that take longer than a threshold
+
+    configure() sets the engines whose statements it looks at; with a
+    threshold of 0 it takes no statements at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = frozenset()
+        self._ids = itertools.count(1)
+        self._explains = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self._thread = None
+        self.threshold = 0.0
+        self.explain = False
+        self.max_per_minute = 60
+        self.redact = True
+        self._tokens = 0.0
+        self._refilled = 0.0
+        self._suppressed = 0
+        self.logged = 0
+        self.suppressed = 0
+        self.explained = 0
+        self.explains_dropped = 0
+        self.explains_failed = 0
+
+    @property
+    def enabled(self):
+        """ True when the statements of the engines are timed """
+        return self.threshold > 0
+
+    def configure(self, threshold_ms=0, explain=False, max_per_minute=60, redact_params=True, engines=()):
+        """ Sets the threshold and limits, and looks at the statements of the engines instead of the old ones """
+        global _active  # pylint: disable=global-statement
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.max_per_minute = max_per_minute
+        self.redact = redact_params
+        with self._lock:
+            self._tokens = float(max_per_minute)
+            self._refilled = time.monotonic()
+        self._watch(engines)
+        if self.enabled and explain and self._thread is None:
+            self._start()
+            _active = self
+        if self.enabled:
+            logger.info("Logging statements slower than %s ms", threshold_ms)
+
+    def add_engines(self, engines):
+        """ Also looks at the statements of engines, e.g. the async ones of the ASGI app """
+        self._watch(self._engines | frozenset(engines))
+
+    def remove_engines(self, engines):
+        """ Stops looking at the statements of engines """
+        self._watch(self._engines - frozenset(engines))
+
+    def _watch(self, engines):
+        """ Looks at the statements of engines only, takes none while disabled """
+        self._engines = frozenset(engines) if self.enabled else frozenset()
+        if self._engines:
+            statements.add_consumer(self._record_statement)
+        else:
+            statements.remove_consumer(self._record_statement)
+
+    def stats(self):
+        """ Returns the counters of the log """
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "threshold_ms": self.threshold * 1000,
+                "logged": self.logged,
+                "suppressed": self.suppressed,
+                "explained": self.explained,
+                "explains_dropped": self.explains_dropped,
+                "explains_failed": self.explains_failed,
+            }
+
+    ######################################################################
+    #  L O G G I N G
+    ######################################################################
+
+    def _record_statement(self, conn, statement, parameters, elapsed, executemany):
+        if elapsed < self.threshold or conn.engine not in self._engines:
+            return
+        if conn.get_execution_options().get(EXPLAIN_OPTION):
+            return
+        self.record(conn.engine, statement, parameters, elapsed, executemany)
+
+    def _allow(self):
+        """ Takes a token of the bucket, returns the records suppressed since the last one or None """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_per_minute, self._tokens + (now - self._refilled) * self.max_per_minute / 60)
+            self._refilled = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                self.suppressed += 1
+                return None
+            self._tokens -= 1
+            self.logged += 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return suppressed
+
+    def record(self, engine, statement, parameters, elapsed, executemany=False):
+        """ Logs a slow statement and queues its EXPLAIN, unless the rate limit is reached """
+        suppressed = self._allow()
+        if suppressed is None:
+            return
+        record = {
+            "id": next(self._ids),
+            "duration_ms": round(elapsed * 1000, 1),
+            "route": caller(),
+            "sql": " ".join(statement.split()),
+            "params": redact(parameters) if self.redact else repr(parameters)[:500],
+            "suppressed": suppressed,
+        }
+        logger.warning("slow_query id=%d duration_ms=%.1f route=%s suppressed=%d sql=%s params=%s",
+                       record["id"], record["duration_ms"], record["route"], suppressed, record["sql"],
+                       record["params"], extra={"slow_query": record})
+        if self.explain and not executemany and _explainable(engine, statement):
+            try:
+                self._explains.put_nowait((record["id"], engine, statement, parameters))
+            except queue.Full:
+                with self._lock:
+                    self.explains_dropped += 1
+
+    ######################################################################
+    #  E X P L A I N
+    ######################################################################
+
+    def _start(self):
+        """ Starts the thread of the EXPLAINs """
+        self._thread = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """ Gives a forked child its own queue and thread, the parent runs the EXPLAINs it queued """
+        self._lock = threading.Lock()
+        self._explains = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self._start()
+
+    def _run(self):
+        """ Runs the queued EXPLAINs one after the other """
+        while True:
+            record_id, engine, statement, parameters = self._explains.get()
+            try:
+                plan = explain(engine, statement, parameters)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("slow_query_explain id=%d failed: %s", record_id, error)
+                with self._lock:
+                    self.explains_failed += 1
+                continue
+            with self._lock:
+                self.explained += 1
+            logger.warning("slow_query_explain id=%d plan:\n%s", record_id, plan,
+                           extra={"slow_query_explain": {"id": record_id, "plan": plan}})
+
+
+def _after_fork():
+    """ Starts the EXPLAIN thread of the active log in a forked child, e.g. a gunicorn --preload worker """
+    if _active is not None:
+        _active.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _explainable(engine, statement):
+    """ True for a plain SELECT of a sync Postgres engine, the EXPLAIN thread cannot use an async one """
+    return engine.dialect.name == "postgresql" and not engine.dialect.is_async and _read_only(statement)
+
+
+def _read_only(statement):
+    """ True for a plain SELECT, the only statements that may run again for EXPLAIN ANALYZE """
+    words = statement.split(None, 1)
+    return bool(words) and words[0].upper() == "SELECT" and "FOR UPDATE" not in statement.upper()
+
+
+def explain(engine, statement, parameters):
+    """ Runs EXPLAIN (ANALYZE, BUFFERS) of a statement in a rolled back transaction, returns the plan """
+    with engine.connect() as conn:
+        conn.execution_options(**{EXPLAIN_OPTION: True})
+        with conn.begin() as transaction:
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}")
+            rows = conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters or None).scalars().all()
+            transaction.rollback()
+    return "\n".join(rows)
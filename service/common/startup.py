@@ -0,0 +1,74 @@
+"""
+Startup Profile
+
+service/__init__.py times each of its init steps with step(). profile()
+imports the service in a fresh interpreter started with -X importtime,
+so nothing is imported yet, and returns how long every module took to
+import along with the init steps. flask startup-profile prints it.
+"""
+import json
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+# Seconds each init step of service/__init__.py took, in order
+STEPS = {}
+
+# Run by profile() in the fresh interpreter, prints the steps as its last line
+PROBE = """
+import json, time
+start = time.perf_counter()
+import service
+from service.common import startup
+print(json.dumps({"total": time.perf_counter() - start, "steps": startup.STEPS}))
+"""
+
+
+@contextmanager
+def step(name):
+    """ Times an init step """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STEPS[name] = time.perf_counter() - start
+
+
+def parse_importtime(output):
+    """ Returns (module, self seconds, cumulative seconds) for every line of -X importtime """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def by_package(modules):
+    """ Adds up the import time of the modules by package, every service module on its own """
+    packages = {}
+    for name, self_time, _ in modules:
+        package = name if name.startswith("service") else name.split(".", 1)[0]
+        packages[package] = packages.get(package, 0.0) + self_time
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+def profile(env=None):
+    """
+    Imports the service in a new interpreter and returns its startup times
+
+    Returns:
+        dict: "total" seconds to import and initialize the service,
+        "steps" the seconds of every init step, "imports" the import
+        seconds of every package, slowest first
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], env=env,
+                            capture_output=True, text=True, check=False)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"The service did not start:\n{result.stderr[-2000:]}")
+    report = json.loads(lines[-1])
+    report["imports"] = by_package(parse_importtime(result.stderr))
+    return report
@@ -0,0 +1,61 @@
+"""
+Statement Hooks
+
+One pair of SQLAlchemy cursor listeners, on the Engine class so the
+replica engines and the ones created later are covered too, times every
+SQL statement once and hands its duration to the consumers that want it:
+the request timing, the query latency histogram, the slow query log and
+the query counters of the tests.
+
+A consumer is called as consumer(conn, statement, parameters, elapsed,
+executemany) in the thread that ran the statement, elapsed in seconds.
+With no consumer the listeners are removed and the statements run
+without them.
+"""
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_lock = threading.Lock()
+# replaced, never changed in place, so a statement reads it without the lock
+_consumers = ()
+
+
+def add_consumer(consumer):
+    """ Hands the duration of every statement to consumer, once however often it is added """
+    global _consumers  # pylint: disable=global-statement
+    with _lock:
+        if consumer in _consumers:
+            return
+        if not _consumers:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _consumers = _consumers + (consumer,)
+
+
+def remove_consumer(consumer):
+    """ Stops handing statements to consumer, the listeners go with the last one """
+    global _consumers  # pylint: disable=global-statement
+    with _lock:
+        if consumer not in _consumers:
+            return
+        _consumers = tuple(other for other in _consumers if other != consumer)
+        if not _consumers:
+            event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    # on the execution context, which goes away with the statement even when it fails
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    start = getattr(context, "statement_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    for consumer in _consumers:
+        consumer(conn, statement, parameters, elapsed, executemany)
@@ -0,0 +1,152 @@
+"""
+Request Timing
+
+With SERVER_TIMING on, every request counts the SQL statements it runs and
+adds up how long they took, along with the time spent marshalling the
+response into dicts and encoding them as JSON. The totals are sent back
+in a Server-Timing header, which the browser dev tools show next to the
+request, and logged as one key=value line per request.
+
+With SERVER_TIMING off nothing is registered: no statement consumer, no
+request hook, and the marshallers only find no timer on flask.g.
+
+Statements run while a streamed response is being sent are not counted,
+the header is gone by then.
+
+The ASGI app times the routes it answers without Flask the same way:
+use_timer() makes a timer the one of the current task, and the async
+statements, which run in greenlets that share the context of the task,
+are added to it.
+
+QueryCounter counts the statements of a block of code on its own, e.g. to
+hold a route to a query budget in the tests.
+"""
+import contextvars
+import logging
+import threading
+import time
+from flask import g, has_request_context, request
+from service.common import statements
+
+logger = logging.getLogger("flask.app")
+
+# The timer of a request that the ASGI app answers without Flask
+_task_timer = contextvars.ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """ What one request spent, in seconds """
+
+    __slots__ = ("start", "queries", "db", "marshal", "json")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.marshal = 0.0
+        self.json = 0.0
+
+    def server_timing(self, total):
+        """ Value of the Server-Timing header, durations in milliseconds """
+        return (f'db;dur={self.db * 1000:.2f};desc="{self.queries} queries", '
+                f"marshal;dur={self.marshal * 1000:.2f}, json;dur={self.json * 1000:.2f}, total;dur={total * 1000:.2f}")
+
+
+def current_timer():
+    """ The timer of the current request, None when timing is off or outside a request """
+    if not has_request_context():
+        return _task_timer.get()
+    return g.get("request_timer")
+
+
+def use_timer(timer):
+    """ Makes timer the one of the current task outside Flask, returns the token for reset_timer() """
+    return _task_timer.set(timer)
+
+
+def reset_timer(token):
+    """ Puts back the timer of the current task from before use_timer() """
+    _task_timer.reset(token)
+
+
+def log_timing(method, path, status, timer, total):
+    """ Logs the timings of a request as one key=value line """
+    logger.info("timing method=%s path=%s status=%d total_ms=%.2f db_queries=%d db_ms=%.2f "
+                "marshal_ms=%.2f json_ms=%.2f", method, path, status, total * 1000,
+                timer.queries, timer.db * 1000, timer.marshal * 1000, timer.json * 1000)
+
+
+######################################################################
+#  H O O K S
+######################################################################
+
+def _record_statement(conn, statement, parameters, elapsed, executemany):  # pylint: disable=unused-argument
+    timer = current_timer()
+    if timer is not None:
+        timer.queries += 1
+        timer.db += elapsed
+
+
+def start_timer():
+    """ Starts timing a request """
+    g.request_timer = RequestTimer()
+
+
+def finish_timer(response):
+    """ Adds the Server-Timing header to a response and logs the timings """
+    timer = g.pop("request_timer", None)
+    if timer is None:
+        return response
+    total = time.perf_counter() - timer.start
+    response.headers["Server-Timing"] = timer.server_timing(total)
+    log_timing(request.method, request.path, response.status_code, timer, total)
+    return response
+
+
+def init_timing(app):
+    """ Times the requests of the app when its SERVER_TIMING setting is on """
+    if not app.config.get("SERVER_TIMING"):
+        return
+    statements.add_consumer(_record_statement)
+    app.before_request(start_timer)
+    app.after_request(finish_timer)
+    logger.info("Server-Timing enabled")
+
+
+######################################################################
+#  Q U E R Y   C O U N T E R
+######################################################################
+
+class QueryCounter:
+    """
+    Context manager that records the SQL statements run in its block
+
+    Only statements of the thread that entered it are recorded, so a
+    background thread, e.g. the write-behind flush, does not count.
+
+        with QueryCounter() as queries:
+            client.get("/api/shopcarts/1")
+        assert queries.count <= 2, queries.statements
+    """
+
+    def __init__(self):
+        self.statements = []
+        self._thread = None
+
+    @property
+    def count(self):
+        """ Number of statements run so far """
+        return len(self.statements)
+
+    def _record(self, conn, statement, parameters, elapsed, executemany):  # pylint: disable=unused-argument
+        if threading.get_ident() == self._thread:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        statements.add_consumer(self._record)
+        return self
+
+    def __exit__(self, *exc):
+        statements.remove_consumer(self._record)
+        return False
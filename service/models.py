@@ -3,14 +3,90 @@ Models for ShopCart
 
 All of the models are stored in this module
 """
+import itertools
 import logging
+import os
+from collections import namedtuple
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import (
+    Column, Identity, Integer, MetaData, Table, any_, bindparam, column, create_engine, inspect, literal, select,
+    text, values
+)
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.exc import DataError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
+from service.common.cache import CartCache
+from service.common.slow_query import SlowQueryLog
 
 logger = logging.getLogger("flask.app")
 
+
+class ReplicaRouter:
+    """ Hands out the read replica engines round-robin """
+
+    def __init__(self):
+        self.engines = []
+        self._cycle = None
+
+    def configure(self, uris, engine_options=None):
+        """ Creates an engine for every replica uri, replacing the old ones """
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(uri, **(engine_options or {})) for uri in uris]
+        self._cycle = itertools.cycle(self.engines) if self.engines else None
+        logger.info("Routing reads to %d replicas", len(self.engines))
+
+    def next_engine(self):
+        """ Returns the replica engine for the next read, or None without replicas """
+        return next(self._cycle) if self._cycle else None
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to the read replicas
+
+    SELECT statements go round-robin to the DATABASE_REPLICA_URIS engines.
+    Writes, SELECT ... FOR UPDATE, and every statement after the session
+    has written, go to the primary so a request always reads its own writes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self.wrote:
+            if self._flushing or isinstance(clause, UpdateBase) or _locks_rows(clause):
+                self.wrote = True
+            elif isinstance(clause, Select):
+                replica = replicas.next_engine()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _locks_rows(clause):
+    """ True for a SELECT ... FOR UPDATE, which only the primary can run """
+    return isinstance(clause, Select) and clause._for_update_arg is not None  # pylint: disable=protected-access
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Per process cache of the items of each customer, configured in init_db()
+cart_cache = CartCache()
+
+# Warnings for the statements slower than SLOW_QUERY_MS, configured in init_db()
+slow_query_log = SlowQueryLog()
 
 
 # Function to initialize the database
@@ -19,24 +95,205 @@ def init_db(app):
     ShopCart.init_db(app)
 
 
+def dispose_pools():
+    """
+    Forgets the pooled connections a forked process inherited
+
+    They are dropped without being closed, the parent keeps using them.
+    Runs in every child after a fork, so gunicorn --preload workers open
+    their own connections instead of sharing the sockets of the master.
+    """
+    if ShopCart.app is not None and "sqlalchemy" in ShopCart.app.extensions:
+        with ShopCart.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+    for engine in replicas.engines:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_pools)
+
+
+def remove_session(exception=None):  # pylint: disable=unused-argument
+    """ Ends the session of a request and returns its connection to the pool """
+    db.session.remove()
+
+
+def pool_status():
+    """ Returns the connection usage of the primary and replica engine pools """
+    status = _engine_pool_status(db.engine)
+    if replicas.engines:
+        status["replicas"] = [_engine_pool_status(engine) for engine in replicas.engines]
+    return status
+
+
+def _engine_pool_status(engine):
+    """ Returns the connection usage of the pool of one engine """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": pool.status()}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,  # pylint: disable=protected-access
+    }
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class ItemRecord(namedtuple("ItemRecord", ["id", "customer_id", "product_id", "quantities", "version_id"])):
+    """
+    Read only cart item, fetched with a Core select() instead of a ShopCart
+
+    It is a plain tuple, so it is also what the cart cache keeps.
+    """
+    __slots__ = ()
+
+    def snapshot(self):
+        """ Returns the record itself, it already is the cached tuple """
+        return self
+
+
+class CartRecord(namedtuple("CartRecord", ["id", "customer_id"])):
+    """ Read only Cart, fetched with a Core select() instead of a Cart """
+    __slots__ = ()
+
+    # what the old sentinel row had, see Cart.serialize()
+    product_id = -1
+    quantities = 1
+
+
+class Cart(db.Model):
+    """
+    Class that represents the shopcart of a customer
+    """
+    # Table Schema
+    id = db.Column(db.BigInteger, Identity(start=1), primary_key=True)
+    # Should add db.ForeignKey(customer.id) when integrate with Customer.
+    customer_id = db.Column(db.Integer, nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"<Cart customer_id=[{self.customer_id}]>"
+
+    def create(self):
+        """
+        Creates a Cart record to the database.
+        """
+        logger.info("Creating a Cart record for customer %d", self.customer_id)
+        db.session.add(self)
+        db.session.commit()
+
+    def serialize(self):
+        """
+        Serializes a Cart into a dictionary
+
+        product_id and quantities keep the values the old sentinel row had,
+        so the API returns carts in the same shape as before.
+        """
+        return {"id": self.id, "customer_id": self.customer_id, "product_id": -1, "quantities": 1}
+
+    @classmethod
+    def create_for_customer(cls, customer_id):
+        """
+        Creates the Cart of a customer in a single statement
+
+        Returns:
+            Cart: the new cart, or None if the customer already has one
+        """
+        logger.info("Creating a Cart for customer %d", customer_id)
+        stmt = (
+            insert(cls)
+            .values(customer_id=customer_id)
+            .on_conflict_do_nothing(index_elements=["customer_id"])
+            .returning(cls)
+        )
+        cart = db.session.scalars(stmt).first()
+        if cart is not None:
+            db.session.expunge(cart)
+        db.session.commit()
+        return cart
+
+    @classmethod
+    def find_by_customer_id(cls, customer_id):
+        """ Finds the Cart of a customer """
+        logger.info("Processing cart lookup for customer id %d ...", customer_id)
+        return cls.query.filter(cls.customer_id == customer_id).first()
+
+    @classmethod
+    def check_exist_by_customer_id(cls, customer_id):
+        """ check if the customer has a Cart """
+        logger.info("Checking cart of customer id %d", customer_id)
+        return db.session.query(select(cls.id).where(cls.customer_id == customer_id).exists()).scalar()
+
+    @classmethod
+    def all_shopcarts(cls, after_id=None, limit=None):
+        """
+        Returns the Cart in the database ordered by id
+
+        Args:
+            after_id (int): only return carts with an id greater than this one
+            limit (int): the maximum number of carts to return
+        """
+        logger.info("Processing all Cart after id %s limit %s", after_id, limit)
+        query = cls.query
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def iter_shopcarts(cls, batch_size=500):
+        """
+        Yields every Cart in the database ordered by id
+
+        Rows are read through a server side cursor batch_size at a time,
+        so memory use does not grow with the number of carts.
+        """
+        logger.info("Streaming all Cart in batches of %d", batch_size)
+        stmt = select(cls).order_by(cls.id).execution_options(yield_per=batch_size)
+        yield from db.session.scalars(stmt)
+
+    @classmethod
+    def read_shopcarts(cls, after_id=None, limit=None):
+        """ Same as all_shopcarts() but returns CartRecord tuples for read only use """
+        logger.info("Reading all Cart after id %s limit %s", after_id, limit)
+        stmt = select(cls.id, cls.customer_id)
+        if after_id is not None:
+            stmt = stmt.where(cls.id > after_id)
+        stmt = stmt.order_by(cls.id).limit(limit)
+        return [CartRecord._make(row) for row in db.session.execute(stmt)]
+
+
 class ShopCart(db.Model):
     """
-    Class that represents a ShopCart
+    Class that represents an item in the shopcart of a customer
     """
+    __tablename__ = "cart_item"
+
     app = None
     # Table Schema
-    id = db.Column(db.Integer, Identity(start=1, cycle=True), primary_key=True)
-    # Should add db.ForeignKey(customer.id) when integrate with Customer.
-    customer_id = db.Column(db.Integer, index=True)
+    id = db.Column(db.BigInteger, Identity(start=1), primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey("cart.customer_id", ondelete="CASCADE"), nullable=False)
     # Should add db.ForeignKey(product.id) when integrate with product.
-    product_id = db.Column(db.Integer)
-    quantities = db.Column(db.Integer)
+    product_id = db.Column(db.Integer, nullable=False)
+    quantities = db.Column(db.Integer, nullable=False)
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
     # price = db.Column(db.Numeric(10, 2))
 
+    # One row per (customer, product). The customer_id prefix also serves
+    # the find_by_customer_id lookups, so no separate customer_id index.
+    __table_args__ = (
+        db.Index("ix_cart_item_customer_product", "customer_id", "product_id", unique=True),
+        db.Index("ix_cart_item_customer_quantities", "customer_id", "quantities"),
+    )
+    # Every UPDATE and DELETE of the ORM checks version_id in its WHERE
+    # clause and bumps it, so a write based on a stale read raises
+    # StaleDataError instead of silently overwriting the other write.
+    __mapper_args__ = {"version_id_col": version_id}
+
     def __repr__(self):
         return f"<ShopCart customer_id=[{self.customer_id}] product_id=[{self.product_id}] quantities=[{self.quantities}]>"
 
@@ -49,6 +306,7 @@ class ShopCart(db.Model):
         # self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
         db.session.commit()
+        cart_cache.invalidate(self.customer_id)
 
     def update(self):
         """
@@ -58,18 +316,54 @@ class ShopCart(db.Model):
             raise DataValidationError("Don't exist current ShopCart record.")
         logger.info("Saving a ShopCart record for customer %d with product %d quantities %d",
                     self.customer_id, self.product_id, self.quantities)
-        db.session.commit()
+        # the customer may have been changed, drop the cache of both; read
+        # before the commit, a rollback expires them and the row may be gone
+        customer_ids = [self.customer_id, *inspect(self).attrs.customer_id.history.deleted]
+        try:
+            db.session.flush()
+            # keep what was written: the commit expires it, and another request
+            # may delete the row before the caller reads the item back
+            written = self.snapshot()
+            db.session.commit()
+            for key, value in written._asdict().items():
+                set_committed_value(self, key, value)
+        except StaleDataError:
+            # another request changed or deleted the row since it was read
+            db.session.rollback()
+            raise
+        finally:
+            for customer_id in customer_ids:
+                cart_cache.invalidate(customer_id)
 
     def delete(self):
         """ Removes a ShopCart from the data store """
         logger.info("Deleting a ShopCart record for customer %d with product %d quantities %d",
                     self.customer_id, self.product_id, self.quantities)
+        customer_id = self.customer_id
         db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise
+        finally:
+            cart_cache.invalidate(customer_id)
+
+    def snapshot(self):
+        """ Returns the columns of a ShopCart as a tuple for the cache """
+        return ItemRecord(self.id, self.customer_id, self.product_id, self.quantities, self.version_id)
+
+    @classmethod
+    def from_snapshot(cls, row):
+        """ Rebuilds a detached ShopCart from a cached tuple """
+        item = cls(id=row[0], customer_id=row[1], product_id=row[2], quantities=row[3], version_id=row[4])
+        make_transient_to_detached(item)
+        return item
 
     def serialize(self):
         """ Serializes a ShopCart into a dictionary """
-        return {"id": self.id, "customer_id": self.customer_id, "product_id": self.product_id, "quantities": self.quantities}
+        return {"id": self.id, "customer_id": self.customer_id, "product_id": self.product_id, "quantities": self.quantities,
+                "version_id": self.version_id}
 
     def deserialize(self, data):
         """
@@ -98,10 +392,24 @@ class ShopCart(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        # This is where we initialize SQLAlchemy from the Flask app, once,
+        # since Flask refuses new setup once the app has served a request
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
+        cart_cache.configure(app.config.get("CART_CACHE_SIZE", 0), app.config.get("CART_CACHE_TTL", 5.0),
+                             app.config.get("CART_CACHE_MAX_BYTES", 4 * 1024 * 1024))
+        replicas.configure(app.config.get("DATABASE_REPLICA_URIS", []),
+                           app.config.get("SQLALCHEMY_ENGINE_OPTIONS"))
+        # The app context below lives for the whole process, so end the
+        # session at the end of every request instead of with the context
+        if remove_session not in app.teardown_request_funcs.get(None, []):
+            app.teardown_request(remove_session)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        slow_query_log.configure(app.config.get("SLOW_QUERY_MS", 0), app.config.get("SLOW_QUERY_EXPLAIN", False),
+                                 app.config.get("SLOW_QUERY_MAX_PER_MINUTE", 60), app.config.get("SLOW_QUERY_REDACT", True),
+                                 engines=[db.engine, *replicas.engines])
+        if app.config.get("DB_AUTO_CREATE", True):
+            db.create_all()  # make our sqlalchemy tables, else "flask db-init" does
 
     @classmethod
     def all(cls):
@@ -117,16 +425,156 @@ class ShopCart(db.Model):
 
     @classmethod
     def find_by_customer_id(cls, customer_id):
-        """ Finds all ShopCart item entries by customer id """
+        """
+        Finds all ShopCart item entries by customer id
+
+        Results may come from the cart cache as detached copies, use
+        find_items() to get rows that will be modified.
+        """
+        hit, rows = cart_cache.get(customer_id, None)
+        if hit:
+            return [cls.from_snapshot(row) for row in rows]
         logger.info("Processing lookup for customer id %d ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id, cls.product_id != -1).all()
+        token = cart_cache.token()
+        items = cls.query.filter(cls.customer_id == customer_id).all()
+        cart_cache.put(customer_id, None, tuple(item.snapshot() for item in items), len(items), token)
+        return items
+
+    @classmethod
+    def find_items(cls, customer_id, quantities=None, min_q=None, max_q=None):
+        """
+        Finds the ShopCart items of a customer filtered by quantities
+
+        Args:
+            customer_id (int): the customer who owns the items
+            quantities (list): only return items with one of these quantities
+            min_q (int): only return items with at least this quantity
+            max_q (int): only return items with at most this quantity
+        """
+        logger.info("Processing filtered lookup for customer id %d ...", customer_id)
+        return cls.query.filter(*cls._item_filters(customer_id, quantities, min_q, max_q)).all()
+
+    @classmethod
+    def _item_filters(cls, customer_id, quantities, min_q, max_q):
+        """ Returns the WHERE clauses of find_items() and read_items() """
+        filters = [cls.customer_id == customer_id]
+        if quantities:
+            filters.append(cls.quantities.in_(quantities))
+        if min_q is not None and max_q is not None:
+            filters.append(cls.quantities.between(min_q, max_q))
+        elif min_q is not None:
+            filters.append(cls.quantities >= min_q)
+        elif max_q is not None:
+            filters.append(cls.quantities <= max_q)
+        return filters
+
+    @classmethod
+    def read_by_customer_id(cls, customer_id):
+        """
+        Same as find_by_customer_id() but returns ItemRecord tuples
+
+        Nothing is hydrated into ShopCart objects, neither on a cache hit
+        nor on a miss, so use it for responses that only read the items.
+        """
+        hit, rows = cart_cache.get(customer_id, None)
+        if hit:
+            return list(rows)
+        logger.info("Reading items of customer id %d ...", customer_id)
+        token = cart_cache.token()
+        items = cls._read(cls.customer_id == customer_id)
+        cart_cache.put(customer_id, None, tuple(items), len(items), token)
+        return items
+
+    @classmethod
+    def read_by_customer_ids(cls, customer_ids):
+        """
+        Reads the items of many customers, grouped by customer
+
+        Customers with cached items are answered from the cache, the others
+        are read with one query whose ids travel as a single array
+        parameter (cart.customer_id = ANY(:customer_ids)), so the statement
+        is the same whatever the number of ids.
+
+        Returns:
+            dict: customer_id -> list of ItemRecord, in the order of
+                  customer_ids, for the customers that have a cart
+        """
+        carts = {}
+        misses = []
+        for customer_id in customer_ids:
+            hit, rows = cart_cache.get(customer_id, None)
+            # items only exist in a cart, an empty hit does not tell whether there is one
+            if hit and rows:
+                carts[customer_id] = list(rows)
+            else:
+                misses.append(customer_id)
+        if misses:
+            logger.info("Reading items of %d customers ...", len(misses))
+            token = cart_cache.token()
+            stmt = (
+                select(Cart.customer_id, cls.id, cls.product_id, cls.quantities, cls.version_id)
+                .outerjoin(cls, cls.customer_id == Cart.customer_id)
+                .where(Cart.customer_id == any_(bindparam("customer_ids", misses, type_=ARRAY(Integer))))
+            )
+            found = {}
+            for customer_id, item_id, product_id, quantities, version_id in db.session.execute(stmt):
+                items = found.setdefault(customer_id, [])
+                if item_id is not None:
+                    items.append(ItemRecord(item_id, customer_id, product_id, quantities, version_id))
+            for customer_id, items in found.items():
+                cart_cache.put(customer_id, None, tuple(items), len(items), token)
+            carts.update(found)
+        return {customer_id: carts[customer_id] for customer_id in customer_ids if customer_id in carts}
 
     @classmethod
-    def find_by_customer_id_and_product_id(cls, customer_id, product_id):
-        """ Finds a ShopCart by customer id and product id """
+    def read_items(cls, customer_id, quantities=None, min_q=None, max_q=None):
+        """ Same as find_items() but returns ItemRecord tuples """
+        logger.info("Reading filtered items of customer id %d ...", customer_id)
+        return cls._read(*cls._item_filters(customer_id, quantities, min_q, max_q))
+
+    @classmethod
+    def _read(cls, *filters):
+        """ Runs a Core select() of the item columns and wraps the rows in ItemRecord """
+        stmt = select(cls.id, cls.customer_id, cls.product_id, cls.quantities, cls.version_id).where(*filters)
+        return [ItemRecord._make(row) for row in db.session.execute(stmt)]
+
+    @classmethod
+    def _columns(cls):
+        """ The item columns, in the order of ItemRecord """
+        table = cls.__table__
+        return (table.c.id, table.c.customer_id, table.c.product_id, table.c.quantities, table.c.version_id)
+
+    @classmethod
+    def _locked_items(cls, customer_id):
+        """ Reads the items of a customer with SELECT ... FOR UPDATE, on the primary, as ItemRecords """
+        stmt = select(*cls._columns()).where(cls.customer_id == customer_id).with_for_update()
+        return [ItemRecord._make(row) for row in db.session.execute(stmt)]
+
+    @classmethod
+    def find_by_customer_id_and_product_id(cls, customer_id, product_id, use_cache=True, for_update=False):
+        """
+        Finds a ShopCart by customer id and product id
+
+        A cached result is a detached copy, pass for_update=True when the
+        item is going to be updated or deleted: the row is then read with
+        SELECT ... FOR UPDATE, on the primary rather than on a replica that
+        may still have an older version_id, and stays locked until the commit.
+        """
+        use_cache = use_cache and not for_update
+        if use_cache:
+            hit, row = cart_cache.get(customer_id, product_id)
+            if hit:
+                return cls.from_snapshot(row) if row is not None else None
         logger.info(
             "Processing lookup for customer id %d and product id %d", customer_id, product_id)
-        return cls.query.filter(cls.customer_id == customer_id, cls.product_id == product_id).first()
+        token = cart_cache.token()
+        query = cls.query.filter(cls.customer_id == customer_id, cls.product_id == product_id)
+        if for_update:
+            query = query.with_for_update()
+        item = query.first()
+        if use_cache:
+            cart_cache.put(customer_id, product_id, item.snapshot() if item is not None else None, 1, token)
+        return item
 
     @classmethod
     def check_exist_by_customer_id_and_product_id(cls, customer_id, product_id):
@@ -136,19 +584,337 @@ class ShopCart(db.Model):
         return cls.query.filter(cls.customer_id == customer_id, cls.product_id == product_id).count() != 0
 
     @classmethod
-    def all_shopcarts(cls):
-        """ Returns all of the ShopCart in the database """
-        logger.info("Processing all unique ShopCart")
-        return cls.query.filter(cls.product_id == -1).all()
+    def add_item(cls, customer_id, product_id, quantities):
+        """
+        Adds an item to an existing shopcart in a single statement
+
+        The row is only inserted when the customer's cart exists and the
+        product is not in it yet, so concurrent adds cannot create duplicates.
+
+        Returns:
+            ShopCart: the inserted item, or None if nothing was inserted
+        """
+        logger.info("Adding product %d quantities %d to cart of customer %d",
+                    product_id, quantities, customer_id)
+        cart_exists = select(Cart.id).where(Cart.customer_id == customer_id).exists()
+        stmt = (
+            insert(cls)
+            .from_select(
+                ["customer_id", "product_id", "quantities"],
+                select(
+                    literal(customer_id, db.Integer),
+                    literal(product_id, db.Integer),
+                    literal(quantities, db.Integer),
+                ).where(cart_exists),
+            )
+            .on_conflict_do_nothing(index_elements=["customer_id", "product_id"])
+            .returning(cls)
+        )
+        item = db.session.scalars(stmt).first()
+        if item is not None:
+            # keep the RETURNING values loaded instead of expiring them on commit
+            db.session.expunge(item)
+        db.session.commit()
+        cart_cache.invalidate(customer_id)
+        return item
 
     @classmethod
-    def clear_cart(cls, customer_id, delete_cart=False):
-        """ Deletes a shopcart or clears a cart based on customer id """
+    def replace_items(cls, customer_id, items, expected_versions=None, check=None):
+        """
+        Replaces every item in a customer's shopcart in one transaction
+
+        The old items are removed with one DELETE and the new ones are
+        written with a single multi-row INSERT while the cart row is locked,
+        so a failure leaves the previous cart untouched. The DELETE returns the versions it removed,
+        a product that is written again continues from its old version.
+
+        Args:
+            customer_id (int): the customer whose cart is replaced
+            items (list): ShopCart records carrying product_id and quantities
+            expected_versions (dict): version_id the caller read, by product_id,
+                StaleDataError is raised if any of them changed since
+            check (callable): called with the ItemRecords of the old items, read
+                under the lock, before anything is written; raise to cancel
+
+        Returns:
+            list: the inserted ShopCart items
+
+        Raises:
+            DataValidationError: when the customer has no cart
+        """
+        logger.info("Replacing cart of customer %d with %d items", customer_id, len(items))
+        table = cls.__table__
+        try:
+            # lock the cart row before the items, in the order apply_batch() takes them,
+            # the INSERT would otherwise wait for it while holding the deleted rows
+            cart = db.session.execute(select(Cart.id).where(Cart.customer_id == customer_id).with_for_update()).first()
+            if cart is None:
+                # e.g. deleted since the route checked it, like the memory store
+                raise DataValidationError(f"Customer {customer_id} does not have a cart")
+            old_items = [ItemRecord._make(row) for row in db.session.execute(
+                table.delete().where(table.c.customer_id == customer_id).returning(*cls._columns())
+            )]
+            if check is not None:
+                check(old_items)
+            removed = {item.product_id: item.version_id for item in old_items}
+            for product_id, version_id in (expected_versions or {}).items():
+                if removed.get(product_id) != version_id:
+                    raise StaleDataError(f"Product {product_id} of customer {customer_id} was changed by another request")
+            rows = [
+                {"customer_id": customer_id, "product_id": item.product_id, "quantities": item.quantities,
+                 "version_id": removed.get(item.product_id, 0) + 1}
+                for item in items
+            ]
+            # a Core insert, the ORM one would start every version_id over at 1
+            stmt = insert(table).values(rows).returning(*cls._columns())
+            inserted = [cls.from_snapshot(ItemRecord._make(row)) for row in db.session.execute(stmt)] if rows else []
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cart_cache.invalidate(customer_id)
+        return inserted
+
+    @classmethod
+    def clear_cart(cls, customer_id, delete_cart=False, check=None):
+        """
+        Deletes a shopcart or clears a cart based on customer id
+
+        check, if given, is called with the ItemRecords of the cart, read
+        while the cart row is locked, before anything is deleted; raise
+        from it to keep the cart.
+        """
         logger.info(
             "Deleting [%s] cart for customer id %d ...", delete_cart, customer_id)
-        del_q = cls.__table__.delete().where(cls.customer_id == customer_id)
-        if not delete_cart:
-            del_q = cls.__table__.delete().where(
-                cls.customer_id == customer_id, cls.product_id != -1)
-        db.session.execute(del_q)
+        if delete_cart:
+            # the items of the cart go with it (ON DELETE CASCADE)
+            del_q = Cart.__table__.delete().where(Cart.customer_id == customer_id)
+        else:
+            del_q = cls.__table__.delete().where(cls.customer_id == customer_id)
+        try:
+            if check is not None:
+                db.session.execute(select(Cart.id).where(Cart.customer_id == customer_id).with_for_update())
+                check(cls._locked_items(customer_id))
+            db.session.execute(del_q)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cart_cache.invalidate(customer_id)
+
+    @classmethod
+    def increment(cls, customer_id, product_id, delta):
+        """
+        Adds delta to the quantities of an item in the database
+
+        The addition happens in a single UPDATE ... RETURNING, so concurrent
+        increments of the same item never lose one another. An item whose
+        quantities drop to zero or below is deleted in the same transaction,
+        while the UPDATE still holds its row lock.
+
+        Returns:
+            ItemRecord: the item after the change, its quantities are not
+            positive when it was deleted, or None when there is no such item
+        """
+        logger.info("Incrementing product id %d of customer id %d by %d", product_id, customer_id, delta)
+        table = cls.__table__
+        try:
+            stmt = table.update().where(
+                table.c.customer_id == customer_id, table.c.product_id == product_id
+            ).values(quantities=table.c.quantities + delta, version_id=table.c.version_id + 1).returning(
+                table.c.id, table.c.customer_id, table.c.product_id, table.c.quantities, table.c.version_id
+            )
+            row = db.session.execute(stmt).first()
+            item = ItemRecord._make(row) if row is not None else None
+            if item is not None and item.quantities <= 0:
+                db.session.execute(table.delete().where(table.c.id == item.id))
+            db.session.commit()
+        except DataError as error:
+            db.session.rollback()
+            raise DataValidationError(f"Quantities of product {product_id} would overflow") from error
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cart_cache.invalidate(customer_id)
+        return item
+
+    @classmethod
+    def set_quantities(cls, changes):
+        """
+        Sets the quantities of many items, of any customers, in one UPDATE
+
+        Args:
+            changes (dict): customer_id -> {product_id: quantities}
+
+        Returns:
+            int: the number of items that were found and updated
+        """
+        rows = [
+            (customer_id, product_id, quantities)
+            for customer_id, items in changes.items() for product_id, quantities in items.items()
+        ]
+        if not rows:
+            return 0
+        logger.info("Setting the quantities of %d items of %d customers", len(rows), len(changes))
+        table = cls.__table__
+        new = values(
+            column("customer_id", Integer), column("product_id", Integer), column("quantities", Integer), name="changes"
+        ).data(rows)
+        stmt = table.update().where(
+            table.c.customer_id == new.c.customer_id, table.c.product_id == new.c.product_id
+        ).values(quantities=new.c.quantities, version_id=table.c.version_id + 1)
+        try:
+            updated = db.session.execute(stmt).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            for customer_id in changes:
+                cart_cache.invalidate(customer_id)
+        return updated
+
+    @classmethod
+    def apply_batch(cls, customer_id, adds, sets, removes, check=None):
+        """
+        Adds, updates and removes items of a shopcart in one transaction
+
+        Every kind of change is a single statement, whatever the number of
+        items, and the cart row stays locked until the commit.
+
+        Args:
+            customer_id (int): the customer whose cart is changed
+            adds (dict): quantities of the products to add, by product_id
+            sets (dict): new quantities of existing products, by product_id
+            removes (list): product_ids to remove
+            check (callable): called with the ItemRecords of the cart, read
+                under the lock, before anything is written; raise to cancel
+
+        Returns:
+            dict: ItemRecords of the "added" and "updated" products by
+            product_id, and the set of "removed" product_ids, or None when
+            the customer has no cart
+        """
+        logger.info("Applying %d adds, %d updates and %d removes to cart of customer %d",
+                    len(adds), len(sets), len(removes), customer_id)
+        table = cls.__table__
+        columns = cls._columns()
+        result = {"added": {}, "updated": {}, "removed": set()}
+        try:
+            cart = select(Cart.id).where(Cart.customer_id == customer_id).with_for_update()
+            if db.session.execute(cart).scalar() is None:
+                db.session.rollback()
+                return None
+            if check is not None:
+                check(cls._locked_items(customer_id))
+            if removes:
+                stmt = table.delete().where(
+                    table.c.customer_id == customer_id, table.c.product_id.in_(removes)
+                ).returning(table.c.product_id)
+                result["removed"] = set(db.session.scalars(stmt))
+            if sets:
+                changes = values(
+                    column("product_id", Integer), column("quantities", Integer), name="changes"
+                ).data(list(sets.items()))
+                stmt = table.update().where(
+                    table.c.customer_id == customer_id, table.c.product_id == changes.c.product_id
+                ).values(quantities=changes.c.quantities, version_id=table.c.version_id + 1).returning(*columns)
+                result["updated"] = {row.product_id: ItemRecord._make(row) for row in db.session.execute(stmt)}
+            if adds:
+                rows = [
+                    {"customer_id": customer_id, "product_id": product_id, "quantities": quantities}
+                    for product_id, quantities in adds.items()
+                ]
+                stmt = insert(table).values(rows).on_conflict_do_nothing(
+                    index_elements=["customer_id", "product_id"]
+                ).returning(*columns)
+                result["added"] = {row.product_id: ItemRecord._make(row) for row in db.session.execute(stmt)}
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cart_cache.invalidate(customer_id)
+        return result
+
+
+######################################################################
+#  M I G R A T I O N   F R O M   T H E   S E N T I N E L   S C H E M A
+######################################################################
+
+# The old single table schema, where a row with product_id = -1 marked a
+# cart. Only the migration reads it, so it stays out of db.metadata.
+legacy_shop_cart = Table(
+    "shop_cart",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("customer_id", Integer),
+    Column("product_id", Integer),
+    Column("quantities", Integer),
+)
+
+
+def migrate_legacy_batch(after_id, batch_size):
+    """
+    Copies one batch of legacy shop_cart rows into cart and cart_item
+
+    Rows are read in id order after after_id and written in one short
+    transaction. Rows that were already copied are skipped, so a batch can
+    be run again safely. An item whose customer had no sentinel row gets a
+    cart, since the item cannot exist without one.
+
+    Returns:
+        tuple: the last legacy id of the batch (None when nothing is left)
+            and the number of legacy rows read
+    """
+    rows = db.session.execute(
+        select(legacy_shop_cart)
+        .where(legacy_shop_cart.c.id > after_id)
+        .order_by(legacy_shop_cart.c.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
         db.session.commit()
+        return None, 0
+
+    logger.info("Migrating %d legacy shop_cart rows after id %d", len(rows), after_id)
+    rows_with_customer = [row for row in rows if row.customer_id is not None]
+    customer_ids = sorted({row.customer_id for row in rows_with_customer})
+    if customer_ids:
+        db.session.execute(
+            insert(Cart.__table__)
+            .values([{"customer_id": customer_id} for customer_id in customer_ids])
+            .on_conflict_do_nothing(index_elements=["customer_id"])
+        )
+    items = [
+        {"customer_id": row.customer_id, "product_id": row.product_id, "quantities": row.quantities}
+        for row in rows_with_customer
+        if row.product_id is not None and row.product_id != -1 and row.quantities is not None
+    ]
+    if items:
+        db.session.execute(
+            insert(ShopCart.__table__)
+            .values(items)
+            .on_conflict_do_nothing(index_elements=["customer_id", "product_id"])
+        )
+    db.session.commit()
+    return rows[-1].id, len(rows)
+
+
+def add_version_column():
+    """
+    Adds the version_id column to a cart_item table created without it
+
+    Returns:
+        bool: True when the column was added, False when it was already there
+    """
+    table = ShopCart.__table__
+    if "version_id" in {column["name"] for column in inspect(db.engine).get_columns(table.name)}:
+        return False
+    logger.info("Adding version_id to %s", table.name)
+    db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN version_id INTEGER NOT NULL DEFAULT 1"))
+    db.session.commit()
+    return True
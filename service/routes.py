@@ -4,13 +4,17 @@ My Service
 Describe what your service does here
 """
 import sys
+import hashlib
 import secrets
 import logging
 from functools import wraps
-from flask import abort, jsonify, request, url_for, make_response, render_template
+from flask import abort, jsonify, request, url_for, make_response, render_template, stream_with_context
 from flask_restx import Resource, fields, reqparse, inputs
-from service.common import status  # HTTP Status Codes
-from service.models import ShopCart
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.http import quote_etag
+from service.common import marshallers, status  # HTTP Status Codes
+from service.models import DataValidationError, ShopCart, cart_cache
+from service.storage import get_store
 from . import app,api
 
 logger = logging.getLogger("flask.app")
@@ -31,6 +35,9 @@ shopcart_model = api.inherit(
     {
         'id': fields.String(readOnly=True,
                             description='The unique id assigned internally by service'),
+        'version_id': fields.Integer(required=False,
+                                     description='Changes with every write of the item, send it back '
+                                                 'to have the write rejected with 409 if the item changed since'),
     }
 )
 shopcart_list_model = api.model(
@@ -44,9 +51,50 @@ shopcart_list_model = api.model(
     }
 )
 
+# One entry of GET /api/shopcarts?customer_ids=...
+customer_shopcart_model = api.model('CustomerShopCart', {
+    'customer_id': fields.String(readOnly=True, description='The customer_id of the customer'),
+    'items': fields.List(fields.Nested(shopcart_model), description='The items in the shopcart of the customer'),
+})
+
+increment_model = api.model('ItemIncrement', {
+    'delta': fields.Integer(required=True, description='The amount to add to the quantities, negative to take away'),
+})
+
+BATCH_OPS = ('add', 'set', 'remove')
+item_operation_model = api.model('ItemOperation', {
+    'op': fields.String(required=True, enum=BATCH_OPS,
+                        description='add a product, set the quantities of a product in the cart, or remove it'),
+    'product_id': fields.Integer(required=True, description='The product_id of the item'),
+    'quantities': fields.Integer(required=False, description='The quantities for add and set'),
+})
+item_batch_model = api.model('ItemBatch', {
+    'operations': fields.List(fields.Nested(item_operation_model), required=True,
+                              description='The operations, applied in one transaction'),
+})
+item_operation_result_model = api.model('ItemOperationResult', {
+    'op': fields.String(description='The operation'),
+    'product_id': fields.Integer(description='The product_id of the item'),
+    'status': fields.Integer(description='The status code the single item route would have answered'),
+    'message': fields.String(description='Why the operation did nothing'),
+    'item': fields.Nested(shopcart_model, allow_null=True, description='The item after the operation'),
+})
+
+# Renders CartRecord, ItemRecord, ShopCart or serialize() dicts as shopcart_model
+render_shopcart = marshallers.compile_model(shopcart_model)
+
 # query string arguments
 shopcart_args = reqparse.RequestParser()
-shopcart_args.add_argument('customer_id', type=int, location='args', required=False, help='List shopcarts by customer_id')
+shopcart_args.add_argument('customer_ids', type=str, location='args', required=False,
+                           help='Comma separated customer ids, list the items of these customers instead')
+shopcart_args.add_argument('after_id', type=int, location='args', required=False,
+                           help='Only list shopcarts with an id greater than this one')
+shopcart_args.add_argument('limit', type=int, location='args', required=False,
+                           help='Maximum number of shopcarts to list')
+shopcart_args.add_argument('stream', type=inputs.boolean, location='args', required=False, default=False,
+                           help='Stream every shopcart as newline delimited JSON')
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
 
 
 MIN_INT_STRING = '0'
@@ -70,6 +118,24 @@ def health():
     return jsonify(dict(status="OK")), status.HTTP_200_OK
 
 
+@app.route("/health/pool")
+def health_pool():
+    """Database connection pool usage"""
+    return jsonify(get_store().pool_status()), status.HTTP_200_OK
+
+
+@app.route("/health/write-buffer")
+def health_write_buffer():
+    """Write-behind buffer counters, how many quantity updates were merged"""
+    return jsonify(get_store().buffer_stats()), status.HTTP_200_OK
+
+
+@app.route("/health/cache")
+def health_cache():
+    """Cart cache size and hit, miss and eviction counters"""
+    return jsonify(cart_cache.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 #  SHOPCART   A P I   E N D P O I N T S
 ######################################################################
@@ -84,23 +150,58 @@ class ShopcartCollection(Resource):
     # -----------------------------------------------------------
 
     @api.doc(' Returns list of all the shopcarts that are created by the customers')
-    @api.marshal_list_with(shopcart_model)
+    @api.expect(shopcart_args, validate=True)
+    @api.response(200, 'Success, the shopcarts. With customer_ids a list of CustomerShopCart, '
+                       'one per customer that has a shopcart, instead', [shopcart_model])
+    @api.response(400, 'The pagination arguments or the customer ids were not valid')
     def get(self):
         """
         Retrieve all shopcarts in DB
-        This endpoint will return all the shopcart
+        This endpoint will return the shopcarts one page at a time
         Args:
+            Query parameter: after_id: only return shopcarts with an id greater than this one
+                             limit: the maximum number of shopcarts to return
+                             stream: return every shopcart as newline delimited JSON
+                             customer_ids: return the items of these customers instead
         Returns:
-            list of all the shopcarts that are created by the customers.
+            list of the shopcarts that are created by the customers.
+            Header with a Link to the next page when there may be more shopcarts
+            With customer_ids, a list of customer_id and items, one per customer
+            that has a shopcart, in the order of the ids
         """
 
         app.logger.info("Request for all shopcart")
-        shopcarts = ShopCart.all_shopcarts()
-        results = [shopcart.serialize() for shopcart in shopcarts]
+        args = shopcart_args.parse_args()
+
+        if args["customer_ids"] is not None:
+            customer_ids = parse_customer_ids(args["customer_ids"])
+            carts = get_store().read_by_customer_ids(customer_ids)
+            app.logger.info("Returning the shopcarts of %d of %d customers", len(carts), len(customer_ids))
+            return [
+                {"customer_id": str(customer_id), "items": render_shopcart(items)}
+                for customer_id, items in carts.items()
+            ], status.HTTP_200_OK
+
+        if args["stream"] or request.accept_mimetypes.best == NDJSON_MIMETYPE:
+            return stream_shopcarts()
+
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["SHOPCART_PAGE_SIZE"]
+        if limit <= 0:
+            abort(status.HTTP_400_BAD_REQUEST, f"limit ({limit}) should be positive")
+        limit = min(limit, app.config["SHOPCART_MAX_PAGE_SIZE"])
+
+        shopcarts = get_store().read_shopcarts(after_id=args["after_id"], limit=limit)
+        results = [render_shopcart(shopcart) for shopcart in shopcarts]
         app.logger.info(
             "Returning %d shopcart ", len(results)
         )
-        return results, status.HTTP_200_OK
+        headers = {}
+        if len(shopcarts) == limit:
+            next_url = api.url_for(ShopcartCollection, after_id=shopcarts[-1].id, limit=limit, _external=True)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return results, status.HTTP_200_OK, headers
 
 
     # -----------------------------------------------------------
@@ -110,7 +211,7 @@ class ShopcartCollection(Resource):
     @api.response(400, 'The posted data was not valid')
     @api.response(409, 'The shopcart is already created for the given customer')
     @api.expect(shopcart_create_model)
-    @api.marshal_with(shopcart_model, code=201)
+    @marshallers.marshal_with(shopcart_model, code=201)
     def post(self):
         """Creates a new shopcart with customer id
         Args: None
@@ -130,22 +231,19 @@ class ShopcartCollection(Resource):
         customer_id = shopcart.customer_id
 
         app.logger.info(
-            f"Request to create a shopcart for customer {customer_id}")
+            "Request to create a shopcart for customer %s", customer_id)
 
         if customer_id is None or not str(customer_id).isdigit():
             abort(status.HTTP_400_BAD_REQUEST,
                 f"Bad request for {customer_id}")
 
         customer_id = int(customer_id)
-        if ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1):
-            logger.info(f"Customer {customer_id} shopcart already exists")
+        shopcart = get_store().create_for_customer(customer_id)
+        if shopcart is None:
+            logger.info("Customer %s shopcart already exists", customer_id)
             abort(status.HTTP_409_CONFLICT,
                 f"Customer {customer_id} shopcart already exists")
 
-        shopcart = ShopCart(customer_id=customer_id,
-                            product_id=-1, quantities=1)
-        shopcart.create()
-
         location_url = api.url_for(CustomerResource, customer_id=customer_id, _external=True)
         return shopcart.serialize(), status.HTTP_201_CREATED,{"Location": location_url}
        
@@ -157,8 +255,9 @@ class CustomerResource(Resource):
     # LIST ALL SHOPCARTS OF A CUSTOMER
     # -----------------------------------------------------------
     @api.doc("Retrieve all the shopcarts of a customer with customer_id as it's identifier")
+    @api.response(304, 'The cart matches the ETag in If-None-Match')
+    @api.response(200, 'Success', [shopcart_model])
     @api.response(404, 'Customer has not created shopcart yet')
-    @api.marshal_list_with(shopcart_model, code=201)
     def get(self,customer_id):
         """
         Retrieve all the shopcarts of a customer
@@ -174,31 +273,36 @@ class CustomerResource(Resource):
         app.logger.info(
             "Request for shopcarts of customer with id: %s", customer_id)
 
-        if not ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1):
-            logger.error(f"Customer {customer_id} does not have a cart")
+        items = get_store().read_by_customer_id(customer_id)
+        # An empty result is the only case that needs the cart probe
+        if not items and not get_store().check_exist_by_customer_id(customer_id):
+            logger.error("Customer %s does not have a cart", customer_id)
             abort(status.HTTP_404_NOT_FOUND,
                 f"Customer {customer_id} does not have a cart")
 
-        items = ShopCart.find_by_customer_id(customer_id)
-        results = [item.serialize() for item in items]
+        etag = cart_etag(items)
+        check_if_none_match(etag)
+
+        results = [render_shopcart(item) for item in items]
         app.logger.info(
             "Returning %d carts of customer %d", len(results),
             customer_id
         )
 
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
     # -----------------------------------------------------------
     # DELETE SHOPCART OF A CUSTOMER
     # -----------------------------------------------------------
     @api.doc('Delete the shopcart of a customer')
     @api.response(404, 'Customer has not created shopcart yet')
+    @api.response(412, 'The cart does not match the ETag in If-Match')
     def delete(self,customer_id):
         """
         Delete the shopcart of a customer
         """
         app.logger.info("delete shopcart of customer with id: %s", customer_id)
-        ShopCart.clear_cart(customer_id, delete_cart=True)
+        get_store().clear_cart(customer_id, delete_cart=True, check=if_match_check())
 
         return "", status.HTTP_204_NO_CONTENT
     
@@ -208,9 +312,11 @@ class CustomerResource(Resource):
     # -----------------------------------------------------------
     @api.doc("Updates shopcart with customer id with the query parameter 'update'=True and Clears shopcart with query parameter 'update'=False")
     @api.response(400, 'The customer has not created the shopcart')
-    @api.response(409, 'The customer_id provided in payload is not in sync with the one provided in the url requested')
+    @api.response(409, 'The customer_id provided in payload is not in sync with the one provided in the url requested, '
+                  'or an item was changed by another request since its version_id was read')
+    @api.response(412, 'The cart does not match the ETag in If-Match')
     @api.expect(shopcart_list_model)
-    @api.marshal_with(shopcart_model, code=200)
+    @marshallers.marshal_with(shopcart_model, code=200)
     def put(self, customer_id):
         """Updates shopcart with customer id with the query parameter 'update'=True
             and Clears shopcart with query parameter 'update'=False
@@ -219,9 +325,9 @@ class CustomerResource(Resource):
         Returns:
             dict: the row entry in database which contains shopcart_id, customer_id
         """
-        if not ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1):
+        if not get_store().check_exist_by_customer_id(customer_id):
             logger.info(
-                f"Customer {customer_id} has not created any shopcart")
+                "Customer %s has not created any shopcart", customer_id)
             abort(
                 status.HTTP_409_CONFLICT,
                 f"Customer {customer_id} has not created any shopcart"
@@ -240,70 +346,40 @@ class CustomerResource(Resource):
             Clear the shopcart of a customer
             """
             app.logger.info("clear shopcart of customer with id: %s", customer_id)
-            ShopCart.clear_cart(customer_id, delete_cart=False)
-            items = ShopCart.find_by_customer_id(customer_id)
-            logger.info(f"Cleared shopcart for customer {customer_id} sucessfully")
+            get_store().clear_cart(customer_id, delete_cart=False, check=if_match_check())
+            items = []
+            logger.info("Cleared shopcart for customer %s sucessfully", customer_id)
             results = [item.serialize() for item in items]
-            return results, status.HTTP_200_OK
+            return results, status.HTTP_200_OK, {"ETag": quote_etag(cart_etag(items))}
         else:       
             app.logger.info(
-            f"Request to update a shopcart for customer {customer_id}")
+            "Request to update a shopcart for customer %s", customer_id)
             check_content_type("application/json")
             data = request.get_json()
             if customer_id != int(data['customer_id']):
                 logger.info(
-                    f"Customer {customer_id} is not consistent with request")
+                    "Customer %s is not consistent with request", customer_id)
                 abort(
                     status.HTTP_409_CONFLICT,
                     f"Customer {customer_id} is not consistent with request"
                 )
-            ShopCart.clear_cart(customer_id, delete_cart=False)
             request_data = data['items']
             if request_data is None or len(request_data) == 0:
                 logger.info(
-                    f"No items are present in the request to update the shopcart of customer {customer_id}")
+                    "No items are present in the request to update the shopcart of customer %s", customer_id)
                 abort(
                     status.HTTP_400_BAD_REQUEST,
                     f"No items are present in the request to update the shopcart of customer {customer_id}"
                 )
-            product_id = set()
-            products = list()
-            for item in request_data:
-                shopcart_item = ShopCart()
-                shopcart_item.deserialize(item)
-                if shopcart_item.customer_id != customer_id:
-                    logger.info(
-                        f"Customer {customer_id} is not consistent with request")
-                    abort(
-                        status.HTTP_409_CONFLICT,
-                        f"Customer {customer_id} is not consistent with request"
-                    )
-                if shopcart_item.product_id in product_id:
-                    logger.info(
-                        f"Duplicate entries for {shopcart_item.product_id } in request body")
-                    abort(
-                        status.HTTP_400_BAD_REQUEST,
-                        f"Duplicate entries for {shopcart_item.product_id } in request body"
-                    )
-                elif int(shopcart_item.quantities)<=0:
-                    logger.info(
-                        f"Negative or Zero quantity of {shopcart_item.product_id } provided in request body")
-                    abort(
-                        status.HTTP_400_BAD_REQUEST,
-                        f"Negative or Zero quantity of {shopcart_item.product_id } provided in request body"
-                    )
-                else:    
-                    product_id.add(shopcart_item.product_id)
-                    products.append(shopcart_item)
-            for product in products:    
-                product.create()
-                logger.info(f"Added item {product.product_id} for customer {customer_id} sucessfully")
-
-            items = ShopCart.find_by_customer_id(customer_id)
-            
-            logger.info(f"Updated shopcart for customer {customer_id} sucessfully")
+            products, expected_versions = parse_cart_items(customer_id, request_data)
+
+            # Validate everything first, then swap the items in one transaction
+            items = get_store().replace_items(customer_id, products, expected_versions=expected_versions,
+                                              check=if_match_check())
+
+            logger.info("Updated shopcart for customer %s sucessfully", customer_id)
             results = [item.serialize() for item in items]
-            return results, status.HTTP_200_OK
+            return results, status.HTTP_200_OK, {"ETag": quote_etag(cart_etag(items))}
 
 # ######################################################################
 # #  ITEM   A P I   E N D P O I N T S
@@ -319,27 +395,32 @@ class ItemResource(Resource):
     @api.doc("Updates the quantity of an existing product of the customer shopcart with customer_id as it's identifier")
     @api.response(404, 'Bad Request: Cutomer as not created cart')
     @api.response(404, 'Bad Request: Quantity provided should be integer')
+    @api.response(409, 'The item was changed by another request since version_id was read')
+    @api.response(412, 'The item does not match the ETag in If-Match')
     @api.expect(shopcart_model)
-    @api.marshal_with(shopcart_model, code=200)
+    @marshallers.marshal_with(shopcart_model, code=200)
     def put(self, customer_id, product_id):
         """Updates the quantity of an existing product"""
         app.logger.info(
-            f"Update quantity of product-{product_id} in customer-{customer_id}'s cart")
+            "Update quantity of product-%s in customer-%s's cart", product_id, customer_id)
         check_content_type("application/json")
 
         product_id = int(product_id)
         customer_id = int(customer_id)
 
-        shopcart_item = ShopCart.find_by_customer_id_and_product_id(
-            customer_id, product_id)
+        shopcart_item = get_store().find_by_customer_id_and_product_id(
+            customer_id, product_id, for_update=True)
 
         if not shopcart_item:
             app.logger.error(
-                f"Product-{product_id} doesn't exist in customer-{customer_id}'s cart!")
+                "Product-%s doesn't exist in customer-%s's cart!", product_id, customer_id)
             abort(status.HTTP_404_NOT_FOUND,
                   f"Product-{product_id} doesn't exist in the customer-{customer_id}'s cart!")
+        check_if_match(cart_etag([shopcart_item]))
 
-        new_quantity = ShopCart().deserialize(request.get_json()).quantities
+        data = request.get_json()
+        new_quantity = ShopCart().deserialize(data).quantities
+        check_version(shopcart_item, data)
 
         if not new_quantity.lstrip('-').isdigit() or int(new_quantity) <= 0:
             app.logger.error("Quantity to be updated must be a valid number!")
@@ -347,31 +428,37 @@ class ItemResource(Resource):
                   f"Quantity to be updated [{new_quantity}] should be positive!")
 
         shopcart_item.quantities = int(new_quantity)
-        shopcart_item.update()
+        get_store().update_item(shopcart_item)
         app.logger.info(
-            f"Updated Product-{product_id} quantity to {new_quantity} in customer-{customer_id}'s cart!")
+            "Updated Product-%s quantity to %s in customer-%s's cart!", product_id, new_quantity, customer_id)
 
-        return shopcart_item.serialize(), status.HTTP_200_OK
+        return shopcart_item.serialize(), status.HTTP_200_OK, {"ETag": quote_etag(cart_etag([shopcart_item]))}
 
     # -----------------------------------------------------------
     # DELETE PRODUCT FROM CART
     # -----------------------------------------------------------
     @api.doc("Deletes an existing product from cart of the customer with customer_id as it's identifier")
-    @api.marshal_with(shopcart_model)
+    @api.response(412, 'The item does not match the ETag in If-Match')
+    @marshallers.marshal_with(shopcart_model)
     def delete(self, customer_id, product_id):
         """Deletes an existing product from cart"""
-        app.logger.info(f"Delete product-{product_id} in customer-{customer_id}'s")
+        app.logger.info("Delete product-%s in customer-%s's", product_id, customer_id)
 
         product_id = int(product_id)
         customer_id = int(customer_id)
 
-        shopcart_item = ShopCart.find_by_customer_id_and_product_id(
-            customer_id, product_id)
+        shopcart_item = get_store().find_by_customer_id_and_product_id(
+            customer_id, product_id, for_update=True)
 
+        if request.if_match and shopcart_item is None:
+            # no current representation, If-Match fails whatever it names (RFC 9110)
+            app.logger.warning("If-Match for Product-%s missing from customer-%s's cart", product_id, customer_id)
+            abort(status.HTTP_412_PRECONDITION_FAILED, f"Product-{product_id} is not in the customer-{customer_id}'s cart")
         if shopcart_item is not None:
-            shopcart_item.delete()
+            check_if_match(cart_etag([shopcart_item]))
+            get_store().delete_item(shopcart_item)
             app.logger.info(
-                f"Deleted Product-{product_id} in customer-{customer_id}'s cart!")
+                "Deleted Product-%s in customer-%s's cart!", product_id, customer_id)
 
         return "", status.HTTP_204_NO_CONTENT
 
@@ -379,29 +466,66 @@ class ItemResource(Resource):
     # READ AN ITEM FROM A SHOPCART
     # -----------------------------------------------------------
     @api.doc("Read an item from a shopcart of customer with customer_id as it's identifier")
+    @api.response(304, 'The item matches the ETag in If-None-Match')
     @api.response(404, 'Bad Request: Customer as not created cart')
-    @api.marshal_with(shopcart_model)
+    @marshallers.marshal_with(shopcart_model)
     def get(self,customer_id, product_id):
         """
         Read an item from a shopcart
         """
         app.logger.info(
-            f"Request to read an Item-{product_id} from Customer-{customer_id} 's shopcart")
+            "Request to read an Item-%s from Customer-%s 's shopcart", product_id, customer_id)
         # Read an item with item_id
         product_id = int(product_id)
         customer_id = int(customer_id)
-        result = ShopCart.find_by_customer_id_and_product_id(
+        result = get_store().find_by_customer_id_and_product_id(
             customer_id, product_id)
         if result is not None:
-            return result.serialize(), status.HTTP_200_OK
+            etag = cart_etag([result])
+            check_if_none_match(etag)
+            return result.serialize(), status.HTTP_200_OK, {"ETag": quote_etag(etag)}
         # See if the item exists and abort if it doesn't
         else:
             logger.error(
-                f"Customer {customer_id} and corresponding item {product_id} could not be found.")
+                "Customer %s and corresponding item %s could not be found.", customer_id, product_id)
             abort(status.HTTP_404_NOT_FOUND,
                   f"Customer {customer_id} and corresponding item {product_id} could not be found.")
             
 
+@api.route('/shopcarts/<int:customer_id>/items/<int:product_id>/increment')
+@api.param('customer_id', 'The Customer identifier')
+@api.param('product_id', 'The Product identifier')
+class ItemIncrementResource(Resource):
+    # -----------------------------------------------------------
+    # INCREMENT PRODUCT QUANTITY IN CART
+    # -----------------------------------------------------------
+    @api.doc("Adds delta to the quantity of a product of the customer shopcart in one atomic update")
+    @api.response(204, 'The quantity reached zero and the product was removed')
+    @api.response(400, 'Bad Request: delta should be a non zero integer')
+    @api.response(404, 'The product is not in the cart of the customer')
+    @api.expect(increment_model)
+    @marshallers.marshal_with(shopcart_model, code=200)
+    def post(self, customer_id, product_id):
+        """Adds delta to the quantity of a product, removes it when the quantity reaches zero"""
+        app.logger.info("Increment quantity of product-%s in customer-%s's cart", product_id, customer_id)
+        check_content_type("application/json")
+        data = request.get_json()
+        delta = as_int(data.get('delta')) if isinstance(data, dict) else None
+        if not delta or abs(delta) > int(MAX_INT_STRING):
+            abort(status.HTTP_400_BAD_REQUEST, "delta should be a non zero integer")
+
+        item = get_store().increment(customer_id, product_id, delta)
+        if item is None:
+            abort(status.HTTP_404_NOT_FOUND,
+                  f"Product-{product_id} doesn't exist in the customer-{customer_id}'s cart!")
+        if item.quantities <= 0:
+            app.logger.info("Removed Product-%s from customer-%s's cart", product_id, customer_id)
+            return "", status.HTTP_204_NO_CONTENT
+        app.logger.info("Incremented Product-%s quantity to %s in customer-%s's cart",
+                        product_id, item.quantities, customer_id)
+        return item._asdict(), status.HTTP_200_OK, {"ETag": quote_etag(cart_etag([item]))}
+
+
 @api.route('/shopcarts/<int:customer_id>/items')
 @api.param('customer_id', 'The Customer identifier') 
 class CustomerItemsCollection(Resource):
@@ -410,8 +534,9 @@ class CustomerItemsCollection(Resource):
     # LIST ALL ITEMS IN A SHOPCART
     # -----------------------------------------------------------
     @api.doc("Retrieve all the items in a customer's cart")
+    @api.response(304, 'The items match the ETag in If-None-Match')
+    @api.response(200, 'Success', [shopcart_model])
     @api.response(404, 'Bad Request: Customer as not created cart')
-    @api.marshal_list_with(shopcart_model)
     def get(self, customer_id):
         """
         Retrieve all the items in a customer's cart
@@ -430,18 +555,13 @@ class CustomerItemsCollection(Resource):
         app.logger.info(
             "Request for shopcart items of customer with id: %s", customer_id)
 
-        if not ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1):
-            logger.error(f"Customer {customer_id} does not have a cart")
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Customer {customer_id} does not have a cart")
-
         query_params = request.args.to_dict(flat=False)
         query_quantities = query_params.get('quantity')
         min_quantity = MIN_INT_STRING if (query_params.get('min_quantity') is None) else query_params.get('min_quantity')[0]
-        app.logger.info(f"{customer_id} cart requested min_quantity :: {min_quantity}!!")
 
         max_quantity = MAX_INT_STRING if (query_params.get('max_quantity') is None) else query_params.get('max_quantity')[0]
-        app.logger.info(f"{customer_id} cart requested max_quantity :: {max_quantity}!!")    
+        app.logger.debug("%s cart requested min_quantity :: %s max_quantity :: %s",
+                         customer_id, min_quantity, max_quantity)
 
         if query_quantities:
             for query_qty in query_quantities:
@@ -456,8 +576,6 @@ class CustomerItemsCollection(Resource):
         if not max_quantity.lstrip('-').isdigit():
             logger.error("Invalid value passed for max quantity in query parameters")
             abort(status.HTTP_400_BAD_REQUEST, f"Quantity: {max_quantity} is not a valid value")
-        results = ShopCart.find_by_customer_id(customer_id)
-        items = []
 
         min_quantity = int(min_quantity)
         max_quantity = int(max_quantity)
@@ -465,20 +583,27 @@ class CustomerItemsCollection(Resource):
             logger.error("min quantity > max quantity in query parameters")
             abort(status.HTTP_400_BAD_REQUEST, f"min_quantity({min_quantity}) > max_quantity({max_quantity})")
 
-        for record in results:
-            if query_quantities and record.quantities not in query_quantities:
-                continue
-            elif not query_quantities and (record.quantities < min_quantity or record.quantities > max_quantity):
-                app.logger.debug(f"ignoring {record.product_id} as {record.quantities} not in range [{min_quantity}, {max_quantity}]")
-                continue
-            items.append(record)
+        # An exact quantity filter takes precedence over the range
+        if query_quantities:
+            items = get_store().read_items(customer_id, quantities=query_quantities)
+        else:
+            items = get_store().read_items(customer_id, min_q=min_quantity, max_q=max_quantity)
 
-        results = [item.serialize() for item in items]
+        # An empty result is the only case that needs the cart probe
+        if not items and not get_store().check_exist_by_customer_id(customer_id):
+            logger.error("Customer %s does not have a cart", customer_id)
+            abort(status.HTTP_404_NOT_FOUND,
+                  f"Customer {customer_id} does not have a cart")
+
+        etag = cart_etag(items)
+        check_if_none_match(etag)
+
+        results = [render_shopcart(item) for item in items]
         app.logger.info(
             "Returning %d items of customer %d", len(items), customer_id
             )
 
-        return (results, status.HTTP_200_OK)
+        return (results, status.HTTP_200_OK, {"ETag": quote_etag(etag)})
     
     # # -----------------------------------------------------------
     # # Add an item to the cart
@@ -487,7 +612,7 @@ class CustomerItemsCollection(Resource):
     @api.response(400, 'Bad Request: inconsistent customer_id in request payload and url')
     @api.response(409, 'Conflict: product already present in the shopcart')
     @api.expect(shopcart_model)
-    @api.marshal_with(shopcart_model, code=201)
+    @marshallers.marshal_with(shopcart_model, code=201)
     def post(self, customer_id):
         """Creates a new entry and stores it in the database
         Args:
@@ -505,7 +630,7 @@ class CustomerItemsCollection(Resource):
         quantities = shopcart.quantities
 
         app.logger.info(
-            f"Request to add item for customer {customer_id} and item {item_id}")
+            "Request to add item for customer %s and item %s", customer_id, item_id)
 
         if (item_id is None or quantities is None or int(customer_id) != shopcart.customer_id):
             abort(
@@ -513,25 +638,286 @@ class CustomerItemsCollection(Resource):
                 f"Bad request for customer:{customer_id} & item:{item_id}"
             )
 
-        if (not ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1)):
-            logger.info(f"Customer {customer_id} does not have any cart")
-            abort(status.HTTP_409_CONFLICT, f"Customer {customer_id} does not have any cart")
+        shopcart = get_store().add_item(customer_id, item_id, quantities)
+        if shopcart is None:
+            # Nothing was inserted, only now work out which conflict it was
+            if not get_store().check_exist_by_customer_id(customer_id):
+                logger.info("Customer %s does not have any cart", customer_id)
+                abort(status.HTTP_409_CONFLICT, f"Customer {customer_id} does not have any cart")
 
-        if ShopCart.check_exist_by_customer_id_and_product_id(customer_id, item_id):
             logger.info(
-                f"Customer {customer_id} and corresponding item {item_id} already exists")
+                "Customer %s and corresponding item %s already exists", customer_id, item_id)
             abort(status.HTTP_409_CONFLICT,
                   f"Customer {customer_id} and corresponding item {item_id} already exists")
 
-        shopcart.create()
-        logger.info(f"Added item {item_id} for customer {customer_id} sucessfully")
+        logger.info("Added item %s for customer %s sucessfully", item_id, customer_id)
         return shopcart.serialize(), status.HTTP_201_CREATED
 
+    # -----------------------------------------------------------
+    # Change several items of the cart at once
+    # -----------------------------------------------------------
+    @api.doc("Add, update and remove several items of the shopcart of a customer in one transaction")
+    @api.response(400, 'Bad Request: an operation is not valid')
+    @api.response(404, 'Customer has not created shopcart yet')
+    @api.response(412, 'The cart does not match the ETag in If-Match')
+    @api.expect(item_batch_model)
+    @marshallers.marshal_with(item_operation_result_model, as_list=True)
+    def patch(self, customer_id):
+        """Applies a list of add, set and remove item operations in one transaction
+        Args:
+            customer_id (int): the id of the customer
+        Request Body: JSON with operations (list): op, product_id and quantities of each change
+        Returns:
+            list: one result per operation, in order, with the status code the
+                  single item route would have answered and the item
+        """
+        app.logger.info("Request to change items of customer %s", customer_id)
+        check_content_type("application/json")
+        operations = parse_operations(request.get_json())
+
+        adds, sets, removes = group_operations(operations)
+        result = get_store().apply_batch(customer_id, adds, sets, removes, check=if_match_check())
+        if result is None:
+            abort(status.HTTP_404_NOT_FOUND, f"Customer {customer_id} does not have a cart")
+
+        results = [operation_result(op, product_id, result) for op, product_id, _ in operations]
+        app.logger.info("Applied %d item operations for customer %s", len(results), customer_id)
+        return results, status.HTTP_200_OK
+
 
 ######################################################################
 #  UTILITY FUNCTIONS
 ######################################################################
 
+class NotModified(Exception):
+    """Raised when the client already holds the current version of a resource"""
+
+    def __init__(self, etag):
+        super().__init__("Not Modified")
+        self.etag = etag
+
+
+@api.errorhandler(NotModified)
+def not_modified(error):
+    """Answers 304 Not Modified, the body is dropped by werkzeug"""
+    return {}, status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(error.etag)}
+
+
+# flask-restx only hands exceptions to the app.errorhandler()s when
+# exceptions propagate, i.e. in testing, so the API maps these itself
+@api.errorhandler(StaleDataError)
+def version_conflict(error):
+    """Answers 409 when a write was based on a version_id that another request changed"""
+    message = str(error)
+    app.logger.warning(message)
+    return {"status": status.HTTP_409_CONFLICT, "error": "Conflict", "message": message}, status.HTTP_409_CONFLICT
+
+
+@api.errorhandler(DataValidationError)
+def data_validation_error(error):
+    """Answers 400 for data the models refuse"""
+    message = str(error)
+    app.logger.warning(message)
+    return {"status": status.HTTP_400_BAD_REQUEST, "error": "Bad Request", "message": message}, status.HTTP_400_BAD_REQUEST
+
+
+def cart_etag(items):
+    """Returns a strong ETag for a list of cart items
+
+    The tag is a hash of the id, customer_id, product_id, quantities and
+    version_id of every item, so any write to the items changes it
+    without keeping a counter.
+    """
+    rows = sorted(item.snapshot() for item in items)
+    return hashlib.blake2b(repr(rows).encode(), digest_size=16).hexdigest()
+
+
+def check_if_none_match(etag):
+    """Raises NotModified when If-None-Match already names this version"""
+    if request.if_none_match.contains_weak(etag):
+        raise NotModified(etag)
+
+
+def check_if_match(etag):
+    """Aborts with 412 when If-Match is given and does not name this version"""
+    if request.if_match and not request.if_match.contains(etag):
+        app.logger.warning("If-Match does not match the current ETag %s", etag)
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            "The resource has been modified since it was read",
+        )
+
+
+def if_match_check():
+    """Returns the If-Match check for a store write to run on the locked items, None without If-Match
+
+    Comparing the tag inside the write, once the cart is locked, keeps two
+    requests with the same If-Match from both passing before either writes.
+    """
+    if not request.if_match:
+        return None
+    return lambda items: check_if_match(cart_etag(items))
+
+
+def stream_shopcarts():
+    """Streams every shopcart as newline delimited JSON"""
+    batch_size = app.config["SHOPCART_STREAM_BATCH_SIZE"]
+
+    def generate():
+        for shopcart in get_store().iter_shopcarts(batch_size):
+            yield app.json.dumps(render_shopcart(shopcart.serialize())) + "\n"
+
+    return app.response_class(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def check_version(item, data):
+    """Rejects the write with 409 when data carries a version_id other than the one of the item"""
+    if data.get('version_id') is not None and parse_version(data['version_id']) != item.version_id:
+        raise StaleDataError(f"Product {item.product_id} of customer {item.customer_id} was changed by another request")
+
+
+def parse_version(value):
+    """Returns a version_id sent by a client, aborts with 400 when it is not an integer"""
+    version_id = as_int(value)
+    if version_id is None:
+        abort(status.HTTP_400_BAD_REQUEST, f"version_id should be an integer, got {value!r}")
+    return version_id
+
+
+def parse_customer_ids(value):
+    """Parses a comma separated list of customer ids, without duplicates"""
+    customer_ids = {}
+    for part in value.split(','):
+        customer_id = as_int(part.strip())
+        if customer_id is None or not 0 <= customer_id <= int(MAX_INT_STRING):
+            abort(status.HTTP_400_BAD_REQUEST, f"customer_ids should be comma separated integers, got {part!r}")
+        customer_ids[customer_id] = None
+    customer_ids = list(customer_ids)
+    max_ids = app.config["SHOPCART_MAX_BULK_IDS"]
+    if len(customer_ids) > max_ids:
+        abort(status.HTTP_400_BAD_REQUEST, f"At most {max_ids} customer_ids are allowed, got {len(customer_ids)}")
+    return customer_ids
+
+
+def parse_cart_items(customer_id, request_data):
+    """Validates the items of a cart update
+
+    Returns:
+        tuple: the ShopCart items to write, and the version_id each item
+               was read at, by product_id, for the items that sent one
+    """
+    product_id = set()
+    products = list()
+    expected_versions = {}
+    for item in request_data:
+        shopcart_item = ShopCart()
+        shopcart_item.deserialize(item)
+        if item.get('version_id') is not None:
+            expected_versions[shopcart_item.product_id] = parse_version(item['version_id'])
+        if shopcart_item.customer_id != customer_id:
+            logger.info(
+                "Customer %s is not consistent with request", customer_id)
+            abort(
+                status.HTTP_409_CONFLICT,
+                f"Customer {customer_id} is not consistent with request"
+            )
+        if shopcart_item.product_id in product_id:
+            logger.info(
+                "Duplicate entries for %s in request body", shopcart_item.product_id)
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Duplicate entries for {shopcart_item.product_id } in request body"
+            )
+        elif int(shopcart_item.quantities) <= 0:
+            logger.info(
+                "Negative or Zero quantity of %s provided in request body", shopcart_item.product_id)
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Negative or Zero quantity of {shopcart_item.product_id } provided in request body"
+            )
+        else:
+            product_id.add(shopcart_item.product_id)
+            products.append(shopcart_item)
+    return products, expected_versions
+
+
+def parse_operations(data):
+    """Validates the body of a batch of item operations
+
+    Returns:
+        list: (op, product_id, quantities) of every operation, quantities is
+              None for remove
+    """
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        abort(status.HTTP_400_BAD_REQUEST, "operations should be a non empty list")
+    max_ops = app.config["SHOPCART_MAX_BATCH_OPS"]
+    if len(operations) > max_ops:
+        abort(status.HTTP_400_BAD_REQUEST, f"At most {max_ops} operations are allowed, got {len(operations)}")
+
+    parsed = []
+    product_ids = set()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPS:
+            abort(status.HTTP_400_BAD_REQUEST, f"Operation {index}: op should be one of {', '.join(BATCH_OPS)}")
+        product_id = as_int(operation.get('product_id'))
+        if product_id is None:
+            abort(status.HTTP_400_BAD_REQUEST, f"Operation {index}: product_id should be an integer")
+        if product_id in product_ids:
+            abort(status.HTTP_400_BAD_REQUEST, f"Operation {index}: product {product_id} appears more than once")
+        product_ids.add(product_id)
+        quantities = None
+        if operation['op'] != 'remove':
+            quantities = as_int(operation.get('quantities'))
+            if quantities is None or quantities <= 0:
+                abort(status.HTTP_400_BAD_REQUEST, f"Operation {index}: quantities should be a positive integer")
+        parsed.append((operation['op'], product_id, quantities))
+    return parsed
+
+
+def group_operations(operations):
+    """Splits parsed operations into the adds, sets and removes of ShopCart.apply_batch()"""
+    adds, sets, removes = {}, {}, []
+    for op, product_id, quantities in operations:
+        if op == 'add':
+            adds[product_id] = quantities
+        elif op == 'set':
+            sets[product_id] = quantities
+        else:
+            removes.append(product_id)
+    return adds, sets, removes
+
+
+def operation_result(op, product_id, result):
+    """Returns the outcome of one operation with the status code the single item route would have answered"""
+    outcome = {'op': op, 'product_id': product_id, 'message': None, 'item': None}
+    if op == 'remove':
+        outcome['status'] = status.HTTP_204_NO_CONTENT
+        return outcome
+    item = result['added' if op == 'add' else 'updated'].get(product_id)
+    if item is not None:
+        outcome['status'] = status.HTTP_201_CREATED if op == 'add' else status.HTTP_200_OK
+        outcome['item'] = item._asdict()
+    elif op == 'add':
+        outcome['status'] = status.HTTP_409_CONFLICT
+        outcome['message'] = f"Product {product_id} is already in the cart"
+    else:
+        outcome['status'] = status.HTTP_404_NOT_FOUND
+        outcome['message'] = f"Product {product_id} is not in the cart"
+    return outcome
+
+
+def as_int(value):
+    """Returns an int or a string of digits as an int, anything else as None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        return int(value)
+    return None
+
+
 def check_content_type(content_type):
     """Checks that the media type is correct"""
     if "Content-Type" not in request.headers:
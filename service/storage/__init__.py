@@ -0,0 +1,42 @@
+"""
+Package: storage
+
+The routes keep carts in a CartStore, chosen with the CART_STORE setting
+"""
+from flask import current_app
+from service.storage.base import CartStore
+from service.storage.sql import SqlCartStore
+from service.storage.memory import MemoryCartStore
+from service.storage.buffered import WriteBehindCartStore
+
+STORES = {
+    SqlCartStore.name: SqlCartStore,
+    MemoryCartStore.name: MemoryCartStore,
+}
+
+
+def init_store(app):
+    """
+    Creates the CartStore named by CART_STORE and attaches it to the app
+
+    With WRITE_BEHIND_WINDOW_MS, quantity updates go through a
+    WriteBehindCartStore in front of it.
+    """
+    name = app.config.get("CART_STORE", SqlCartStore.name)
+    if name not in STORES:
+        raise ValueError(f"Unknown CART_STORE {name!r}, expected one of {', '.join(STORES)}")
+    store = STORES[name]()
+    window = app.config.get("WRITE_BEHIND_WINDOW_MS", 0)
+    if window > 0:
+        store = WriteBehindCartStore(store, window / 1000)
+    store.init_app(app)
+    app.extensions["cart_store"] = store
+    return store
+
+
+def get_store():
+    """ Returns the CartStore of the current app """
+    return current_app.extensions["cart_store"]
+
+
+__all__ = ["CartStore", "SqlCartStore", "MemoryCartStore", "WriteBehindCartStore", "STORES", "init_store", "get_store"]
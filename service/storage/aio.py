@@ -0,0 +1,149 @@
+"""
+Async Cart Readers
+
+The queries behind the polled GET routes for the ASGI app. They run on an
+async SQLAlchemy engine, so one worker can wait on many of them at once.
+"""
+import itertools
+import logging
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from service.models import Cart, ItemRecord, ShopCart, cart_cache, slow_query_log
+
+logger = logging.getLogger("flask.app")
+
+ITEM_COLUMNS = (ShopCart.id, ShopCart.customer_id, ShopCart.product_id, ShopCart.quantities, ShopCart.version_id)
+
+
+def async_uri(uri):
+    """ Returns the asyncpg flavour of a postgresql:// uri """
+    scheme, separator, rest = uri.partition("://")
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        scheme = "postgresql+asyncpg"
+    return scheme + separator + rest
+
+
+def async_engine_options(options, statement_timeout=0):
+    """ Adapts SQLALCHEMY_ENGINE_OPTIONS, whose connect_args are for psycopg2, to asyncpg """
+    options = {key: value for key, value in (options or {}).items() if key != "connect_args"}
+    if statement_timeout:
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(statement_timeout)}}
+    return options
+
+
+class AsyncSqlCartReader:
+    """ Reads carts from the database with asyncpg, through the cart cache """
+
+    def __init__(self):
+        self.engine = None
+        self.replicas = []
+        self._cycle = None
+
+    def connect(self, config):
+        """ Creates the engines of the primary and of the replicas """
+        options = async_engine_options(config.get("SQLALCHEMY_ENGINE_OPTIONS"), config.get("DB_STATEMENT_TIMEOUT", 0))
+        self.engine = create_async_engine(async_uri(config["SQLALCHEMY_DATABASE_URI"]), **options)
+        self.replicas = [
+            create_async_engine(async_uri(uri), **options) for uri in config.get("DATABASE_REPLICA_URIS", [])
+        ]
+        self._cycle = itertools.cycle(self.replicas) if self.replicas else None
+        slow_query_log.add_engines(engine.sync_engine for engine in [self.engine, *self.replicas])
+        logger.info("Async reads use %d replicas", len(self.replicas))
+
+    async def close(self):
+        """ Closes every connection of the engines """
+        for engine in [self.engine, *self.replicas]:
+            if engine is not None:
+                slow_query_log.remove_engines([engine.sync_engine])
+                await engine.dispose()
+
+    async def _fetch(self, stmt):
+        """ Runs a select on the next replica, or on the primary without replicas """
+        engine = next(self._cycle) if self._cycle else self.engine
+        async with engine.connect() as conn:
+            result = await conn.execute(stmt)
+            return result.all()
+
+    async def read_by_customer_id(self, customer_id):
+        """ Same as ShopCart.read_by_customer_id() """
+        hit, rows = cart_cache.get(customer_id, None)
+        if hit:
+            return list(rows)
+        token = cart_cache.token()
+        rows = await self._fetch(select(*ITEM_COLUMNS).where(ShopCart.customer_id == customer_id))
+        items = [ItemRecord._make(row) for row in rows]
+        cart_cache.put(customer_id, None, tuple(items), len(items), token)
+        return items
+
+    async def read_item(self, customer_id, product_id):
+        """ Same as ShopCart.find_by_customer_id_and_product_id() but returns an ItemRecord """
+        hit, row = cart_cache.get(customer_id, product_id)
+        if hit:
+            return row
+        token = cart_cache.token()
+        rows = await self._fetch(
+            select(*ITEM_COLUMNS).where(ShopCart.customer_id == customer_id, ShopCart.product_id == product_id)
+        )
+        item = ItemRecord._make(rows[0]) if rows else None
+        cart_cache.put(customer_id, product_id, item, 1, token)
+        return item
+
+    async def check_exist_by_customer_id(self, customer_id):
+        """ Same as Cart.check_exist_by_customer_id() """
+        rows = await self._fetch(select(Cart.id).where(Cart.customer_id == customer_id).limit(1))
+        return bool(rows)
+
+
+class InlineCartReader:
+    """ Async face of a CartStore that never blocks, such as the MemoryCartStore """
+
+    def __init__(self, store):
+        self.store = store
+
+    def connect(self, config):
+        """ Nothing to connect to """
+
+    async def close(self):
+        """ Nothing to close """
+
+    async def read_by_customer_id(self, customer_id):
+        """ Same as CartStore.read_by_customer_id() """
+        return self.store.read_by_customer_id(customer_id)
+
+    async def read_item(self, customer_id, product_id):
+        """ Same as CartStore.find_by_customer_id_and_product_id() but returns an ItemRecord """
+        item = self.store.find_by_customer_id_and_product_id(customer_id, product_id)
+        return item.snapshot() if item is not None else None
+
+    async def check_exist_by_customer_id(self, customer_id):
+        """ Same as CartStore.check_exist_by_customer_id() """
+        return self.store.check_exist_by_customer_id(customer_id)
+
+
+class BufferedCartReader:
+    """ Lays the unflushed updates of a WriteBehindCartStore over another reader """
+
+    def __init__(self, reader, store):
+        self.reader = reader
+        self.store = store
+
+    def connect(self, config):
+        """ Connects the reader underneath """
+        self.reader.connect(config)
+
+    async def close(self):
+        """ Closes the reader underneath """
+        await self.reader.close()
+
+    async def read_by_customer_id(self, customer_id):
+        """ Same as CartStore.read_by_customer_id() """
+        return self.store.overlay_records(customer_id, await self.reader.read_by_customer_id(customer_id))
+
+    async def read_item(self, customer_id, product_id):
+        """ Same as CartStore.find_by_customer_id_and_product_id() but returns an ItemRecord """
+        item = await self.reader.read_item(customer_id, product_id)
+        return self.store.overlay_records(customer_id, [item])[0] if item is not None else None
+
+    async def check_exist_by_customer_id(self, customer_id):
+        """ Same as CartStore.check_exist_by_customer_id() """
+        return await self.reader.check_exist_by_customer_id(customer_id)
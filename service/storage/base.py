@@ -0,0 +1,141 @@
+"""
+Cart Store interface
+
+Everything the routes need to read and write carts and their items
+"""
+from abc import ABC, abstractmethod
+
+
+class CartStore(ABC):
+    """
+    Persistence of carts and cart items
+
+    Carts are returned as Cart objects and items as ShopCart objects, which
+    only carry the data; writes always go through the store. The read_*
+    methods return CartRecord and ItemRecord tuples for responses that do
+    not modify anything. A store has to implement every abstract method,
+    one that misses any cannot be created.
+    """
+
+    name = None
+
+    @abstractmethod
+    def init_app(self, app):
+        """ Prepares the store for an app """
+
+    @abstractmethod
+    def pool_status(self):
+        """ Returns the connection usage of the store """
+
+    def buffer_stats(self):
+        """ Returns the counters of the write-behind buffer, see WriteBehindCartStore """
+        return {"enabled": False}
+
+    def close(self):
+        """ Writes out anything the store still holds, called at shutdown """
+
+    ######################################################################
+    #  C A R T S
+    ######################################################################
+
+    @abstractmethod
+    def create_for_customer(self, customer_id):
+        """ Creates the Cart of a customer, returns None if it already has one """
+
+    @abstractmethod
+    def check_exist_by_customer_id(self, customer_id):
+        """ Returns True if the customer has a Cart """
+
+    @abstractmethod
+    def all_shopcarts(self, after_id=None, limit=None):
+        """ Returns at most limit Carts with an id greater than after_id, ordered by id """
+
+    @abstractmethod
+    def read_shopcarts(self, after_id=None, limit=None):
+        """ Same as all_shopcarts() but returns read only CartRecord tuples """
+
+    @abstractmethod
+    def iter_shopcarts(self, batch_size=500):
+        """ Yields every Cart ordered by id, reading batch_size at a time """
+
+    @abstractmethod
+    def clear_cart(self, customer_id, delete_cart=False, check=None):
+        """
+        Removes the items of a customer, and the Cart too with delete_cart
+
+        The writes of clear_cart(), replace_items() and apply_batch() call
+        check, when given, with the ItemRecords of the cart as they are
+        once it is locked, before they change anything. An exception it
+        raises cancels the write, so a precondition such as If-Match holds
+        until the commit.
+        """
+
+    ######################################################################
+    #  I T E M S
+    ######################################################################
+
+    @abstractmethod
+    def find_by_customer_id(self, customer_id):
+        """ Returns all the items of a customer, possibly from a cache """
+
+    @abstractmethod
+    def find_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        """ Returns the items of a customer filtered by quantities """
+
+    @abstractmethod
+    def read_by_customer_id(self, customer_id):
+        """ Same as find_by_customer_id() but returns read only ItemRecord tuples """
+
+    @abstractmethod
+    def read_by_customer_ids(self, customer_ids):
+        """ Returns customer_id -> ItemRecord tuples for the customers that have a cart """
+
+    @abstractmethod
+    def read_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        """ Same as find_items() but returns read only ItemRecord tuples """
+
+    @abstractmethod
+    def find_by_customer_id_and_product_id(self, customer_id, product_id, use_cache=True, for_update=False):
+        """ Returns one item of a customer or None, for_update reads and locks it for a write """
+
+    @abstractmethod
+    def add_item(self, customer_id, product_id, quantities):
+        """ Adds an item to an existing cart, returns None if nothing was added """
+
+    @abstractmethod
+    def replace_items(self, customer_id, items, expected_versions=None, check=None):
+        """
+        Replaces every item of a customer at once, returns the new items
+
+        Raises StaleDataError when an item of expected_versions, a dict of
+        version_id by product_id, no longer has that version. check is
+        described in clear_cart().
+        """
+
+    @abstractmethod
+    def apply_batch(self, customer_id, adds, sets, removes, check=None):
+        """ Adds, updates and removes items at once, see ShopCart.apply_batch() """
+
+    @abstractmethod
+    def increment(self, customer_id, product_id, delta):
+        """ Adds delta to the quantities of an item atomically, see ShopCart.increment() """
+
+    @abstractmethod
+    def set_quantities(self, changes):
+        """
+        Sets the quantities of many existing items at once
+
+        Args:
+            changes (dict): customer_id -> {product_id: quantities}
+
+        Returns:
+            int: the number of items that were found and updated
+        """
+
+    @abstractmethod
+    def update_item(self, item):
+        """ Saves the quantities of an item read from the store, StaleDataError if it changed since """
+
+    @abstractmethod
+    def delete_item(self, item):
+        """ Removes an item read from the store, StaleDataError if it changed since """
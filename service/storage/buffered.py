@@ -0,0 +1,309 @@
+"""
+Write-Behind Cart Store
+
+Wraps another CartStore and holds back the quantity updates of
+update_item() for a short window. Updates of the same item inside the
+window are merged, and a background thread writes whatever is pending
+with one set_quantities() call, so a burst of +/- clicks costs one bulk
+UPDATE and one commit instead of one per click.
+
+The worker that buffered a write reads it back right away: the item and
+cart reads lay the pending quantities over what the store returns, and
+every other write to a customer first writes out the pending updates of
+that customer. Other workers see a buffered write once it is flushed.
+A buffered write is not checked against concurrent writes when it is
+flushed, the last one wins.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from flask import has_app_context
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import ShopCart
+from service.storage.base import CartStore
+
+logger = logging.getLogger("flask.app")
+
+# The store of init_app(), whose thread a forked child starts again
+_active = None
+
+
+class WriteBehindCartStore(CartStore):
+    """ CartStore that coalesces the quantity updates of another store """
+
+    def __init__(self, store, window=0.05):
+        self.store = store
+        self.name = store.name
+        self.window = window
+        self.app = None
+        self._pending = {}  # customer_id -> {product_id: [quantities, version_id once flushed]}
+        self._flushing = {}  # the batch being written, still visible to the reads
+        self._first_write = None
+        self._closed = False
+        self._cond = threading.Condition()
+        # taken around every write of the pending updates, so they reach
+        # the store in the order they were buffered
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed = 0
+
+    def init_app(self, app):
+        self.store.init_app(app)
+        self.app = app
+        self._start()
+        atexit.register(self.close)
+        global _active  # pylint: disable=global-statement
+        _active = self
+        logger.info("Buffering quantity updates for %d ms", self.window * 1000)
+
+    def pool_status(self):
+        return self.store.pool_status()
+
+    def buffer_stats(self):
+        with self._cond:
+            pending = sum(len(items) for items in self._pending.values())
+            return {
+                "enabled": True,
+                "window_ms": self.window * 1000,
+                "pending": pending,
+                "writes": self.writes,
+                "coalesced": self.coalesced,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "failed": self.failed,
+                # every buffered write would have been one commit
+                "commits_saved": max(self.writes - pending - self.failed - self.flushes, 0),
+            }
+
+    def close(self):
+        """ Stops the background thread once it wrote out everything pending """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    ######################################################################
+    #  B U F F E R
+    ######################################################################
+
+    def _start(self):
+        """ Starts the background thread """
+        self._thread = threading.Thread(target=self._run, name="cart-write-behind", daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """ Starts over in a forked child: the parent writes what it buffered, the child gets its own thread """
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._first_write = None
+        if not self._closed:
+            self._start()
+
+    def _run(self):
+        """ Writes out the pending updates window seconds after the first one """
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = self._first_write + self.window
+                while not self._closed and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+            self.flush()
+
+    def flush(self, customer_id=None):
+        """ Writes out the pending updates, of one customer or of everybody """
+        with self._write_lock:
+            with self._cond:
+                if customer_id is None:
+                    batch, self._pending = self._pending, {}
+                elif customer_id in self._pending:
+                    batch = {customer_id: self._pending.pop(customer_id)}
+                else:
+                    batch = {}
+                if not self._pending:
+                    self._first_write = None
+                self._flushing = batch
+            if batch:
+                self._write(batch)
+            with self._cond:
+                self._flushing = {}
+
+    def _write(self, batch):
+        """ Sets the quantities of a batch in the store """
+        changes = {
+            customer_id: {product_id: quantities for product_id, (quantities, _) in items.items()}
+            for customer_id, items in batch.items()
+        }
+        rows = sum(len(items) for items in changes.values())
+        try:
+            if has_app_context():
+                written = self.store.set_quantities(changes)
+            else:
+                with self.app.app_context():
+                    written = self.store.set_quantities(changes)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Lost %d buffered quantity updates", rows)
+            with self._cond:
+                self.failed += rows
+            return
+        with self._cond:
+            self.flushes += 1
+            self.rows_written += written
+        logger.debug("Wrote %d buffered quantity updates, %d items still existed", rows, written)
+
+    def _buffer(self, customer_id, product_id, quantities, version_id):
+        """ Holds back one quantity update, returns the version_id it will have once flushed """
+        with self._cond:
+            items = self._pending.setdefault(customer_id, {})
+            self.writes += 1
+            if product_id in items:
+                self.coalesced += 1
+                version_id = items[product_id][1]
+            else:
+                version_id += 1
+            items[product_id] = [quantities, version_id]
+            if self._first_write is None:
+                self._first_write = time.monotonic()
+                self._cond.notify_all()
+        return version_id
+
+    def _overlay(self, customer_id):
+        """ Returns the unflushed [quantities, version_id] of a customer by product_id """
+        with self._cond:
+            if customer_id not in self._pending and customer_id not in self._flushing:
+                return None
+            return {**self._flushing.get(customer_id, {}), **self._pending.get(customer_id, {})}
+
+    def overlay_records(self, customer_id, rows):
+        """ Lays the unflushed quantities of a customer over ItemRecords of the store """
+        pending = self._overlay(customer_id)
+        if not pending:
+            return rows
+        return [
+            row._replace(quantities=pending[row.product_id][0], version_id=pending[row.product_id][1])
+            if row.product_id in pending else row
+            for row in rows
+        ]
+
+    def _overlay_items(self, customer_id, items):
+        """ Same as overlay_records() for ShopCart objects, returns detached copies """
+        pending = self._overlay(customer_id)
+        if not pending:
+            return items
+        return [ShopCart.from_snapshot(row) for row in self.overlay_records(customer_id, [item.snapshot() for item in items])]
+
+    ######################################################################
+    #  C A R T S
+    ######################################################################
+
+    def create_for_customer(self, customer_id):
+        return self.store.create_for_customer(customer_id)
+
+    def check_exist_by_customer_id(self, customer_id):
+        return self.store.check_exist_by_customer_id(customer_id)
+
+    def all_shopcarts(self, after_id=None, limit=None):
+        return self.store.all_shopcarts(after_id=after_id, limit=limit)
+
+    def read_shopcarts(self, after_id=None, limit=None):
+        return self.store.read_shopcarts(after_id=after_id, limit=limit)
+
+    def iter_shopcarts(self, batch_size=500):
+        return self.store.iter_shopcarts(batch_size)
+
+    def clear_cart(self, customer_id, delete_cart=False, check=None):
+        self.flush(customer_id)
+        self.store.clear_cart(customer_id, delete_cart=delete_cart, check=check)
+
+    ######################################################################
+    #  I T E M S
+    ######################################################################
+
+    def find_by_customer_id(self, customer_id):
+        return self._overlay_items(customer_id, self.store.find_by_customer_id(customer_id))
+
+    def find_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        # the filters run in the store, on the flushed quantities
+        self.flush(customer_id)
+        return self.store.find_items(customer_id, quantities=quantities, min_q=min_q, max_q=max_q)
+
+    def read_by_customer_id(self, customer_id):
+        return self.overlay_records(customer_id, self.store.read_by_customer_id(customer_id))
+
+    def read_by_customer_ids(self, customer_ids):
+        carts = self.store.read_by_customer_ids(customer_ids)
+        return {customer_id: self.overlay_records(customer_id, rows) for customer_id, rows in carts.items()}
+
+    def read_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        self.flush(customer_id)
+        return self.store.read_items(customer_id, quantities=quantities, min_q=min_q, max_q=max_q)
+
+    def find_by_customer_id_and_product_id(self, customer_id, product_id, use_cache=True, for_update=False):
+        item = self.store.find_by_customer_id_and_product_id(customer_id, product_id, use_cache=use_cache,
+                                                             for_update=for_update)
+        if item is None:
+            return None
+        # always a detached copy, update_item() writes it through the buffer
+        return ShopCart.from_snapshot(self.overlay_records(customer_id, [item.snapshot()])[0])
+
+    def add_item(self, customer_id, product_id, quantities):
+        self.flush(customer_id)
+        return self.store.add_item(customer_id, product_id, quantities)
+
+    def replace_items(self, customer_id, items, expected_versions=None, check=None):
+        self.flush(customer_id)
+        return self.store.replace_items(customer_id, items, expected_versions=expected_versions, check=check)
+
+    def apply_batch(self, customer_id, adds, sets, removes, check=None):
+        self.flush(customer_id)
+        return self.store.apply_batch(customer_id, adds, sets, removes, check=check)
+
+    def increment(self, customer_id, product_id, delta):
+        self.flush(customer_id)
+        return self.store.increment(customer_id, product_id, delta)
+
+    def set_quantities(self, changes):
+        for customer_id in changes:
+            self.flush(customer_id)
+        return self.store.set_quantities(changes)
+
+    def update_item(self, item):
+        if self._closed:
+            self.store.set_quantities({item.customer_id: {item.product_id: item.quantities}})
+            item.version_id += 1
+            return item
+        item.version_id = self._buffer(item.customer_id, item.product_id, item.quantities, item.version_id)
+        return item
+
+    def delete_item(self, item):
+        self.flush(item.customer_id)
+        # the flush moved the version on, delete what the store has now
+        current = self.store.find_by_customer_id_and_product_id(item.customer_id, item.product_id, for_update=True)
+        if current is None or current.id != item.id:
+            return
+        if current.version_id != item.version_id:
+            raise StaleDataError(f"Product {item.product_id} of customer {item.customer_id} was changed by another request")
+        self.store.delete_item(current)
+
+
+def _after_fork():
+    """ Starts the thread of the active store in a forked child, e.g. a gunicorn --preload worker """
+    if _active is not None:
+        _active.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,226 @@
+"""
+Memory Cart Store
+
+Keeps the carts in plain dicts and a sorted list of cart ids, so the
+service runs without a database. Every worker has its own copy and
+nothing survives a restart; use it for local load tests and to measure
+the routes without the database.
+"""
+import itertools
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Cart, CartRecord, ItemRecord, ShopCart, DataValidationError
+from service.storage.base import CartStore
+
+logger = logging.getLogger("flask.app")
+
+# quantities is an INTEGER column in the SQL store
+MAX_QUANTITIES = 2**31 - 1
+
+
+class MemoryCartStore(CartStore):
+    """ CartStore held in process memory """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cart_ids = {}  # customer_id -> cart id
+        self._owners = {}  # cart id -> customer_id
+        self._order = []  # cart ids, sorted, for keyset pagination
+        self._items = {}  # customer_id -> {product_id: ItemRecord}
+        self._next_cart_id = itertools.count(1)
+        self._next_item_id = itertools.count(1)
+
+    def init_app(self, app):
+        logger.info("Keeping carts in memory, nothing is saved to the database")
+
+    def pool_status(self):
+        with self._lock:
+            return {"store": self.name, "carts": len(self._order)}
+
+    ######################################################################
+    #  C A R T S
+    ######################################################################
+
+    def create_for_customer(self, customer_id):
+        with self._lock:
+            if customer_id in self._cart_ids:
+                return None
+            cart_id = next(self._next_cart_id)
+            self._cart_ids[customer_id] = cart_id
+            self._owners[cart_id] = customer_id
+            # ids only grow, so appending keeps the list sorted
+            self._order.append(cart_id)
+            self._items[customer_id] = {}
+        return Cart(id=cart_id, customer_id=customer_id)
+
+    def check_exist_by_customer_id(self, customer_id):
+        return customer_id in self._cart_ids
+
+    def all_shopcarts(self, after_id=None, limit=None):
+        return [Cart(id=cart.id, customer_id=cart.customer_id) for cart in self.read_shopcarts(after_id, limit)]
+
+    def read_shopcarts(self, after_id=None, limit=None):
+        with self._lock:
+            start = bisect_right(self._order, after_id) if after_id is not None else 0
+            end = start + limit if limit is not None else len(self._order)
+            return [CartRecord(cart_id, self._owners[cart_id]) for cart_id in self._order[start:end]]
+
+    def iter_shopcarts(self, batch_size=500):
+        after_id = None
+        while True:
+            carts = self.all_shopcarts(after_id=after_id, limit=batch_size)
+            yield from carts
+            if len(carts) < batch_size:
+                return
+            after_id = carts[-1].id
+
+    def clear_cart(self, customer_id, delete_cart=False, check=None):
+        with self._lock:
+            if customer_id not in self._cart_ids:
+                return
+            if check is not None:
+                check(list(self._items[customer_id].values()))
+            if not delete_cart:
+                self._items[customer_id] = {}
+                return
+            cart_id = self._cart_ids.pop(customer_id)
+            del self._owners[cart_id]
+            del self._order[bisect_left(self._order, cart_id)]
+            del self._items[customer_id]
+
+    ######################################################################
+    #  I T E M S
+    ######################################################################
+
+    def find_by_customer_id(self, customer_id):
+        return [ShopCart.from_snapshot(row) for row in self.read_by_customer_id(customer_id)]
+
+    def find_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        return [ShopCart.from_snapshot(row) for row in self.read_items(customer_id, quantities, min_q, max_q)]
+
+    def read_by_customer_id(self, customer_id):
+        with self._lock:
+            return list(self._items.get(customer_id, {}).values())
+
+    def read_by_customer_ids(self, customer_ids):
+        with self._lock:
+            return {
+                customer_id: list(self._items.get(customer_id, {}).values())
+                for customer_id in customer_ids if customer_id in self._cart_ids
+            }
+
+    def read_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        rows = self.read_by_customer_id(customer_id)
+        if quantities:
+            wanted = set(quantities)
+            rows = [row for row in rows if row[3] in wanted]
+        if min_q is not None:
+            rows = [row for row in rows if row[3] >= min_q]
+        if max_q is not None:
+            rows = [row for row in rows if row[3] <= max_q]
+        return rows
+
+    def find_by_customer_id_and_product_id(self, customer_id, product_id, use_cache=True, for_update=False):
+        row = self._items.get(customer_id, {}).get(product_id)
+        return ShopCart.from_snapshot(row) if row is not None else None
+
+    def add_item(self, customer_id, product_id, quantities):
+        with self._lock:
+            items = self._items.get(customer_id)
+            if items is None or product_id in items:
+                return None
+            row = ItemRecord(next(self._next_item_id), customer_id, product_id, quantities, 1)
+            items[product_id] = row
+        return ShopCart.from_snapshot(row)
+
+    def replace_items(self, customer_id, items, expected_versions=None, check=None):
+        with self._lock:
+            if customer_id not in self._cart_ids:
+                raise DataValidationError(f"Customer {customer_id} does not have a cart")
+            if check is not None:
+                check(list(self._items[customer_id].values()))
+            removed = {row.product_id: row.version_id for row in self._items[customer_id].values()}
+            for product_id, version_id in (expected_versions or {}).items():
+                if removed.get(product_id) != version_id:
+                    raise StaleDataError(f"Product {product_id} of customer {customer_id} was changed by another request")
+            rows = {}
+            for item in items:
+                rows[item.product_id] = ItemRecord(next(self._next_item_id), customer_id, item.product_id, item.quantities,
+                                                   removed.get(item.product_id, 0) + 1)
+            self._items[customer_id] = rows
+        return [ShopCart.from_snapshot(row) for row in rows.values()]
+
+    def apply_batch(self, customer_id, adds, sets, removes, check=None):
+        result = {"added": {}, "updated": {}, "removed": set()}
+        with self._lock:
+            items = self._items.get(customer_id)
+            if items is None:
+                return None
+            if check is not None:
+                check(list(items.values()))
+            for product_id in removes:
+                if items.pop(product_id, None) is not None:
+                    result["removed"].add(product_id)
+            for product_id, quantities in sets.items():
+                if product_id in items:
+                    row = items[product_id]
+                    items[product_id] = result["updated"][product_id] = row._replace(
+                        quantities=quantities, version_id=row.version_id + 1)
+            for product_id, quantities in adds.items():
+                if product_id not in items:
+                    items[product_id] = result["added"][product_id] = ItemRecord(
+                        next(self._next_item_id), customer_id, product_id, quantities, 1)
+        return result
+
+    def increment(self, customer_id, product_id, delta):
+        with self._lock:
+            items = self._items.get(customer_id, {})
+            row = items.get(product_id)
+            if row is None:
+                return None
+            if row.quantities + delta > MAX_QUANTITIES:
+                raise DataValidationError(f"Quantities of product {product_id} would overflow")
+            row = row._replace(quantities=row.quantities + delta, version_id=row.version_id + 1)
+            if row.quantities > 0:
+                items[product_id] = row
+            else:
+                del items[product_id]
+        return row
+
+    def set_quantities(self, changes):
+        updated = 0
+        with self._lock:
+            for customer_id, quantities in changes.items():
+                items = self._items.get(customer_id, {})
+                for product_id, quantity in quantities.items():
+                    row = items.get(product_id)
+                    if row is not None:
+                        items[product_id] = row._replace(quantities=quantity, version_id=row.version_id + 1)
+                        updated += 1
+        return updated
+
+    def update_item(self, item):
+        with self._lock:
+            items = self._items.get(item.customer_id, {})
+            row = items.get(item.product_id)
+            if row is None or row[0] != item.id:
+                raise DataValidationError("Don't exist current ShopCart record.")
+            if row.version_id != item.version_id:
+                raise StaleDataError(
+                    f"Product {item.product_id} of customer {item.customer_id} was changed by another request")
+            item.version_id += 1
+            items[item.product_id] = item.snapshot()
+        return item
+
+    def delete_item(self, item):
+        with self._lock:
+            items = self._items.get(item.customer_id, {})
+            row = items.get(item.product_id)
+            if row is None or row[0] != item.id or row.version_id != item.version_id:
+                raise StaleDataError(
+                    f"Product {item.product_id} of customer {item.customer_id} was changed by another request")
+            del items[item.product_id]
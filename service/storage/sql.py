@@ -0,0 +1,79 @@
+"""
+SQL Cart Store
+
+Keeps the carts in the database through the SQLAlchemy models
+"""
+from service import models
+from service.models import Cart, ShopCart
+from service.storage.base import CartStore
+
+
+class SqlCartStore(CartStore):
+    """ CartStore backed by the Cart and ShopCart tables """
+
+    name = "sql"
+
+    def init_app(self, app):
+        models.init_db(app)
+
+    def pool_status(self):
+        return models.pool_status()
+
+    def create_for_customer(self, customer_id):
+        return Cart.create_for_customer(customer_id)
+
+    def check_exist_by_customer_id(self, customer_id):
+        return Cart.check_exist_by_customer_id(customer_id)
+
+    def all_shopcarts(self, after_id=None, limit=None):
+        return Cart.all_shopcarts(after_id=after_id, limit=limit)
+
+    def read_shopcarts(self, after_id=None, limit=None):
+        return Cart.read_shopcarts(after_id=after_id, limit=limit)
+
+    def iter_shopcarts(self, batch_size=500):
+        return Cart.iter_shopcarts(batch_size)
+
+    def clear_cart(self, customer_id, delete_cart=False, check=None):
+        ShopCart.clear_cart(customer_id, delete_cart=delete_cart, check=check)
+
+    def find_by_customer_id(self, customer_id):
+        return ShopCart.find_by_customer_id(customer_id)
+
+    def find_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        return ShopCart.find_items(customer_id, quantities=quantities, min_q=min_q, max_q=max_q)
+
+    def read_by_customer_id(self, customer_id):
+        return ShopCart.read_by_customer_id(customer_id)
+
+    def read_by_customer_ids(self, customer_ids):
+        return ShopCart.read_by_customer_ids(customer_ids)
+
+    def read_items(self, customer_id, quantities=None, min_q=None, max_q=None):
+        return ShopCart.read_items(customer_id, quantities=quantities, min_q=min_q, max_q=max_q)
+
+    def find_by_customer_id_and_product_id(self, customer_id, product_id, use_cache=True, for_update=False):
+        return ShopCart.find_by_customer_id_and_product_id(customer_id, product_id, use_cache=use_cache,
+                                                           for_update=for_update)
+
+    def add_item(self, customer_id, product_id, quantities):
+        return ShopCart.add_item(customer_id, product_id, quantities)
+
+    def replace_items(self, customer_id, items, expected_versions=None, check=None):
+        return ShopCart.replace_items(customer_id, items, expected_versions=expected_versions, check=check)
+
+    def apply_batch(self, customer_id, adds, sets, removes, check=None):
+        return ShopCart.apply_batch(customer_id, adds, sets, removes, check=check)
+
+    def increment(self, customer_id, product_id, delta):
+        return ShopCart.increment(customer_id, product_id, delta)
+
+    def set_quantities(self, changes):
+        return ShopCart.set_quantities(changes)
+
+    def update_item(self, item):
+        item.update()
+        return item
+
+    def delete_item(self, item):
+        item.delete()
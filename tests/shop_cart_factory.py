@@ -1,5 +1,12 @@
 import factory
-from service.models import ShopCart
+from service.models import Cart, ShopCart
+
+
+class CartsFactory(factory.Factory):
+    """Create fake cart records"""
+    class Meta:
+        model = Cart
+    customer_id = factory.Sequence(lambda n: n)
 
 
 class ShopCartsFactory(factory.Factory):
@@ -0,0 +1,155 @@
+"""
+Test cases for the ASGI app
+
+"""
+import unittest
+import httpx
+from flask import Flask
+from prometheus_client import REGISTRY
+from service import app
+from service.asgi import ShopcartASGI, create_app
+from service.common import status  # HTTP Status Codes
+from service.common.timing import init_timing
+from service.config import SQLALCHEMY_DATABASE_URI
+from service.models import db, Cart, ShopCart, slow_query_log
+from service.storage import MemoryCartStore
+from service.storage.aio import AsyncSqlCartReader, InlineCartReader, async_engine_options, async_uri
+
+CUSTOMER_ID = 1
+ITEM_ID = 1
+
+
+######################################################################
+#  A S G I   A P P   T E S T   C A S E S
+######################################################################
+class TestShopcartASGI(unittest.IsolatedAsyncioTestCase):
+    """ ASGI App Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
+        ShopCart.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        db.session.query(Cart).delete()
+        db.session.commit()
+        Cart(customer_id=CUSTOMER_ID).create()
+        ShopCart(customer_id=CUSTOMER_ID, product_id=ITEM_ID, quantities=2).create()
+        self.flask = app.test_client()
+
+    async def asyncSetUp(self):
+        """ This runs before each test, in the event loop """
+        self.asgi = create_app(app)
+        await self.asgi.startup()
+        self.client = httpx.AsyncClient(app=self.asgi, base_url="http://localhost")
+
+    async def asyncTearDown(self):
+        """ This runs after each test, in the event loop """
+        await self.client.aclose()
+        await self.asgi.shutdown()
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+
+    async def assert_same(self, method, url, **kwargs):
+        """ Checks that the ASGI app answers like the Flask app """
+        resp = await self.client.request(method, url, **kwargs)
+        expected = self.flask.open(url, method=method, **kwargs)
+        self.assertEqual(resp.status_code, expected.status_code)
+        self.assertEqual(resp.headers.get("ETag"), expected.headers.get("ETag"))
+        if expected.data:
+            self.assertEqual(resp.json(), expected.get_json())
+        return resp
+
+    async def test_read_routes(self):
+        """It should serve the read routes like the Flask app"""
+        self.assertIsInstance(self.asgi.reader, AsyncSqlCartReader)
+        for url in [f"/api/shopcarts/{CUSTOMER_ID}", f"/api/shopcarts/{CUSTOMER_ID}/items",
+                    f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", f"/api/shopcarts/{CUSTOMER_ID}/items?quantity=2"]:
+            resp = await self.assert_same("GET", url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            await self.assert_same("GET", url, headers={"If-None-Match": resp.headers["ETag"]})
+
+    async def test_fallback_routes(self):
+        """It should hand 404s, writes and the docs to the Flask app"""
+        await self.assert_same("GET", f"/api/shopcarts/{CUSTOMER_ID + 1}")
+        await self.assert_same("GET", f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID + 1}")
+        await self.assert_same("GET", f"/api/shopcarts/{CUSTOMER_ID}", headers={"X-Fields": "id"})
+        await self.assert_same("GET", "/api/swagger.json")
+        resp = await self.client.post(f"/api/shopcarts/{CUSTOMER_ID}/items",
+                                      json={"customer_id": CUSTOMER_ID, "product_id": 2, "quantities": 5})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = await self.client.get(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertEqual(len(resp.json()), 2)
+
+    async def test_accept_header(self):
+        """It should answer JSON whatever the Accept header, like flask-restx"""
+        await self.assert_same("GET", f"/api/shopcarts/{CUSTOMER_ID}", headers={"Accept": "text/csv"})
+
+    async def test_memory_store(self):
+        """It should read a memory store without a database"""
+        store = MemoryCartStore()
+        store.create_for_customer(CUSTOMER_ID)
+        store.add_item(CUSTOMER_ID, ITEM_ID, 3)
+        asgi = ShopcartASGI(app, InlineCartReader(store))
+        await asgi.startup()
+        async with httpx.AsyncClient(app=asgi, base_url="http://localhost") as client:
+            resp = await client.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+        await asgi.shutdown()
+        self.assertEqual(resp.json()["quantities"], 3)
+
+    async def test_metrics(self):
+        """It should count the requests it answers itself under the route template of Flask"""
+        labels = {"method": "GET", "route": "/api/shopcarts/<int:customer_id>/items/<int:product_id>", "status": "200"}
+        before = REGISTRY.get_sample_value("shopcart_http_requests_total", labels) or 0
+        resp = await self.client.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(REGISTRY.get_sample_value("shopcart_http_requests_total", labels), before + 1)
+
+    async def test_server_timing(self):
+        """It should time the requests it answers itself, with their async statements"""
+        timed = Flask(__name__)
+        timed.config["SERVER_TIMING"] = True
+        init_timing(timed)
+        self.asgi.server_timing = True
+        with self.assertLogs("flask.app", level="INFO") as logs:
+            resp = await self.client.get(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertRegex(resp.headers["Server-Timing"],
+                         r'^db;dur=[\d.]+;desc="[1-9]\d* queries", marshal;dur=[\d.]+, json;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertTrue(any(f"method=GET path=/api/shopcarts/{CUSTOMER_ID} status=200" in line for line in logs.output))
+
+    async def test_slow_query_caller(self):
+        """It should log the slow async statements with the route as the caller"""
+        slow_query_log.configure(0.000001)
+        asgi = create_app(app)
+        await asgi.startup()
+        try:
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                async with httpx.AsyncClient(app=asgi, base_url="http://localhost") as client:
+                    await client.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+        finally:
+            await asgi.reader.close()
+            slow_query_log.configure(0)
+        routes = [record.slow_query["route"] for record in logs.records if hasattr(record, "slow_query")]
+        self.assertIn("GET /api/shopcarts/<int:customer_id>/items/<int:product_id>", routes)
+
+
+class TestAsyncEngineOptions(unittest.TestCase):
+    """ Test Cases for the async engine settings """
+
+    def test_async_uri(self):
+        """It should switch postgresql uris to asyncpg"""
+        self.assertEqual(async_uri("postgresql://u:p@h:5432/db"), "postgresql+asyncpg://u:p@h:5432/db")
+        self.assertEqual(async_uri("postgres://h/db"), "postgresql+asyncpg://h/db")
+        self.assertEqual(async_uri("sqlite+aiosqlite:///x"), "sqlite+aiosqlite:///x")
+
+    def test_async_engine_options(self):
+        """It should pass the statement timeout as an asyncpg server setting"""
+        options = {"pool_size": 2, "connect_args": {"options": "-c statement_timeout=5"}}
+        self.assertEqual(async_engine_options(options), {"pool_size": 2})
+        self.assertEqual(async_engine_options(options, 5)["connect_args"],
+                         {"server_settings": {"statement_timeout": "5"}})
@@ -0,0 +1,91 @@
+"""
+Test cases for the Cart Cache
+
+"""
+import unittest
+from unittest.mock import patch
+from service.common.cache import CartCache, ROW_BYTES
+
+
+######################################################################
+#  C A R T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestCartCache(unittest.TestCase):
+    """ Test Cases for CartCache """
+
+    def test_disabled(self):
+        """It should not cache anything when disabled"""
+        cache = CartCache(max_customers=0)
+        cache.put(1, None, (), 0)
+        self.assertEqual(cache.get(1, None), (False, None))
+        self.assertFalse(cache.stats()["enabled"])
+
+    def test_hit_and_miss(self):
+        """It should count hits and misses"""
+        cache = CartCache(max_customers=10)
+        self.assertEqual(cache.get(1, None), (False, None))
+        cache.put(1, None, ((1, 1, 2, 3),), 1)
+        cache.put(1, 2, (1, 1, 2, 3), 1)
+        self.assertEqual(cache.get(1, None), (True, ((1, 1, 2, 3),)))
+        self.assertEqual(cache.get(1, 2), (True, (1, 1, 2, 3)))
+        self.assertEqual(cache.get(1, 3), (False, None))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["bytes"], 2 * ROW_BYTES)
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used customer"""
+        cache = CartCache(max_customers=2)
+        cache.put(1, None, (), 0)
+        cache.put(2, None, (), 0)
+        cache.get(1, None)
+        cache.put(3, None, (), 0)
+        self.assertTrue(cache.get(1, None)[0])
+        self.assertFalse(cache.get(2, None)[0])
+        self.assertTrue(cache.get(3, None)[0])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_memory_cap(self):
+        """It should evict customers to stay under the byte limit"""
+        cache = CartCache(max_customers=100, max_bytes=10 * ROW_BYTES)
+        cache.put(1, None, "six rows", 6)
+        cache.put(2, None, "six rows", 6)
+        self.assertFalse(cache.get(1, None)[0])
+        self.assertTrue(cache.get(2, None)[0])
+        cache.put(3, None, "too big", 11)
+        self.assertFalse(cache.get(3, None)[0])
+        self.assertLessEqual(cache.stats()["bytes"], 10 * ROW_BYTES)
+
+    def test_ttl(self):
+        """It should expire entries after the time to live"""
+        cache = CartCache(max_customers=10, ttl=5)
+        with patch("service.common.cache.time.monotonic", return_value=100.0):
+            cache.put(1, None, (), 0)
+        with patch("service.common.cache.time.monotonic", return_value=104.0):
+            self.assertTrue(cache.get(1, None)[0])
+        with patch("service.common.cache.time.monotonic", return_value=105.0):
+            self.assertFalse(cache.get(1, None)[0])
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_invalidate(self):
+        """It should drop every lookup of a customer"""
+        cache = CartCache(max_customers=10)
+        cache.put(1, None, (), 0)
+        cache.put(1, 2, None, 1)
+        cache.put(2, None, (), 0)
+        cache.invalidate(1)
+        self.assertFalse(cache.get(1, None)[0])
+        self.assertFalse(cache.get(1, 2)[0])
+        self.assertTrue(cache.get(2, None)[0])
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_stale_put_dropped(self):
+        """It should not cache a value read before an invalidation"""
+        cache = CartCache(max_customers=10)
+        token = cache.token()
+        cache.invalidate(1)
+        cache.put(1, None, (), 0, token)
+        self.assertFalse(cache.get(1, None)[0])
+        cache.put(1, None, (), 0, cache.token())
+        self.assertTrue(cache.get(1, None)[0])
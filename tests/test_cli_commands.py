@@ -5,7 +5,9 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import (
+    db_add_version_column, db_create, db_init, db_migrate_carts, startup_profile
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +23,66 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.migrate_legacy_batch')
+    @patch('service.common.cli_commands.inspect')
+    @patch('service.common.cli_commands.db')
+    def test_db_migrate_carts(self, db_mock, inspect_mock, batch_mock):
+        """It should copy the legacy rows batch by batch"""
+        inspect_mock.return_value.has_table.return_value = True
+        batch_mock.side_effect = [(10, 10), (15, 5), (None, 0)]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate_carts, ["--batch-size", "10"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("resume with --after-id 15", result.output)
+            self.assertIn("15 rows migrated", result.output)
+        batch_mock.assert_called_with(15, 10)
+        db_mock.create_all.assert_called_once()
+
+    @patch('service.common.cli_commands.migrate_legacy_batch')
+    @patch('service.common.cli_commands.inspect')
+    @patch('service.common.cli_commands.db')
+    def test_db_migrate_carts_no_legacy_table(self, db_mock, inspect_mock, batch_mock):
+        """It should do nothing without a legacy shop_cart table"""
+        inspect_mock.return_value.has_table.return_value = False
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_migrate_carts)
+            self.assertEqual(result.exit_code, 0)
+        batch_mock.assert_not_called()
+
+    @patch('service.common.cli_commands.add_version_column')
+    def test_db_add_version_column(self, add_mock):
+        """It should add the version_id column once"""
+        add_mock.side_effect = [True, False]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_add_version_column)
+            self.assertIn("Added cart_item.version_id", result.output)
+            result = self.runner.invoke(db_add_version_column)
+            self.assertIn("already exists", result.output)
+
+    @patch('service.common.cli_commands.add_version_column')
+    @patch('service.common.cli_commands.db')
+    def test_db_init(self, db_mock, add_mock):
+        """It should create the missing tables and columns"""
+        add_mock.return_value = False
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_init)
+        db_mock.create_all.assert_called_once()
+        add_mock.assert_called_once()
+        self.assertIn("Database is up to date", result.output)
+
+    @patch('service.common.cli_commands.startup.profile')
+    def test_startup_profile(self, profile_mock):
+        """It should print the init steps and the slowest imports"""
+        profile_mock.return_value = {
+            "total": 0.5,
+            "steps": {"init_logging": 0.001, "init_store": 0.02},
+            "imports": [("sqlalchemy", 0.29), ("flask", 0.1), ("json", 0.001)],
+        }
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(startup_profile, ["--top", "2"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("500.0 ms", result.output)
+        self.assertIn("init_store", result.output)
+        self.assertIn("sqlalchemy", result.output)
+        self.assertNotIn("json", result.output)
@@ -0,0 +1,45 @@
+"""
+Test cases for the JSON provider
+
+"""
+import datetime
+import decimal
+import unittest
+from unittest.mock import patch
+from service import app
+from service.common import json_provider
+from service.common.json_provider import OrjsonProvider
+
+
+class TestOrjsonProvider(unittest.TestCase):
+    """ Test Cases for OrjsonProvider """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.provider = OrjsonProvider(app)
+        self.data = {
+            "b": [1, 2.5, None, True],
+            "a": "café",
+            "price": decimal.Decimal("1.10"),
+            "when": datetime.date(2023, 3, 1),
+        }
+
+    def test_same_as_stdlib(self):
+        """It should decode to the same value as the stdlib provider"""
+        fast = self.provider.dumps(self.data)
+        with patch.object(json_provider, "orjson", None):
+            slow = self.provider.dumps(self.data)
+        self.assertEqual(self.provider.loads(fast), self.provider.loads(slow))
+        self.assertEqual(self.provider.loads(fast)["when"], "Wed, 01 Mar 2023 00:00:00 GMT")
+
+    def test_stdlib_arguments(self):
+        """It should use the stdlib encoder for arguments orjson does not support"""
+        self.assertEqual(self.provider.dumps([1], indent=4), "[\n    1\n]")
+        self.assertEqual(self.provider.dumps([1], indent=2), "[\n  1\n]")
+
+    def test_app_provider(self):
+        """It should be the JSON provider of the app"""
+        self.assertIsInstance(app.json, OrjsonProvider)
+        with app.test_request_context():
+            resp = app.json.response({"a": 1})
+        self.assertEqual(resp.get_json(), {"a": 1})
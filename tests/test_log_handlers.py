@@ -0,0 +1,151 @@
+"""
+Test cases for the log handlers
+
+"""
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from flask import Flask
+from service.common.log_handlers import JsonFormatter, LogQueueHandler, SamplingFilter, init_logging
+
+
+def make_record(msg, *args, level=logging.INFO, **extra):
+    """ A record of the flask.app logger """
+    record = logging.LogRecord("flask.app", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def make_app(stream, **config):
+    """ A Flask app whose gunicorn logger writes to stream """
+    gunicorn_logger = logging.getLogger(f"test.gunicorn.{id(stream)}")
+    gunicorn_logger.setLevel(logging.DEBUG)
+    gunicorn_logger.handlers = [logging.StreamHandler(stream)]
+    flask_app = Flask(__name__)
+    flask_app.config.update(config)
+    init_logging(flask_app, gunicorn_logger.name)
+    return flask_app
+
+
+class TestJsonFormatter(unittest.TestCase):
+    """ Test Cases for JsonFormatter """
+
+    def test_format(self):
+        """It should write the message and the extra fields as one JSON object"""
+        entry = json.loads(JsonFormatter().format(make_record("Returning %d items", 3, slow_query={"id": 1})))
+        self.assertEqual(entry["message"], "Returning 3 items")
+        self.assertEqual((entry["level"], entry["logger"]), ("INFO", "flask.app"))
+        self.assertEqual(entry["slow_query"], {"id": 1})
+        self.assertIn("time", entry)
+
+    def test_exception(self):
+        """It should add the traceback of an exception"""
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.LogRecord("flask.app", logging.ERROR, __file__, 1, "failed", None, True)
+            record.exc_info = sys.exc_info()
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertIn("ValueError: boom", entry["exception"])
+
+
+class TestSamplingFilter(unittest.TestCase):
+    """ Test Cases for SamplingFilter """
+
+    def test_sample(self):
+        """It should keep the share of a level and every record of the others"""
+        sampler = SamplingFilter({logging.INFO: 0.25, logging.DEBUG: 1.0})
+        kept = sum(sampler.filter(make_record("info")) for _ in range(100))
+        self.assertEqual(kept, 25)
+        self.assertEqual(sampler.sampled_out, 75)
+        self.assertTrue(all(sampler.filter(make_record("debug", level=logging.DEBUG)) for _ in range(10)))
+        self.assertTrue(all(sampler.filter(make_record("warning", level=logging.WARNING)) for _ in range(10)))
+
+
+class TestLogQueueHandler(unittest.TestCase):
+    """ Test Cases for LogQueueHandler """
+
+    def test_prepare(self):
+        """It should leave plain arguments for the background thread and format the others"""
+        handler = LogQueueHandler([])
+        record = handler.prepare(make_record("Customer %s has %d items", 7, 2))
+        self.assertEqual((record.msg, record.args), ("Customer %s has %d items", (7, 2)))
+        record = handler.prepare(make_record("Read %s", [1, 2]))
+        self.assertEqual((record.msg, record.args), ("Read [1, 2]", None))
+
+    def test_full_queue(self):
+        """It should drop the records a full queue has no room for"""
+        handler = LogQueueHandler([], maxsize=1)
+        for _ in range(3):
+            handler.handle(make_record("info"))
+        self.assertEqual(handler.dropped, 2)
+
+
+class TestInitLogging(unittest.TestCase):
+    """ Test Cases for init_logging """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.flask_logger = logging.getLogger("flask.app")
+        self.saved = (self.flask_logger.handlers, self.flask_logger.propagate, self.flask_logger.level)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.flask_logger.handlers, self.flask_logger.propagate, level = self.saved
+        self.flask_logger.setLevel(level)
+
+    def stop(self, flask_app):
+        """ Writes out the queued records """
+        for handler in flask_app.logger.handlers:
+            handler.stop()
+
+    def test_json(self):
+        """It should write the records as JSON lines from the background thread"""
+        stream = io.StringIO()
+        flask_app = make_app(stream)
+        self.assertIsInstance(flask_app.logger.handlers[0], LogQueueHandler)
+        flask_app.logger.info("Returning %d items of customer %d", 2, 7)
+        self.flask_logger.debug("Reading items of customer id %d ...", 7)
+        self.stop(flask_app)
+        messages = [json.loads(line)["message"] for line in stream.getvalue().splitlines()]
+        self.assertEqual(messages, ["Logging handler established", "Returning 2 items of customer 7",
+                                    "Reading items of customer id 7 ..."])
+
+    def test_text_and_sampling(self):
+        """It should write text lines and sample the info records"""
+        stream = io.StringIO()
+        flask_app = make_app(stream, LOG_FORMAT="text", LOG_SAMPLE_INFO=0.5)
+        for index in range(10):
+            flask_app.logger.info("info %d", index)
+        flask_app.logger.warning("warning")
+        self.stop(flask_app)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len([line for line in lines if "] info " in line]), 5)
+        self.assertRegex(lines[-1], r"^\[.*\] \[WARNING\] \[test_log_handlers\] warning$")
+
+    def test_no_handlers(self):
+        """It should not start a thread when there is nothing to write to"""
+        flask_app = Flask(__name__)
+        init_logging(flask_app, "test.gunicorn.none")
+        self.assertEqual(flask_app.logger.handlers, [])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_fork(self):
+        """It should write the records of a forked child with its own thread"""
+        with tempfile.TemporaryFile("w+") as stream:
+            flask_app = make_app(stream)
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                flask_app.logger.info("from the child")
+                self.stop(flask_app)
+                stream.flush()
+                os._exit(0)  # pylint: disable=protected-access
+            os.waitpid(pid, 0)
+            self.stop(flask_app)
+            stream.seek(0)
+            messages = [json.loads(line)["message"] for line in stream.read().splitlines()]
+        self.assertIn("from the child", messages)
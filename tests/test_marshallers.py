@@ -0,0 +1,46 @@
+"""
+Test cases for the compiled marshallers
+
+"""
+import unittest
+from flask_restx import Model, fields, marshal
+from service.common.marshallers import compile_model
+from service.models import CartRecord, ItemRecord, ShopCart
+from service.routes import shopcart_model
+
+nested_model = Model("Nested", {
+    "name": fields.String(attribute="label"),
+    "price": fields.Float,
+    "count": fields.Integer(default=0),
+    "active": fields.Boolean,
+    "tags": fields.List(fields.String),
+})
+
+
+class TestCompiledModel(unittest.TestCase):
+    """ Test Cases for compile_model """
+
+    def test_shopcart_model(self):
+        """It should render records, objects and dicts like marshal()"""
+        render = compile_model(shopcart_model)
+        item = ShopCart(id=7, customer_id=1, product_id=2, quantities=3, version_id=1)
+        expected = marshal(item.serialize(), shopcart_model)
+        self.assertEqual(render(item), expected)
+        self.assertEqual(render(item.serialize()), expected)
+        self.assertEqual(render(ItemRecord(7, 1, 2, 3, 1)), expected)
+        self.assertEqual(render([ItemRecord(7, 1, 2, 3, 1)]), [expected])
+        self.assertEqual(render(CartRecord(5, 1)),
+                         {"customer_id": 1, "product_id": -1, "quantities": 1, "id": "5", "version_id": None})
+
+    def test_missing_values(self):
+        """It should render missing values as None like marshal()"""
+        render = compile_model(shopcart_model)
+        self.assertEqual(render({}), marshal({}, shopcart_model))
+        self.assertEqual(render(""), marshal("", shopcart_model))
+
+    def test_other_fields(self):
+        """It should fall back to the field for attributes, defaults and other types"""
+        render = compile_model(nested_model)
+        data = {"label": "pen", "price": "1.5", "active": 1, "tags": ["a", 2]}
+        self.assertEqual(render(data), marshal(data, nested_model))
+        self.assertEqual(render(data)["count"], 0)
@@ -0,0 +1,102 @@
+"""
+Test cases for the Prometheus metrics
+
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from prometheus_client import CollectorRegistry, multiprocess
+from prometheus_client.parser import text_string_to_metric_families
+from service import app
+from service.common import status  # HTTP Status Codes
+from service.config import SQLALCHEMY_DATABASE_URI
+from service.models import ShopCart
+
+# What one gunicorn worker does: serve a request and exit
+WORKER = """
+from service import app
+app.test_client().get("/health")
+"""
+
+# What "flask db-init" does: run SQL outside gunicorn, which made the directory
+COMMAND = """
+from sqlalchemy import text
+from service import app
+from service.models import db
+db.session.execute(text("SELECT 1"))
+"""
+
+
+def samples(text):
+    """ The samples of a /metrics page by name and labels """
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(text) for sample in family.samples
+    }
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for /metrics """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
+        ShopCart.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.client = app.test_client()
+
+    def get_samples(self):
+        """ Scrapes /metrics """
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain; version=0.0.4"))
+        return samples(resp.get_data(as_text=True))
+
+    def test_requests(self):
+        """It should count the requests of a route template by status and time them"""
+        route = (("method", "GET"), ("route", "/api/shopcarts/<int:customer_id>"))
+        before = self.get_samples()
+        self.client.get("/api/shopcarts/987123001")
+        self.client.get("/api/shopcarts/987123002")
+        after = self.get_samples()
+        total = ("shopcart_http_requests_total", route + (("status", "404"),))
+        count = ("shopcart_http_request_duration_seconds_count", route)
+        self.assertEqual(after[total] - before.get(total, 0), 2)
+        self.assertEqual(after[count] - before.get(count, 0), 2)
+        query = ("shopcart_db_query_duration_seconds_count", (("statement", "SELECT"),))
+        self.assertGreater(after[query], before.get(query, 0))
+
+    def test_gauges(self):
+        """It should export the connection pool and the cart cache"""
+        metrics = self.get_samples()
+        self.assertIn(("shopcart_db_pool_connections", (("engine", "primary"), ("state", "checked_out"))), metrics)
+        self.assertIn(("shopcart_cart_cache", (("stat", "hits"),)), metrics)
+
+    def test_multiprocess(self):
+        """It should add up the requests of every worker in the shared directory"""
+        with tempfile.TemporaryDirectory() as path:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path, CART_STORE="memory")
+            for _ in range(2):
+                subprocess.run([sys.executable, "-c", WORKER], env=env, check=True, capture_output=True)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=path)
+            self.assertEqual(registry.get_sample_value(
+                "shopcart_http_requests_total", {"method": "GET", "route": "/health", "status": "200"}), 2)
+
+    def test_missing_directory(self):
+        """It should create a missing shared directory instead of failing on the first statement"""
+        with tempfile.TemporaryDirectory() as parent:
+            path = os.path.join(parent, "metrics")
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path)
+            result = subprocess.run([sys.executable, "-c", COMMAND], env=env, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=path)
+            self.assertTrue(registry.get_sample_value("shopcart_db_query_duration_seconds_count",
+                                                      {"statement": "SELECT"}))
@@ -3,10 +3,18 @@ Test cases for ShopCart Model
 
 """
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from sqlalchemy import event
 from service import app
 from service.config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_TRACK_MODIFICATIONS
-from service.models import ShopCart, DataValidationError, db
-from .shop_cart_factory import ShopCartsFactory
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import (
+    Cart, CartRecord, ItemRecord, ShopCart, DataValidationError, db, cart_cache, legacy_shop_cart, migrate_legacy_batch,
+    pool_status, replicas
+)
+from .shop_cart_factory import CartsFactory, ShopCartsFactory
 
 
 ######################################################################
@@ -39,6 +47,13 @@ class TestShopCartsModel(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
+    def _create_items(self, *shop_carts):
+        """ Creates the carts the items belong to, then the items """
+        for shop_cart in shop_carts:
+            if not Cart.check_exist_by_customer_id(shop_cart.customer_id):
+                Cart(customer_id=shop_cart.customer_id).create()
+            shop_cart.create()
+
     ######################################################################
     #  T E S T   C A S E S
     ######################################################################
@@ -48,6 +63,7 @@ class TestShopCartsModel(unittest.TestCase):
     #     self.assertTrue(True)
     def test_create_shopcarts(self):
         """Test create shopcarts record"""
+        Cart(customer_id=1).create()
         shop_cart = ShopCart(customer_id=1, product_id=1, quantities=1)
         shop_cart.create()
         self.assertNotEqual(shop_cart, None)
@@ -58,6 +74,7 @@ class TestShopCartsModel(unittest.TestCase):
 
     def test__repr__(self):
         """test shopcart __repr__"""
+        Cart(customer_id=1).create()
         shop_cart = ShopCart(customer_id=1, product_id=1, quantities=1)
         shop_cart.create()
         self.assertEqual(repr(shop_cart),
@@ -68,9 +85,7 @@ class TestShopCartsModel(unittest.TestCase):
         shop_cart1 = ShopCartsFactory()
         shop_cart2 = ShopCartsFactory()
         shop_cart3 = ShopCartsFactory()
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        self._create_items(shop_cart1, shop_cart2, shop_cart3)
         uid = shop_cart2.id
         shop_cart = ShopCart.find(uid)
         self.assertEqual(shop_cart2.id, shop_cart.id)
@@ -80,8 +95,9 @@ class TestShopCartsModel(unittest.TestCase):
     def test_update_shopcarts(self):
         """Test update shopcarts record"""
         shop_cart = ShopCartsFactory()
-        shop_cart.create()
+        self._create_items(shop_cart)
 
+        Cart(customer_id=15).create()
         shop_cart = ShopCart.find(shop_cart.id)
         shop_cart.customer_id = 15
         shop_cart.product_id = 15
@@ -103,7 +119,7 @@ class TestShopCartsModel(unittest.TestCase):
     def test_delete_shopcarts(self):
         """Test delete shopcarts record by its id"""
         shop_cart = ShopCartsFactory()
-        shop_cart.create()
+        self._create_items(shop_cart)
         uid = shop_cart.id
         shop_cart.delete()
 
@@ -112,6 +128,7 @@ class TestShopCartsModel(unittest.TestCase):
 
     def test_serialize_shopcarts(self):
         """Test serialize shopcarts record"""
+        Cart(customer_id=1).create()
         shop_cart = ShopCart(customer_id=1, product_id=1, quantities=1)
         shop_cart.create()
         shop_cart_dict = shop_cart.serialize()
@@ -150,9 +167,7 @@ class TestShopCartsModel(unittest.TestCase):
         shop_cart1 = ShopCartsFactory()
         shop_cart2 = ShopCartsFactory()
         shop_cart3 = ShopCartsFactory()
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        self._create_items(shop_cart1, shop_cart2, shop_cart3)
 
         all_shopcarts = ShopCart.all()
         self.assertEqual(len(all_shopcarts), 3)
@@ -162,27 +177,64 @@ class TestShopCartsModel(unittest.TestCase):
         shop_cart1 = ShopCartsFactory()
         shop_cart2 = ShopCartsFactory()
         shop_cart3 = ShopCartsFactory()
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        self._create_items(shop_cart1, shop_cart2, shop_cart3)
         cid = shop_cart2.customer_id
         shop_cart = ShopCart(customer_id=cid, product_id=1, quantities=1)
         shop_cart.create()
-        shop_cart = ShopCart(customer_id=cid, product_id=1, quantities=1)
+        shop_cart = ShopCart(customer_id=cid, product_id=2, quantities=1)
         shop_cart.create()
         shop_cart = ShopCart.find_by_customer_id(cid)
 
         self.assertEqual(len(shop_cart), 3)
 
+    def test_find_items(self):
+        """Test get the shopcart items of a customer filtered by quantities"""
+        Cart(customer_id=1).create()
+        for pid, quantities in [(1, 1), (2, 10), (3, 10), (4, 20)]:
+            ShopCart(customer_id=1, product_id=pid, quantities=quantities).create()
+        Cart(customer_id=2).create()
+        ShopCart(customer_id=2, product_id=1, quantities=10).create()
+
+        def product_ids(items):
+            return sorted(item.product_id for item in items)
+
+        self.assertEqual(product_ids(ShopCart.find_items(1)), [1, 2, 3, 4])
+        self.assertEqual(product_ids(ShopCart.find_items(1, quantities=[10])), [2, 3])
+        self.assertEqual(product_ids(ShopCart.find_items(1, quantities=[1, 20])), [1, 4])
+        self.assertEqual(product_ids(ShopCart.find_items(1, min_q=10)), [2, 3, 4])
+        self.assertEqual(product_ids(ShopCart.find_items(1, max_q=10)), [1, 2, 3])
+        self.assertEqual(product_ids(ShopCart.find_items(1, min_q=5, max_q=15)), [2, 3])
+        self.assertEqual(product_ids(ShopCart.find_items(1, quantities=[10, 20], max_q=15)), [2, 3])
+
+    def test_read_items(self):
+        """Test reading the items of a customer as ItemRecord tuples"""
+        Cart(customer_id=1).create()
+        for pid, quantities in [(1, 1), (2, 10), (3, 20)]:
+            ShopCart(customer_id=1, product_id=pid, quantities=quantities).create()
+
+        records = ShopCart.read_by_customer_id(1)
+        self.assertTrue(all(isinstance(record, ItemRecord) for record in records))
+        self.assertEqual(sorted(records), sorted(item.snapshot() for item in ShopCart.find_items(1)))
+        self.assertEqual(sorted(record.product_id for record in ShopCart.read_items(1, min_q=5)), [2, 3])
+        self.assertEqual([record.product_id for record in ShopCart.read_items(1, quantities=[20])], [3])
+        self.assertEqual(ShopCart.read_by_customer_id(2), [])
+
+    def test_read_shopcarts(self):
+        """Test reading the Carts as CartRecord tuples"""
+        carts = [CartsFactory() for _ in range(3)]
+        for cart in carts:
+            cart.create()
+        records = Cart.read_shopcarts(after_id=carts[0].id)
+        self.assertEqual(records, [CartRecord(cart.id, cart.customer_id) for cart in carts[1:]])
+        self.assertEqual((records[0].product_id, records[0].quantities), (-1, 1))
+
     def test_find_by_customer_id_and_product_id(self):
         """Test get a shopcarts record by its customer id and product id"""
         shop_cart1 = ShopCartsFactory()
         shop_cart2 = ShopCartsFactory()
         shop_cart2.product_id = 3
         shop_cart3 = ShopCartsFactory()
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        self._create_items(shop_cart1, shop_cart2, shop_cart3)
         cid = shop_cart2.customer_id
         pid = 3
         uid = shop_cart2.id
@@ -200,9 +252,7 @@ class TestShopCartsModel(unittest.TestCase):
         shop_cart2 = ShopCartsFactory()
         shop_cart2.product_id = 3
         shop_cart3 = ShopCartsFactory()
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        self._create_items(shop_cart1, shop_cart2, shop_cart3)
         cid = shop_cart2.customer_id
         pid = 3
         # uid = shop_cart2.id
@@ -218,61 +268,382 @@ class TestShopCartsModel(unittest.TestCase):
         self.assertEqual(bool1, True)
         self.assertEqual(bool2, False)
 
+    def test_duplicate_item_rejected(self):
+        """Test the same product cannot be stored twice for a customer"""
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        duplicate = ShopCart(customer_id=1, product_id=1, quantities=2)
+        self.assertRaises(IntegrityError, duplicate.create)
+        db.session.rollback()
+
+    def test_add_item(self):
+        """Test add an item to an existing shopcart"""
+        Cart(customer_id=1).create()
+        item = ShopCart.add_item(1, 2, 3)
+        self.assertIsNotNone(item)
+        self.assertIsInstance(item.id, int)
+        self.assertEqual(item.customer_id, 1)
+        self.assertEqual(item.product_id, 2)
+        self.assertEqual(item.quantities, 3)
+        self.assertEqual(len(ShopCart.find_by_customer_id(1)), 1)
+
+    def test_add_item_existing_product(self):
+        """Test add an item that is already in the shopcart"""
+        Cart(customer_id=1).create()
+        self.assertIsNotNone(ShopCart.add_item(1, 2, 3))
+        self.assertIsNone(ShopCart.add_item(1, 2, 5))
+        item = ShopCart.find_by_customer_id_and_product_id(1, 2)
+        self.assertEqual(item.quantities, 3)
+
+    def test_add_item_without_shopcart(self):
+        """Test add an item for a customer without a shopcart"""
+        self.assertIsNone(ShopCart.add_item(1, 2, 3))
+        self.assertEqual(len(ShopCart.find_by_customer_id(1)), 0)
+
+    def test_replace_items(self):
+        """Test replace all items of a shopcart"""
+        Cart(customer_id=1).create()
+        Cart(customer_id=2).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        ShopCart(customer_id=2, product_id=1, quantities=1).create()
+        new_items = [ShopCart(customer_id=1, product_id=pid, quantities=pid * 10) for pid in range(2, 6)]
+        items = ShopCart.replace_items(1, new_items)
+        self.assertEqual(len(items), 4)
+        self.assertTrue(all(isinstance(item.id, int) for item in items))
+        stored = sorted((item.product_id, item.quantities) for item in ShopCart.find_by_customer_id(1))
+        self.assertEqual(stored, [(2, 20), (3, 30), (4, 40), (5, 50)])
+        self.assertTrue(Cart.check_exist_by_customer_id(1))
+        self.assertEqual(len(ShopCart.find_by_customer_id(2)), 1)
+
+    def test_replace_items_rolls_back(self):
+        """Test a failed replacement leaves the shopcart untouched"""
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        duplicates = [ShopCart(customer_id=1, product_id=2, quantities=1),
+                      ShopCart(customer_id=1, product_id=2, quantities=2)]
+        self.assertRaises(IntegrityError, ShopCart.replace_items, 1, duplicates)
+        items = ShopCart.find_by_customer_id(1)
+        self.assertEqual([(item.product_id, item.quantities) for item in items], [(1, 1)])
+
+    def test_replace_items_without_cart(self):
+        """Test replacing the items of a customer without a cart, e.g. deleted meanwhile"""
+        items = [ShopCart(customer_id=1, product_id=1, quantities=1)]
+        self.assertRaises(DataValidationError, ShopCart.replace_items, 1, items)
+        self.assertEqual(ShopCart.find_by_customer_id(1), [])
+
+    def test_read_by_customer_ids(self):
+        """Test read the items of many customers with one query"""
+        for customer_id in (1, 2, 3):
+            Cart(customer_id=customer_id).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        ShopCart(customer_id=1, product_id=2, quantities=2).create()
+        ShopCart(customer_id=3, product_id=1, quantities=3).create()
+        carts = ShopCart.read_by_customer_ids([3, 4, 2, 1])
+        self.assertEqual(list(carts), [3, 2, 1])
+        self.assertEqual(carts[2], [])
+        self.assertEqual(sorted((item.product_id, item.quantities) for item in carts[1]), [(1, 1), (2, 2)])
+        self.assertIsInstance(carts[3][0], ItemRecord)
+        self.assertEqual(carts[3][0].customer_id, 3)
+        self.assertEqual(ShopCart.read_by_customer_ids([]), {})
+
+    def test_version_id(self):
+        """Test every write bumps version_id and a stale write is rejected"""
+        Cart(customer_id=1).create()
+        item = ShopCart(customer_id=1, product_id=1, quantities=1)
+        item.create()
+        self.assertEqual(item.version_id, 1)
+        self.assertEqual(item.serialize()["version_id"], 1)
+        stale = ShopCart.from_snapshot(item.snapshot())
+        item.quantities = 2
+        item.update()
+        self.assertEqual(item.version_id, 2)
+        self.assertEqual(ShopCart.increment(1, 1, 1).version_id, 3)
+        db.session.expunge(item)
+        snapshot = stale.snapshot()
+        db.session.add(stale)
+        stale.quantities = 5
+        self.assertRaises(StaleDataError, stale.update)
+        db.session.expunge(stale)
+        self.assertRaises(StaleDataError, ShopCart.from_snapshot(snapshot).delete)
+        self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 1, use_cache=False).quantities, 3)
+        # the row is gone: still a StaleDataError, not a failed reload of the item
+        deleted = ShopCart.from_snapshot(ShopCart.increment(1, 1, 1))
+        ShopCart.clear_cart(1)
+        db.session.add(deleted)
+        deleted.quantities = 7
+        self.assertRaises(StaleDataError, deleted.update)
+
+    def test_update_keeps_written_values(self):
+        """Test an updated item can be read after another connection deleted it"""
+        Cart(customer_id=1).create()
+        item = ShopCart(customer_id=1, product_id=1, quantities=1)
+        item.create()
+        item.quantities = 4
+        item.update()
+        with db.engine.begin() as conn:
+            conn.execute(ShopCart.__table__.delete().where(ShopCart.customer_id == 1))
+        self.assertEqual(item.serialize(),
+                         {"id": item.id, "customer_id": 1, "product_id": 1, "quantities": 4, "version_id": 2})
+
+    def test_replace_items_versions(self):
+        """Test replacing a cart checks the versions read and continues them"""
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        ShopCart.increment(1, 1, 1)
+        new_items = [ShopCart(customer_id=1, product_id=pid, quantities=3) for pid in (1, 2)]
+        self.assertRaises(StaleDataError, ShopCart.replace_items, 1, new_items, {1: 1})
+        self.assertRaises(StaleDataError, ShopCart.replace_items, 1, new_items, {2: 1})
+        self.assertEqual([item.quantities for item in ShopCart.find_by_customer_id(1)], [2])
+        items = ShopCart.replace_items(1, new_items, {1: 2})
+        self.assertEqual(sorted((item.product_id, item.version_id) for item in items), [(1, 3), (2, 1)])
+
+    def test_set_quantities(self):
+        """Test set the quantities of items of several customers in one UPDATE"""
+        for customer_id in (1, 2):
+            Cart(customer_id=customer_id).create()
+            ShopCart(customer_id=customer_id, product_id=1, quantities=1).create()
+        self.assertEqual(ShopCart.set_quantities({}), 0)
+        self.assertEqual(ShopCart.set_quantities({1: {1: 5, 2: 5}, 2: {1: 6}}), 2)
+        items = ShopCart.read_by_customer_ids([1, 2])
+        self.assertEqual([(item.quantities, item.version_id) for item in items[1] + items[2]], [(5, 2), (6, 2)])
+
+    def test_increment(self):
+        """Test add to the quantities of an item and remove it at zero"""
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=2).create()
+        self.assertIsNone(ShopCart.increment(1, 2, 1))
+        self.assertEqual(ShopCart.increment(1, 1, 3).quantities, 5)
+        self.assertRaises(DataValidationError, ShopCart.increment, 1, 1, 2**31 - 1)
+        self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 1).quantities, 5)
+        item = ShopCart.increment(1, 1, -6)
+        self.assertEqual(item.quantities, -1)
+        self.assertIsNone(ShopCart.find_by_customer_id_and_product_id(1, 1))
+
+    def test_increment_concurrently(self):
+        """Test concurrent increments of one item never lose an update"""
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        db.session.close()
+
+        def click(delta):
+            with app.app_context():
+                return ShopCart.increment(1, 1, delta).quantities
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            seen = list(pool.map(click, [1] * 100))
+        self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 1).quantities, 101)
+        # every increment saw a distinct quantity, none of them overwrote another
+        self.assertEqual(sorted(seen), list(range(2, 102)))
+
+    def test_apply_batch(self):
+        """Test add, set and remove items of a shopcart in one transaction"""
+        self.assertIsNone(ShopCart.apply_batch(1, {1: 1}, {}, []))
+        Cart(customer_id=1).create()
+        ShopCart(customer_id=1, product_id=1, quantities=1).create()
+        ShopCart(customer_id=1, product_id=2, quantities=1).create()
+        ShopCart(customer_id=1, product_id=4, quantities=1).create()
+        result = ShopCart.apply_batch(1, {1: 5, 3: 3}, {2: 4, 9: 9}, [4, 8])
+        self.assertEqual(list(result["added"]), [3])
+        self.assertEqual(result["added"][3].quantities, 3)
+        self.assertEqual(list(result["updated"]), [2])
+        self.assertEqual(result["updated"][2].quantities, 4)
+        self.assertEqual(result["removed"], {4})
+        stored = sorted((item.product_id, item.quantities) for item in ShopCart.find_by_customer_id(1))
+        self.assertEqual(stored, [(1, 1), (2, 4), (3, 3)])
+
     def test_all_shopcart(self):
         """Test get all shopcarts record"""
-        shop_cart1 = ShopCartsFactory()
-        shop_cart2 = ShopCartsFactory()
-        shop_cart3 = ShopCartsFactory()
-        shop_cart1.product_id = -1
-        shop_cart2.product_id = 2
-        shop_cart3.product_id = 3
-        shop_cart1.create()
-        shop_cart2.create()
-        shop_cart3.create()
+        carts = [CartsFactory() for _ in range(3)]
+        for cart in carts:
+            cart.create()
+        shop_cart_item = ShopCartsFactory()
+        shop_cart_item.customer_id = carts[0].customer_id
+        shop_cart_item.create()
 
-        all_shopcarts = ShopCart.all_shopcarts()
-        self.assertEqual(len(all_shopcarts), 1)
+        all_shopcarts = Cart.all_shopcarts()
+        self.assertEqual([cart.customer_id for cart in all_shopcarts],
+                         [cart.customer_id for cart in carts])
+
+        page = Cart.all_shopcarts(after_id=carts[0].id, limit=1)
+        self.assertEqual([cart.id for cart in page], [carts[1].id])
+
+        streamed = list(Cart.iter_shopcarts(batch_size=2))
+        self.assertEqual([cart.id for cart in streamed], [cart.id for cart in carts])
+
+    def test_create_cart(self):
+        """Test create the cart of a customer"""
+        cart = Cart.create_for_customer(1)
+        self.assertIsNotNone(cart)
+        self.assertIsInstance(cart.id, int)
+        self.assertEqual(cart.customer_id, 1)
+        self.assertEqual(repr(cart), "<Cart customer_id=[1]>")
+        self.assertEqual(cart.serialize(),
+                         {"id": cart.id, "customer_id": 1, "product_id": -1, "quantities": 1})
+        self.assertIsNone(Cart.create_for_customer(1))
+        self.assertEqual(Cart.find_by_customer_id(1).id, cart.id)
+        self.assertTrue(Cart.check_exist_by_customer_id(1))
+        self.assertFalse(Cart.check_exist_by_customer_id(2))
+
+    def test_item_requires_cart(self):
+        """Test an item cannot be stored without the cart of its customer"""
+        shop_cart = ShopCart(customer_id=1, product_id=1, quantities=1)
+        self.assertRaises(IntegrityError, shop_cart.create)
+        db.session.rollback()
 
     def test_clear_shopcart_delete_false(self):
         """Test clear shopcart"""
-        shop_cart = ShopCartsFactory()
-        shop_cart.product_id = -1
+        cart = CartsFactory()
+        cart.create()
+        customer_id = cart.customer_id
         shop_cart_item = ShopCartsFactory()
-        customer_id = shop_cart.customer_id
         shop_cart_item.product_id = 1
         shop_cart_item.customer_id = customer_id
-        shop_cart.create()
         shop_cart_item.create()
 
         item_count = ShopCart.find_by_customer_id(customer_id)
         self.assertEqual(len(item_count), 1)
-        self.assertTrue(
-            ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1))
+        self.assertTrue(Cart.check_exist_by_customer_id(customer_id))
 
         ShopCart.clear_cart(customer_id, delete_cart=False)
 
         item_count = ShopCart.find_by_customer_id(customer_id)
         self.assertEqual(len(item_count), 0)
-        self.assertTrue(
-            ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1))
+        self.assertTrue(Cart.check_exist_by_customer_id(customer_id))
 
     def test_clear_shopcart_delete_true(self):
         """Test clear shopcart"""
-        shop_cart = ShopCartsFactory()
-        shop_cart.product_id = -1
+        cart = CartsFactory()
+        cart.create()
+        customer_id = cart.customer_id
         shop_cart_item = ShopCartsFactory()
-        customer_id = shop_cart.customer_id
         shop_cart_item.product_id = 1
         shop_cart_item.customer_id = customer_id
-        shop_cart.create()
         shop_cart_item.create()
 
         items = ShopCart.find_by_customer_id(customer_id)
         self.assertEqual(len(items), 1)
-        self.assertTrue(
-            ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1))
+        self.assertTrue(Cart.check_exist_by_customer_id(customer_id))
 
         ShopCart.clear_cart(customer_id, delete_cart=True)
 
-        self.assertFalse(
-            ShopCart.check_exist_by_customer_id_and_product_id(customer_id, -1))
+        self.assertFalse(Cart.check_exist_by_customer_id(customer_id))
+        self.assertEqual(len(ShopCart.find_by_customer_id(customer_id)), 0)
+
+    def test_migrate_legacy_batch(self):
+        """Test copy the legacy shop_cart rows into cart and cart_item"""
+        legacy_shop_cart.drop(db.engine, checkfirst=True)
+        legacy_shop_cart.create(db.engine)
+        try:
+            db.session.execute(legacy_shop_cart.insert(), [
+                {"id": 1, "customer_id": 1, "product_id": -1, "quantities": 1},
+                {"id": 2, "customer_id": 1, "product_id": 10, "quantities": 2},
+                {"id": 3, "customer_id": 2, "product_id": -1, "quantities": 1},
+                {"id": 4, "customer_id": 3, "product_id": 30, "quantities": 4},
+                {"id": 5, "customer_id": 1, "product_id": 11, "quantities": 5},
+            ])
+            db.session.commit()
+
+            self.assertEqual(migrate_legacy_batch(0, 2), (2, 2))
+            self.assertEqual(migrate_legacy_batch(2, 2), (4, 2))
+            # running a batch again is harmless
+            self.assertEqual(migrate_legacy_batch(0, 2), (2, 2))
+            self.assertEqual(migrate_legacy_batch(4, 2), (5, 1))
+            self.assertEqual(migrate_legacy_batch(5, 2), (None, 0))
+
+            self.assertEqual([cart.customer_id for cart in Cart.all_shopcarts()], [1, 2, 3])
+            items = sorted((item.customer_id, item.product_id, item.quantities) for item in ShopCart.all())
+            self.assertEqual(items, [(1, 10, 2), (1, 11, 5), (3, 30, 4)])
+        finally:
+            db.session.close()
+            legacy_shop_cart.drop(db.engine)
+
+    def test_read_replica_routing(self):
+        """Test reads go round-robin to the replicas and writes to the primary"""
+        # two stand-in replicas pointing at the test database
+        replicas.configure([SQLALCHEMY_DATABASE_URI, SQLALCHEMY_DATABASE_URI])
+        statements = []
+
+        def recorder(name):
+            def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+                statements.append((name, statement.split()[0]))
+            return record
+
+        listeners = [
+            (db.engine, recorder("primary")),
+            (replicas.engines[0], recorder("replica1")),
+            (replicas.engines[1], recorder("replica2")),
+        ]
+        for engine, listener in listeners:
+            event.listen(engine, "before_cursor_execute", listener)
+        try:
+            Cart(customer_id=1).create()
+            db.session.remove()
+            statements.clear()
+
+            self.assertTrue(Cart.check_exist_by_customer_id(1))
+            self.assertEqual(ShopCart.find_by_customer_id(1), [])
+            self.assertEqual(len(Cart.all_shopcarts()), 1)
+            self.assertEqual([name for name, _ in statements], ["replica1", "replica2", "replica1"])
+
+            statements.clear()
+            ShopCart(customer_id=1, product_id=1, quantities=1).create()
+            self.assertEqual(len(ShopCart.find_by_customer_id(1)), 1)
+            self.assertNotIn("replica1", [name for name, _ in statements])
+            self.assertNotIn("replica2", [name for name, _ in statements])
+            self.assertIn(("primary", "INSERT"), statements)
+
+            self.assertEqual(len(pool_status()["replicas"]), 2)
+        finally:
+            db.session.remove()
+            for engine, listener in listeners:
+                event.remove(engine, "before_cursor_execute", listener)
+            replicas.configure([])
+
+    def test_cart_cache(self):
+        """Test item lookups are cached and writes invalidate them"""
+        cart_cache.configure(max_customers=10, ttl=60, max_bytes=1024 * 1024)
+        try:
+            Cart(customer_id=1).create()
+            item = ShopCart(customer_id=1, product_id=1, quantities=1)
+            item.create()
+            self.assertEqual(len(ShopCart.find_by_customer_id(1)), 1)
+            self.assertIsNotNone(ShopCart.find_by_customer_id_and_product_id(1, 1))
+            self.assertIsNone(ShopCart.find_by_customer_id_and_product_id(1, 2))
+
+            cached = ShopCart.find_by_customer_id(1)
+            self.assertEqual([entry.serialize() for entry in cached], [item.serialize()])
+            self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 1).quantities, 1)
+            self.assertIsNone(ShopCart.find_by_customer_id_and_product_id(1, 2))
+            self.assertEqual(cart_cache.stats()["hits"], 3)
+
+            self.assertIsNotNone(ShopCart.add_item(1, 2, 5))
+            self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 2).quantities, 5)
+
+            item = ShopCart.find_by_customer_id_and_product_id(1, 1, use_cache=False)
+            item.quantities = 7
+            item.update()
+            self.assertEqual(ShopCart.find_by_customer_id_and_product_id(1, 1).quantities, 7)
+
+            ShopCart.replace_items(1, [ShopCart(customer_id=1, product_id=3, quantities=3)])
+            self.assertEqual([entry.product_id for entry in ShopCart.find_by_customer_id(1)], [3])
+
+            ShopCart.find_by_customer_id_and_product_id(1, 3, use_cache=False).delete()
+            self.assertEqual(ShopCart.find_by_customer_id(1), [])
+
+            ShopCart(customer_id=1, product_id=4, quantities=4).create()
+            self.assertEqual(len(ShopCart.find_by_customer_id(1)), 1)
+            ShopCart.clear_cart(1)
+            self.assertEqual(ShopCart.find_by_customer_id(1), [])
+        finally:
+            cart_cache.configure(0, 5.0, 4 * 1024 * 1024)
+
+    def test_init_db_without_create(self):
+        """It should not create the tables at startup when DB_AUTO_CREATE is off"""
+        auto_create = app.config.get("DB_AUTO_CREATE", True)
+        app.config["DB_AUTO_CREATE"] = False
+        try:
+            with patch.object(db, "create_all") as create_all:
+                ShopCart.init_db(app)
+            create_all.assert_not_called()
+        finally:
+            app.config["DB_AUTO_CREATE"] = auto_create
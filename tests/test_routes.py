@@ -6,11 +6,18 @@ Test cases can be run with the following:
   coverage report -m
 """
 # import random
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 # from flask import jsonify
+from flask_restx import marshal
+from sqlalchemy import text
 from service import app
-from service.models import db, ShopCart
+from service.routes import shopcart_model
+from service.models import db, Cart, ShopCart, replicas
 from service.common import status  # HTTP Status Codes
+from service.common.timing import QueryCounter
 from service.config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_TRACK_MODIFICATIONS
 from tests.shop_cart_factory import ShopCartsFactory
 ######################################################################
@@ -20,6 +27,27 @@ from tests.shop_cart_factory import ShopCartsFactory
 CUSTOMER_ID = 1
 ITEM_ID = 1
 
+# Most SQL statements each route may run, with the cart cache off. Raise a
+# budget only on purpose: every statement is a round trip to Postgres.
+QUERY_BUDGETS = {
+    "POST /api/shopcarts": 1,
+    "GET /api/shopcarts": 1,
+    "GET /api/shopcarts?stream=true": 1,
+    "GET /api/shopcarts?customer_ids=": 1,
+    "GET /api/shopcarts/<customer_id>": 1,
+    "GET /api/shopcarts/<customer_id> of a missing customer": 2,
+    "PUT /api/shopcarts/<customer_id>?update=True": 4,
+    "PUT /api/shopcarts/<customer_id>?update=False": 2,
+    "DELETE /api/shopcarts/<customer_id>": 1,
+    "GET /api/shopcarts/<customer_id>/items": 1,
+    "POST /api/shopcarts/<customer_id>/items": 1,
+    "PATCH /api/shopcarts/<customer_id>/items": 4,
+    "GET /api/shopcarts/<customer_id>/items/<product_id>": 1,
+    "PUT /api/shopcarts/<customer_id>/items/<product_id>": 2,
+    "DELETE /api/shopcarts/<customer_id>/items/<product_id>": 2,
+    "POST /api/shopcarts/<customer_id>/items/<product_id>/increment": 1,
+}
+
 class TestShopCartsServer(TestCase):
     """ REST API Server Tests """
 
@@ -40,7 +68,7 @@ class TestShopCartsServer(TestCase):
     def setUp(self):
         """ This runs before each test """
         self.app = app.test_client()
-        db.session.query(ShopCart).delete()  # clean up the last tests
+        db.session.query(Cart).delete()  # clean up the last tests, items go with their carts
         db.session.commit()
 
     def tearDown(self):
@@ -48,13 +76,16 @@ class TestShopCartsServer(TestCase):
         db.session.remove()
 
     def _add_new_shopcart(self, customer_id):
-        shopcart = ShopCart(customer_id=customer_id, product_id=-1, quantities=1)
+        shopcart = Cart(customer_id=customer_id)
         shopcart.create()
         return shopcart
 
     def _add_new_shopcart_item(self, customer_id, product_id, quantities=1):
         shopcart_item = ShopCart(customer_id=customer_id, product_id=product_id, quantities=quantities)
         shopcart_item.create()
+        # like a client's copy, changes to it must not reach the session of the app
+        db.session.refresh(shopcart_item)
+        db.session.expunge(shopcart_item)
         return shopcart_item
 
     def _delete_shopcart_item(self, shopcart_item):
@@ -71,6 +102,30 @@ class TestShopCartsServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["status"], "OK")
 
+    def test_health_pool(self):
+        """It should report the connection pool usage"""
+        resp = self.app.get("/health/pool")
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        for key in ["size", "checked_out", "idle", "overflow", "max_overflow"]:
+            self.assertIn(key, data)
+        self.assertEqual(data["checked_out"], 0)
+
+    def test_health_cache(self):
+        """It should report the cart cache counters"""
+        resp = self.app.get("/health/cache")
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        for key in ["enabled", "customers", "bytes", "hits", "misses", "evictions"]:
+            self.assertIn(key, data)
+
+    def test_session_removed_after_request(self):
+        """It should end the database session at the end of each request"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self.assertTrue(db.session.registry.has())
+        self.app.get(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertFalse(db.session.registry.has())
+
     def test_index(self):
         """ It should call the home page """
         resp = self.app.get("/")
@@ -441,6 +496,97 @@ class TestShopCartsServer(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), 2)
 
+    def test_read_shopcart_matches_marshal(self):
+        """ It should render the read only routes exactly as marshal() does"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        item = self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID, 3)
+        expected = marshal(item.serialize(), shopcart_model)
+        for url in [f'/api/shopcarts/{CUSTOMER_ID}', f'/api/shopcarts/{CUSTOMER_ID}/items']:
+            self.assertEqual(self.app.get(url).get_json(), [expected])
+        cart = Cart.find_by_customer_id(CUSTOMER_ID)
+        self.assertEqual(self.app.get('/api/shopcarts').get_json(), [marshal(cart.serialize(), shopcart_model)])
+
+    def test_get_item_with_fields_mask(self):
+        """ It should only return the fields named in X-Fields"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID, 3)
+        resp = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"X-Fields": "quantities"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"quantities": 3})
+
+    def test_read_all_shopcart_paginated(self):
+        """ It should read all shopcarts one page at a time """
+        for customer_id in range(1, 6):
+            self._add_new_shopcart(customer_id)
+
+        customer_ids = []
+        url = '/api/shopcarts?limit=2'
+        while url:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            customer_ids.extend(cart['customer_id'] for cart in data)
+            link = re.match(r'<(.*)>; rel="next"', response.headers.get('Link', ''))
+            url = link.group(1) if link else None
+        self.assertEqual(customer_ids, [1, 2, 3, 4, 5])
+
+    def test_read_all_shopcart_after_id(self):
+        """ It should only read shopcarts after the given id """
+        first = self._add_new_shopcart(1)
+        self._add_new_shopcart(2)
+        response = self.app.get(f'/api/shopcarts?after_id={first.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([cart['customer_id'] for cart in data], [2])
+        self.assertNotIn('Link', response.headers)
+
+    def test_read_all_shopcart_bad_limit(self):
+        """ It should not read shopcarts with an invalid page size """
+        response = self.app.get('/api/shopcarts?limit=0')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.app.get('/api/shopcarts?limit=abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_read_shopcarts_of_customers(self):
+        """ It should read the items of several customers in one request"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart(CUSTOMER_ID + 1)
+        self._add_new_shopcart_item(CUSTOMER_ID, 1)
+        self._add_new_shopcart_item(CUSTOMER_ID, 2)
+        ids = f"{CUSTOMER_ID + 1},{CUSTOMER_ID + 2}, {CUSTOMER_ID},{CUSTOMER_ID + 1}"
+        response = self.app.get(f"/api/shopcarts?customer_ids={ids}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([cart["customer_id"] for cart in data], [str(CUSTOMER_ID + 1), str(CUSTOMER_ID)])
+        self.assertEqual(data[0]["items"], [])
+        self.assertEqual(data[1]["items"], self.app.get(f"/api/shopcarts/{CUSTOMER_ID}").get_json())
+
+    def test_shopcarts_of_customers_docs(self):
+        """ It should document the shape of the customer_ids reads"""
+        docs = self.app.get("/api/swagger.json").get_json()
+        self.assertEqual(set(docs["definitions"]["CustomerShopCart"]["properties"]), {"customer_id", "items"})
+        self.assertIn("CustomerShopCart", docs["paths"]["/shopcarts"]["get"]["responses"]["200"]["description"])
+
+    def test_read_shopcarts_of_customers_bad_ids(self):
+        """ It should refuse customer_ids that are not integers or too many"""
+        for ids in ["", "1,x", "1,-2", str(2**31), ",".join(map(str, range(app.config["SHOPCART_MAX_BULK_IDS"] + 1)))]:
+            response = self.app.get(f"/api/shopcarts?customer_ids={ids}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, ids)
+
+    def test_stream_all_shopcart(self):
+        """ It should stream all shopcarts as newline delimited JSON """
+        for customer_id in range(1, 4):
+            self._add_new_shopcart(customer_id)
+        response = self.app.get('/api/shopcarts?stream=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['customer_id'] for line in lines], [1, 2, 3])
+
+        response = self.app.get('/api/shopcarts', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 3)
+
     def test_list_all_shopcarts_of_a_customer_with_cart(self):
         """ It should read all shopcarts of a customer"""
         self._add_new_shopcart(CUSTOMER_ID)
@@ -493,6 +639,312 @@ class TestShopCartsServer(TestCase):
         response = self.app.put(f'/api/shopcarts/{CUSTOMER_ID}?update=False')
         self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
 
+    def test_read_shopcart_not_modified(self):
+        """ It should answer 304 when If-None-Match names the current cart"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, 1)
+        response = self.app.get(f'/api/shopcarts/{CUSTOMER_ID}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        response = self.app.get(f'/api/shopcarts/{CUSTOMER_ID}', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data, b"")
+        response = self.app.get(f'/api/shopcarts/{CUSTOMER_ID}/items', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # any change to the items gives a new tag
+        self._add_new_shopcart_item(CUSTOMER_ID, 2)
+        response = self.app.get(f'/api/shopcarts/{CUSTOMER_ID}', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_read_item_not_modified(self):
+        """ It should answer 304 when If-None-Match names the current item"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        response = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+        etag = response.headers["ETag"]
+        response = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"If-None-Match": '"stale"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_shopcart_if_match(self):
+        """ It should only update a shopcart when If-Match names the current cart"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, 1)
+        etag = self.app.get(f'/api/shopcarts/{CUSTOMER_ID}').headers["ETag"]
+        body = {"customer_id": CUSTOMER_ID, "items": [{"customer_id": CUSTOMER_ID, "product_id": 2, "quantities": 3}]}
+        response = self.app.put(f'/api/shopcarts/{CUSTOMER_ID}?update=True', json=body,
+                                headers={"If-Match": '"stale"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.app.put(f'/api/shopcarts/{CUSTOMER_ID}?update=True', json=body,
+                                headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        # the old tag no longer matches
+        response = self.app.delete(f'/api/shopcarts/{CUSTOMER_ID}', headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.app.delete(f'/api/shopcarts/{CUSTOMER_ID}', headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_update_item_if_match(self):
+        """ It should only update or delete an item when If-Match names the current item"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        test_shopcart_item = self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        etag = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}").headers["ETag"]
+        test_shopcart_item.quantities = "5"
+        response = self.app.put(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}",
+                                json=test_shopcart_item.serialize(), headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_etag = response.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        response = self.app.put(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}",
+                                json=test_shopcart_item.serialize(), headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.app.delete(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.app.delete(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"If-Match": new_etag})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        # the item is gone, If-Match fails whatever it names, the tag of an empty cart and * too
+        empty_etag = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}").headers["ETag"]
+        for if_match in [new_etag, empty_etag, "*"]:
+            response = self.app.delete(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", headers={"If-Match": if_match})
+            self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED, if_match)
+        response = self.app.delete(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_item_write_reads_the_primary(self):
+        """ It should read an item it updates or deletes on the primary, not on a lagging replica"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        test_shopcart_item = self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        # a replica that missed every write after the item was added: its own schema holds version_id 1
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP SCHEMA IF EXISTS lagging_replica CASCADE"))
+            conn.execute(text("CREATE SCHEMA lagging_replica"))
+        replicas.configure([SQLALCHEMY_DATABASE_URI], {"connect_args": {"options": "-csearch_path=lagging_replica"}})
+        try:
+            db.metadata.create_all(replicas.engines[0])
+            with replicas.engines[0].begin() as conn:
+                conn.execute(Cart.__table__.insert().values(customer_id=CUSTOMER_ID))
+                conn.execute(ShopCart.__table__.insert().values(
+                    id=test_shopcart_item.id, customer_id=CUSTOMER_ID, product_id=ITEM_ID, quantities=1, version_id=1))
+            for quantities in ("2", "3"):
+                test_shopcart_item.quantities = quantities
+                response = self.app.put(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}", json=test_shopcart_item.serialize())
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                test_shopcart_item.version_id = response.get_json()["version_id"]
+            self.assertEqual(response.get_json()["version_id"], 3)
+            response = self.app.delete(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}")
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertIsNone(ShopCart.find_by_customer_id_and_product_id(CUSTOMER_ID, ITEM_ID, for_update=True))
+        finally:
+            db.session.remove()
+            replicas.configure([])
+            with db.engine.begin() as conn:
+                conn.execute(text("DROP SCHEMA lagging_replica CASCADE"))
+
+    def test_update_item_version_conflict(self):
+        """ It should reject an item update based on an old version_id with 409"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}"
+        item = self.app.get(url).get_json()
+        self.assertEqual(item["version_id"], 1)
+        item["quantities"] = "5"
+        response = self.app.put(url, json=item)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["version_id"], 2)
+        # a second writer still holding version 1
+        item["quantities"] = "7"
+        response = self.app.put(url, json=item)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        item["version_id"] = "x"
+        response = self.app.put(url, json=item)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.app.get(url).get_json()["quantities"], 5)
+
+    def test_errors_without_propagation(self):
+        """ It should answer 409 and 400 for model errors when exceptions do not propagate, as in production"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}"
+        app.config["PROPAGATE_EXCEPTIONS"] = False
+        try:
+            item = self.app.get(url).get_json()
+            item["version_id"] += 1
+            response = self.app.put(url, json=item)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+            self.assertEqual(response.get_json()["error"], "Conflict")
+            response = self.app.post(f"{url}/increment", json={"delta": 2**31 - 1})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config["PROPAGATE_EXCEPTIONS"] = None
+
+    def test_update_shopcart_version_conflict(self):
+        """ It should reject a cart update based on an old version_id of an item with 409"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        items = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}").get_json()
+        self.app.post(f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}/increment", json={"delta": 1})
+        body = {"customer_id": CUSTOMER_ID, "items": items}
+        response = self.app.put(f"/api/shopcarts/{CUSTOMER_ID}?update=True", json=body)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        body["items"] = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}").get_json()
+        response = self.app.put(f"/api/shopcarts/{CUSTOMER_ID}?update=True", json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()[0]["version_id"], 3)
+
+    def test_increment_item(self):
+        """ It should add to the quantity of an item and remove it at zero"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}"
+        quantities = self.app.get(url).get_json()["quantities"]
+        response = self.app.post(f"{url}/increment", json={"delta": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["quantities"], quantities + 2)
+        self.assertEqual(response.headers["ETag"], self.app.get(url).headers["ETag"])
+        response = self.app.post(f"{url}/increment", json={"delta": -(quantities + 2)})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.app.post(f"{url}/increment", json={"delta": 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_increment_item_bad_delta(self):
+        """ It should refuse a delta that is not a non zero integer"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}/increment"
+        for body in [{}, {"delta": 0}, {"delta": "x"}, {"delta": 1.5}, {"delta": 2**31}, []]:
+            response = self.app.post(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        response = self.app.post(url, json={"delta": 2**31 - 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_increment_item_concurrently(self):
+        """ It should not lose concurrent increments of one item"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items/{ITEM_ID}"
+        quantities = self.app.get(url).get_json()["quantities"]
+
+        def click(_):
+            return app.test_client().post(f"{url}/increment", json={"delta": 1}).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(click, range(50)))
+        self.assertEqual(codes, [status.HTTP_200_OK] * 50)
+        self.assertEqual(self.app.get(url).get_json()["quantities"], quantities + 50)
+
+    def test_concurrent_if_match(self):
+        """ It should let only one of the concurrent writes with the same If-Match through"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, ITEM_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items"
+        etag = self.app.get(url).headers["ETag"]
+
+        def change(quantities):
+            operations = [{"op": "set", "product_id": ITEM_ID, "quantities": quantities}]
+            return app.test_client().patch(url, json={"operations": operations}, headers={"If-Match": etag}).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(change, range(2, 18)))
+        self.assertEqual(sorted(codes), [status.HTTP_200_OK] + [status.HTTP_412_PRECONDITION_FAILED] * 15)
+
+    def test_patch_items(self):
+        """ It should apply a batch of item operations in one request"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        self._add_new_shopcart_item(CUSTOMER_ID, 1)
+        self._add_new_shopcart_item(CUSTOMER_ID, 2)
+        operations = [
+            {"op": "add", "product_id": 10, "quantities": 3},
+            {"op": "add", "product_id": 1, "quantities": 3},
+            {"op": "set", "product_id": 2, "quantities": "7"},
+            {"op": "set", "product_id": 11, "quantities": 1},
+            {"op": "remove", "product_id": 1 + 100},
+        ]
+        response = self.app.patch(f"/api/shopcarts/{CUSTOMER_ID}/items", json={"operations": operations})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()
+        self.assertEqual([result["status"] for result in results], [201, 409, 200, 404, 204])
+        self.assertEqual(results[0]["item"]["quantities"], 3)
+        self.assertEqual(results[2]["item"]["quantities"], 7)
+        self.assertIsNone(results[3]["item"])
+        response = self.app.patch(f"/api/shopcarts/{CUSTOMER_ID}/items",
+                                  json={"operations": [{"op": "remove", "product_id": 1}]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = self.app.get(f"/api/shopcarts/{CUSTOMER_ID}").get_json()
+        self.assertEqual(sorted((item["product_id"], item["quantities"]) for item in items), [(2, 7), (10, 3)])
+
+    def test_patch_items_bad_request(self):
+        """ It should refuse a batch with an invalid operation and apply none of it"""
+        self._add_new_shopcart(CUSTOMER_ID)
+        url = f"/api/shopcarts/{CUSTOMER_ID}/items"
+        add = {"op": "add", "product_id": 10, "quantities": 3}
+        for body in [{}, {"operations": []}, {"operations": [add, {"op": "double", "product_id": 1}]},
+                     {"operations": [add, {"op": "set", "product_id": "x", "quantities": 1}]},
+                     {"operations": [add, {"op": "set", "product_id": 1, "quantities": 0}]},
+                     {"operations": [add, {"op": "remove", "product_id": 10}]},
+                     {"operations": [add] * (app.config["SHOPCART_MAX_BATCH_OPS"] + 1)}]:
+            response = self.app.patch(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        self.assertEqual(self.app.get(url).get_json(), [])
+        response = self.app.patch(f"/api/shopcarts/{CUSTOMER_ID + 1}/items", json={"operations": [add]})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.app.patch(url, json={"operations": [add]}, headers={"If-Match": '"stale"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def assert_query_budget(self, route, method, url, expected_status, **kwargs):
+        """ Sends a request and checks it ran at most the statements budgeted for its route """
+        with QueryCounter() as queries:
+            response = self.app.open(url, method=method, **kwargs)
+        self.assertEqual(response.status_code, expected_status, route)
+        self.assertLessEqual(queries.count, QUERY_BUDGETS[route],
+                             f"{route} ran {queries.count} statements:\n" + "\n".join(queries.statements))
+        return route
+
+    def test_query_budgets(self):
+        """ It should keep every route within its SQL statement budget"""
+        cart = f"/api/shopcarts/{CUSTOMER_ID}"
+        item = f"{cart}/items/{ITEM_ID}"
+        body = {"customer_id": CUSTOMER_ID, "product_id": ITEM_ID, "quantities": 1}
+        checked = {
+            self.assert_query_budget("POST /api/shopcarts", "POST", "/api/shopcarts", status.HTTP_201_CREATED,
+                                     json={**body, "product_id": -1}),
+            self.assert_query_budget("POST /api/shopcarts/<customer_id>/items", "POST", f"{cart}/items",
+                                     status.HTTP_201_CREATED, json=body),
+            self.assert_query_budget("GET /api/shopcarts", "GET", "/api/shopcarts", status.HTTP_200_OK),
+            self.assert_query_budget("GET /api/shopcarts?stream=true", "GET", "/api/shopcarts?stream=true",
+                                     status.HTTP_200_OK),
+            self.assert_query_budget("GET /api/shopcarts?customer_ids=", "GET",
+                                     f"/api/shopcarts?customer_ids={CUSTOMER_ID},{CUSTOMER_ID + 1}", status.HTTP_200_OK),
+            self.assert_query_budget("GET /api/shopcarts/<customer_id>", "GET", cart, status.HTTP_200_OK),
+            self.assert_query_budget("GET /api/shopcarts/<customer_id> of a missing customer", "GET",
+                                     f"/api/shopcarts/{CUSTOMER_ID + 1}", status.HTTP_404_NOT_FOUND),
+            self.assert_query_budget("GET /api/shopcarts/<customer_id>/items", "GET", f"{cart}/items", status.HTTP_200_OK),
+            self.assert_query_budget("GET /api/shopcarts/<customer_id>/items/<product_id>", "GET", item,
+                                     status.HTTP_200_OK),
+            self.assert_query_budget("PUT /api/shopcarts/<customer_id>/items/<product_id>", "PUT", item,
+                                     status.HTTP_200_OK, json={**body, "quantities": "3"}),
+            self.assert_query_budget("POST /api/shopcarts/<customer_id>/items/<product_id>/increment", "POST",
+                                     f"{item}/increment", status.HTTP_200_OK, json={"delta": 1}),
+            self.assert_query_budget("PATCH /api/shopcarts/<customer_id>/items", "PATCH", f"{cart}/items",
+                                     status.HTTP_200_OK, json={"operations": [
+                                         {"op": "set", "product_id": ITEM_ID, "quantities": 2},
+                                         {"op": "add", "product_id": ITEM_ID + 1, "quantities": 1},
+                                         {"op": "remove", "product_id": ITEM_ID + 2}]}),
+            self.assert_query_budget("PUT /api/shopcarts/<customer_id>?update=True", "PUT", f"{cart}?update=True",
+                                     status.HTTP_200_OK, json={"customer_id": CUSTOMER_ID, "items": [body]}),
+            self.assert_query_budget("DELETE /api/shopcarts/<customer_id>/items/<product_id>", "DELETE", item,
+                                     status.HTTP_204_NO_CONTENT),
+            self.assert_query_budget("PUT /api/shopcarts/<customer_id>?update=False", "PUT", f"{cart}?update=False",
+                                     status.HTTP_200_OK),
+            self.assert_query_budget("DELETE /api/shopcarts/<customer_id>", "DELETE", cart, status.HTTP_204_NO_CONTENT),
+        }
+        self.assertEqual(checked, set(QUERY_BUDGETS))
+
     # TEST CASES TO COVER STATUS CODE
 
     def test_405_status_code(self):
@@ -0,0 +1,92 @@
+"""
+Test cases for the slow query log
+
+"""
+import time
+import unittest
+from sqlalchemy import create_engine, text
+from service.common.slow_query import SlowQueryLog, redact
+from service.config import SQLALCHEMY_DATABASE_URI
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    """ Test Cases for SlowQueryLog """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.engine = create_engine("sqlite://")
+        self.log = SlowQueryLog()
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.log.configure(0)
+        self.engine.dispose()
+
+    def query(self, times=1, engine=None):
+        """ Runs a statement with a number and a string parameter """
+        with (engine or self.engine).connect() as conn:
+            for _ in range(times):
+                conn.execute(text("SELECT :id, :email"), {"id": 7, "email": "someone@example.com"})
+
+    def test_redact(self):
+        """It should keep numbers and replace anything else by its type"""
+        self.assertEqual(redact({"id": 7, "ids": [1, 2], "email": "x@y", "on": True, "none": None}),
+                         {"id": 7, "ids": [1, 2], "email": "<str>", "on": True, "none": None})
+        self.assertEqual(redact(tuple(range(100))), list(range(20)))
+
+    def test_slow_statement(self):
+        """It should log a statement slower than the threshold with redacted parameters"""
+        self.log.configure(0.000001, engines=[self.engine])
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.query()
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0].slow_query
+        self.assertEqual(record["sql"], "SELECT ?, ?")
+        self.assertEqual(record["params"], [7, "<str>"])
+        self.assertEqual(record["route"], "MainThread")
+        self.assertNotIn("someone@example.com", logs.output[0])
+        self.log.configure(0.000001, redact_params=False, engines=[self.engine])
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.query()
+        self.assertIn("someone@example.com", logs.output[0])
+
+    def test_threshold(self):
+        """It should not log statements under the threshold, nor any when it is 0"""
+        self.log.configure(60000, engines=[self.engine])
+        self.query()
+        self.log.configure(0, engines=[self.engine])
+        self.query()
+        self.assertEqual(self.log.stats()["logged"], 0)
+        self.assertFalse(self.log.stats()["enabled"])
+
+    def test_rate_limit(self):
+        """It should log at most max_per_minute statements and count the others"""
+        self.log.configure(0.000001, max_per_minute=2, engines=[self.engine])
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.query(5)
+        self.assertEqual(len(logs.records), 2)
+        stats = self.log.stats()
+        self.assertEqual((stats["logged"], stats["suppressed"]), (2, 3))
+        # the next record that gets through counts the ones dropped before it
+        self.log._tokens = 1  # pylint: disable=protected-access
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.query()
+        self.assertEqual(logs.records[0].slow_query["suppressed"], 3)
+
+    def test_explain(self):
+        """It should log the EXPLAIN ANALYZE plan of a slow SELECT in the background"""
+        engine = create_engine(SQLALCHEMY_DATABASE_URI)
+        self.log.configure(0.000001, explain=True, engines=[engine])
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT :id AS id"), {"id": 7})
+                conn.execute(text("CREATE TEMPORARY TABLE slow_query_test (id INTEGER)"))
+            deadline = time.monotonic() + 10
+            while self.log.stats()["explained"] < 1 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        engine.dispose()
+        plans = [record for record in logs.records if hasattr(record, "slow_query_explain")]
+        self.assertEqual(len(plans), 1)
+        self.assertIn("actual time=", plans[0].slow_query_explain["plan"])
+        # the statements of the EXPLAIN itself are not logged, only the two of the test
+        self.assertEqual(self.log.stats()["logged"], 2)
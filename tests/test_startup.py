@@ -0,0 +1,116 @@
+"""
+Test cases for the startup profile and the forked workers
+
+"""
+import os
+import time
+import unittest
+from sqlalchemy import text
+from service import app
+from service.common import startup
+from service.common.slow_query import SlowQueryLog
+from service.config import SQLALCHEMY_DATABASE_URI
+from service.models import ShopCart, db
+from service.storage import MemoryCartStore, WriteBehindCartStore
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _json
+import time:      2000 |       2120 | json
+import time:     50000 |      50000 |     sqlalchemy.sql
+import time:     30000 |      80000 |   sqlalchemy
+import time:      9000 |      89000 | service.models
+"""
+
+
+class TestStartupProfile(unittest.TestCase):
+    """ Test Cases for the startup profile """
+
+    def test_parse_importtime(self):
+        """It should read the module, own and cumulative time of every line"""
+        modules = startup.parse_importtime(IMPORTTIME)
+        self.assertEqual(len(modules), 5)
+        self.assertEqual(modules[2], ("sqlalchemy.sql", 0.05, 0.05))
+
+    def test_by_package(self):
+        """It should add up the own time of a package, slowest first"""
+        packages = startup.by_package(startup.parse_importtime(IMPORTTIME))
+        self.assertEqual([name for name, _ in packages], ["sqlalchemy", "service.models", "json", "_json"])
+        self.assertAlmostEqual(packages[0][1], 0.08)
+
+    def test_profile(self):
+        """It should import the service in a new interpreter and time its init steps"""
+        report = startup.profile(dict(os.environ, CART_STORE="memory"))
+        self.assertGreater(report["total"], 0)
+        self.assertEqual(list(report["steps"]), ["init_logging", "init_timing", "init_metrics", "init_store"])
+        self.assertIn("sqlalchemy", dict(report["imports"]))
+
+    def test_profile_fails(self):
+        """It should raise the error of a service that does not start"""
+        with self.assertRaises(RuntimeError):
+            startup.profile(dict(os.environ, CART_STORE="nonexistent"))
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+class TestFork(unittest.TestCase):
+    """ Test Cases for the workers forked by gunicorn --preload """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
+        ShopCart.init_db(app)
+
+    def in_child(self, check):
+        """ Runs check() in a forked child, exits 0 when it returns True """
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os._exit(0 if check() else 1)  # pylint: disable=protected-access
+            except BaseException:  # pylint: disable=broad-except
+                os._exit(2)  # pylint: disable=protected-access
+        _, code = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(code)
+
+    def test_own_connections(self):
+        """It should not share a pooled connection of the parent with a child"""
+        with app.app_context():
+            pid = db.session.execute(text("SELECT pg_backend_pid()")).scalar()
+            db.session.close()
+
+            def check():
+                child_pid = db.session.execute(text("SELECT pg_backend_pid()")).scalar()
+                db.session.close()
+                return child_pid != pid
+
+            self.assertEqual(self.in_child(check), 0)
+            # the connections of the parent are still open
+            self.assertEqual(db.session.execute(text("SELECT 1")).scalar(), 1)
+            db.session.close()
+
+    def test_write_behind_thread(self):
+        """It should flush the writes of a child with its own thread"""
+        store = WriteBehindCartStore(MemoryCartStore(), window=0.01)
+        store.init_app(app)
+        store.create_for_customer(1)
+
+        def check():
+            store.add_item(1, 2, 3)
+            deadline = time.monotonic() + 5
+            while store.buffer_stats()["pending"] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return store.store.find_by_customer_id_and_product_id(1, 2) is not None
+
+        try:
+            self.assertEqual(self.in_child(check), 0)
+        finally:
+            store.close()
+
+    def test_slow_query_thread(self):
+        """It should start the EXPLAIN thread of the active slow query log in a child"""
+        log = SlowQueryLog()
+        log.configure(60000, explain=True)
+        try:
+            self.assertEqual(self.in_child(lambda: log._thread.is_alive()), 0)  # pylint: disable=protected-access
+        finally:
+            log.configure(0)
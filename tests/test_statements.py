@@ -0,0 +1,72 @@
+"""
+Test cases for the statement hooks
+
+"""
+import unittest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from service.common import statements
+
+
+class TestStatementHooks(unittest.TestCase):
+    """ Test Cases for the shared cursor listeners """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.engine = create_engine("sqlite://")
+        self.calls = []
+
+    def tearDown(self):
+        """ This runs after each test """
+        statements.remove_consumer(self.first)
+        statements.remove_consumer(self.second)
+        self.engine.dispose()
+
+    def first(self, conn, statement, parameters, elapsed, executemany):  # pylint: disable=unused-argument
+        """ Notes a statement """
+        self.calls.append(("first", statement, elapsed))
+
+    def second(self, conn, statement, parameters, elapsed, executemany):  # pylint: disable=unused-argument
+        """ Notes a statement """
+        self.calls.append(("second", statement, elapsed))
+
+    def query(self):
+        """ Runs one statement """
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    def test_one_duration(self):
+        """It should time a statement once and hand the same duration to every consumer"""
+        statements.add_consumer(self.first)
+        statements.add_consumer(self.first)
+        statements.add_consumer(self.second)
+        self.query()
+        self.assertEqual([(name, sql) for name, sql, _ in self.calls], [("first", "SELECT 1"), ("second", "SELECT 1")])
+        self.assertEqual(self.calls[0][2], self.calls[1][2])
+        self.assertGreater(self.calls[0][2], 0)
+
+    def test_remove(self):
+        """It should stop calling a removed consumer"""
+        statements.add_consumer(self.first)
+        statements.add_consumer(self.second)
+        statements.remove_consumer(self.first)
+        self.query()
+        self.assertEqual([name for name, _, _ in self.calls], ["second"])
+        statements.remove_consumer(self.second)
+        self.query()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_no_consumers(self):
+        """It should remove the listeners with the last consumer"""
+        saved = statements._consumers  # pylint: disable=protected-access
+        for consumer in saved:
+            statements.remove_consumer(consumer)
+        try:
+            self.assertFalse(event.contains(Engine, "before_cursor_execute",
+                                            statements._before_cursor_execute))  # pylint: disable=protected-access
+            statements.add_consumer(self.first)
+            self.assertTrue(event.contains(Engine, "before_cursor_execute",
+                                           statements._before_cursor_execute))  # pylint: disable=protected-access
+        finally:
+            for consumer in saved:
+                statements.add_consumer(consumer)
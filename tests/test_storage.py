@@ -0,0 +1,313 @@
+"""
+Test cases for the cart stores
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import time
+from unittest import TestCase
+from sqlalchemy.orm.exc import StaleDataError
+from service import app
+from service.common import status  # HTTP Status Codes
+from service.models import ShopCart, DataValidationError
+from service.storage import CartStore, MemoryCartStore, SqlCartStore, WriteBehindCartStore, init_store
+
+CUSTOMER_ID = 1
+
+
+######################################################################
+#  M E M O R Y   S T O R E   T E S T   C A S E S
+######################################################################
+class TestMemoryCartStore(TestCase):
+    """ Test Cases for the in-memory CartStore """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.store = MemoryCartStore()
+
+    def test_create_cart(self):
+        """It should create one Cart per customer"""
+        cart = self.store.create_for_customer(CUSTOMER_ID)
+        self.assertEqual(cart.customer_id, CUSTOMER_ID)
+        self.assertIsNotNone(cart.id)
+        self.assertIsNone(self.store.create_for_customer(CUSTOMER_ID))
+        self.assertTrue(self.store.check_exist_by_customer_id(CUSTOMER_ID))
+        self.assertFalse(self.store.check_exist_by_customer_id(CUSTOMER_ID + 1))
+
+    def test_all_shopcarts(self):
+        """It should page through the Carts by id"""
+        carts = [self.store.create_for_customer(customer_id) for customer_id in range(10)]
+        self.store.clear_cart(3, delete_cart=True)
+        page = self.store.all_shopcarts(limit=4)
+        self.assertEqual([cart.customer_id for cart in page], [0, 1, 2, 4])
+        page = self.store.all_shopcarts(after_id=page[-1].id, limit=4)
+        self.assertEqual([cart.customer_id for cart in page], [5, 6, 7, 8])
+        self.assertEqual(len(self.store.all_shopcarts(after_id=carts[-1].id)), 0)
+        streamed = list(self.store.iter_shopcarts(batch_size=3))
+        self.assertEqual(len(streamed), 9)
+
+    def test_add_and_find_items(self):
+        """It should add items only to an existing cart and filter them"""
+        self.assertIsNone(self.store.add_item(CUSTOMER_ID, 1, 1))
+        self.store.create_for_customer(CUSTOMER_ID)
+        for product_id in range(1, 6):
+            self.assertIsNotNone(self.store.add_item(CUSTOMER_ID, product_id, product_id))
+        self.assertIsNone(self.store.add_item(CUSTOMER_ID, 1, 7))
+        self.assertEqual(len(self.store.find_by_customer_id(CUSTOMER_ID)), 5)
+        items = self.store.find_items(CUSTOMER_ID, quantities=[2, 4])
+        self.assertEqual([item.product_id for item in items], [2, 4])
+        items = self.store.find_items(CUSTOMER_ID, min_q=2, max_q=3)
+        self.assertEqual([item.quantities for item in items], [2, 3])
+        item = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 3)
+        self.assertEqual(item.quantities, 3)
+        self.assertIsNone(self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 9))
+
+    def test_update_and_delete_item(self):
+        """It should save and remove an item read from the store"""
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 1, 1)
+        item = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1)
+        item.quantities = 8
+        self.store.update_item(item)
+        self.assertEqual(self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 8)
+        self.store.delete_item(item)
+        self.assertIsNone(self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1))
+        self.assertRaises(DataValidationError, self.store.update_item, item)
+
+    def test_replace_and_clear(self):
+        """It should replace and clear the items of a cart"""
+        products = [ShopCart(customer_id=CUSTOMER_ID, product_id=pid, quantities=2) for pid in range(3)]
+        self.assertRaises(DataValidationError, self.store.replace_items, CUSTOMER_ID, products)
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 9, 1)
+        items = self.store.replace_items(CUSTOMER_ID, products)
+        self.assertEqual(sorted(item.product_id for item in items), [0, 1, 2])
+        self.assertEqual(len(self.store.find_by_customer_id(CUSTOMER_ID)), 3)
+        self.store.clear_cart(CUSTOMER_ID)
+        self.assertEqual(self.store.find_by_customer_id(CUSTOMER_ID), [])
+        self.assertTrue(self.store.check_exist_by_customer_id(CUSTOMER_ID))
+        self.store.clear_cart(CUSTOMER_ID, delete_cart=True)
+        self.assertFalse(self.store.check_exist_by_customer_id(CUSTOMER_ID))
+
+    def test_read_by_customer_ids(self):
+        """It should read the items of many customers"""
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.create_for_customer(CUSTOMER_ID + 1)
+        self.store.add_item(CUSTOMER_ID, 1, 1)
+        carts = self.store.read_by_customer_ids([CUSTOMER_ID + 1, CUSTOMER_ID + 2, CUSTOMER_ID])
+        self.assertEqual(list(carts), [CUSTOMER_ID + 1, CUSTOMER_ID])
+        self.assertEqual(carts[CUSTOMER_ID + 1], [])
+        self.assertEqual([item.product_id for item in carts[CUSTOMER_ID]], [1])
+
+    def test_version_conflicts(self):
+        """It should reject writes based on an old version_id"""
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 1, 1)
+        item = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1)
+        stale = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1)
+        self.assertEqual(self.store.update_item(item).version_id, 2)
+        self.assertRaises(StaleDataError, self.store.update_item, stale)
+        self.assertRaises(StaleDataError, self.store.delete_item, stale)
+        products = [ShopCart(customer_id=CUSTOMER_ID, product_id=1, quantities=4)]
+        self.assertRaises(StaleDataError, self.store.replace_items, CUSTOMER_ID, products, {1: 1})
+        items = self.store.replace_items(CUSTOMER_ID, products, {1: 2})
+        self.assertEqual(items[0].version_id, 3)
+        self.assertEqual(self.store.increment(CUSTOMER_ID, 1, 1).version_id, 4)
+
+    def test_increment(self):
+        """It should add to the quantities of an item and remove it at zero"""
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 1, 2)
+        self.assertIsNone(self.store.increment(CUSTOMER_ID, 2, 1))
+        self.assertEqual(self.store.increment(CUSTOMER_ID, 1, 3).quantities, 5)
+        self.assertRaises(DataValidationError, self.store.increment, CUSTOMER_ID, 1, 2**31 - 1)
+        self.assertEqual(self.store.increment(CUSTOMER_ID, 1, -5).quantities, 0)
+        self.assertIsNone(self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1))
+
+    def test_apply_batch(self):
+        """It should add, set and remove items in one call"""
+        self.assertIsNone(self.store.apply_batch(CUSTOMER_ID, {1: 1}, {}, []))
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 1, 1)
+        self.store.add_item(CUSTOMER_ID, 2, 1)
+        self.store.add_item(CUSTOMER_ID, 4, 1)
+        result = self.store.apply_batch(CUSTOMER_ID, {1: 5, 3: 3}, {2: 4, 9: 9}, [4, 8])
+        self.assertEqual(list(result["added"]), [3])
+        self.assertEqual(result["updated"][2].quantities, 4)
+        self.assertEqual(result["removed"], {4})
+        stored = sorted((item.product_id, item.quantities) for item in self.store.find_by_customer_id(CUSTOMER_ID))
+        self.assertEqual(stored, [(1, 1), (2, 4), (3, 3)])
+
+
+######################################################################
+#  W R I T E - B E H I N D   S T O R E   T E S T   C A S E S
+######################################################################
+
+
+class TestWriteBehindCartStore(TestCase):
+    """ Test Cases for the write-behind CartStore """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.inner = MemoryCartStore()
+        # a long window, the tests flush by hand
+        self.store = WriteBehindCartStore(self.inner, window=60)
+        self.store.init_app(app)
+        self.store.create_for_customer(CUSTOMER_ID)
+        self.store.add_item(CUSTOMER_ID, 1, 1)
+        self.store.add_item(CUSTOMER_ID, 2, 1)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.store.close()
+
+    def _set(self, product_id, quantities):
+        item = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, product_id, use_cache=False)
+        item.quantities = quantities
+        return self.store.update_item(item)
+
+    def test_coalesce_updates(self):
+        """It should merge the updates of an item into one write"""
+        for quantities in range(2, 12):
+            self._set(1, quantities)
+        self._set(2, 5)
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 1)
+        self.store.flush()
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 11)
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 2).quantities, 5)
+        stats = self.store.buffer_stats()
+        self.assertEqual((stats["writes"], stats["coalesced"], stats["flushes"]), (11, 9, 1))
+        self.assertEqual((stats["rows_written"], stats["pending"], stats["commits_saved"]), (2, 0, 10))
+
+    def test_read_your_writes(self):
+        """It should read the pending quantities and versions back"""
+        item = self._set(1, 7)
+        self.assertEqual(item.version_id, 2)
+        self.assertEqual(self._set(1, 8).version_id, 2)
+        self.assertEqual(self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 8)
+        rows = {row.product_id: row for row in self.store.read_by_customer_id(CUSTOMER_ID)}
+        self.assertEqual((rows[1].quantities, rows[1].version_id), (8, 2))
+        self.assertEqual(self.store.read_by_customer_ids([CUSTOMER_ID])[CUSTOMER_ID], list(rows.values()))
+        self.assertEqual(sorted(item.quantities for item in self.store.find_by_customer_id(CUSTOMER_ID)), [1, 8])
+        # filtered reads and other writes go to the store after a flush
+        self.assertEqual([row.product_id for row in self.store.read_items(CUSTOMER_ID, quantities=[8])], [1])
+        self.assertEqual(self.store.buffer_stats()["pending"], 0)
+        self.assertEqual(self.store.read_by_customer_id(CUSTOMER_ID), self.inner.read_by_customer_id(CUSTOMER_ID))
+
+    def test_writes_flush_first(self):
+        """It should write the pending updates of a customer before its other writes"""
+        self._set(1, 7)
+        self.assertEqual(self.store.increment(CUSTOMER_ID, 1, 1).quantities, 8)
+        self._set(2, 3)
+        item = self.store.find_by_customer_id_and_product_id(CUSTOMER_ID, 2)
+        self.store.delete_item(item)
+        self.assertIsNone(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 2))
+
+    def test_background_flush(self):
+        """It should write the pending updates once the window is over"""
+        self.store.close()
+        self.store = WriteBehindCartStore(self.inner, window=0.01)
+        self.store.init_app(app)
+        self._set(1, 4)
+        deadline = time.monotonic() + 5
+        while self.store.buffer_stats()["flushes"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 4)
+
+    def test_close(self):
+        """It should write the pending updates on close and write through after"""
+        self._set(1, 4)
+        self.store.close()
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 4)
+        self._set(1, 5)
+        self.assertEqual(self.inner.find_by_customer_id_and_product_id(CUSTOMER_ID, 1).quantities, 5)
+
+
+######################################################################
+#  S T O R E   S E L E C T I O N   T E S T   C A S E S
+######################################################################
+class TestStoreSelection(TestCase):
+    """ Test Cases for choosing the store of the app """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.store = app.extensions["cart_store"]
+        self.cart_store = app.config["CART_STORE"]
+
+    def tearDown(self):
+        """ This runs after each test """
+        app.extensions["cart_store"] = self.store
+        app.config["CART_STORE"] = self.cart_store
+
+    def test_default_store(self):
+        """It should keep carts in the database by default"""
+        self.assertIsInstance(self.store, SqlCartStore)
+
+    def test_incomplete_store(self):
+        """It should not create a store that misses a method of the interface"""
+        class IncompleteCartStore(CartStore):  # pylint: disable=abstract-method
+            """ A store without most of the interface """
+
+            def init_app(self, app):  # pylint: disable=redefined-outer-name
+                """ Nothing to prepare """
+
+        self.assertRaises(TypeError, IncompleteCartStore)
+
+    def test_unknown_store(self):
+        """It should refuse an unknown CART_STORE"""
+        app.config["CART_STORE"] = "nosuchstore"
+        self.assertRaises(ValueError, init_store, app)
+
+    def test_routes_with_memory_store(self):
+        """It should serve the REST API from the memory store"""
+        app.config["CART_STORE"] = "memory"
+        self.assertIsInstance(init_store(app), MemoryCartStore)
+        client = app.test_client()
+        resp = client.post("/api/shopcarts", json={"customer_id": CUSTOMER_ID, "product_id": -1, "quantities": 1})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = client.post(f"/api/shopcarts/{CUSTOMER_ID}/items",
+                           json={"customer_id": CUSTOMER_ID, "product_id": 5, "quantities": 2})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = client.put(f"/api/shopcarts/{CUSTOMER_ID}/items/5",
+                          json={"customer_id": CUSTOMER_ID, "product_id": 5, "quantities": "4"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = client.get(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["quantities"] for item in resp.get_json()], [4])
+        resp = client.get("/api/shopcarts")
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = client.get("/health/pool")
+        self.assertEqual(resp.get_json()["store"], "memory")
+        resp = client.delete(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = client.get(f"/api/shopcarts/{CUSTOMER_ID}")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_routes_with_write_behind(self):
+        """It should serve quantity updates through the write-behind buffer"""
+        app.config["WRITE_BEHIND_WINDOW_MS"] = 60000
+        store = init_store(app)
+        try:
+            self.assertIsInstance(store, WriteBehindCartStore)
+            client = app.test_client()
+            client.delete(f"/api/shopcarts/{CUSTOMER_ID}")
+            client.post("/api/shopcarts", json={"customer_id": CUSTOMER_ID, "product_id": -1, "quantities": 1})
+            client.post(f"/api/shopcarts/{CUSTOMER_ID}/items",
+                        json={"customer_id": CUSTOMER_ID, "product_id": 5, "quantities": 2})
+            for quantities in ("3", "4", "5"):
+                resp = client.put(f"/api/shopcarts/{CUSTOMER_ID}/items/5",
+                                  json={"customer_id": CUSTOMER_ID, "product_id": 5, "quantities": quantities})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = client.get(f"/api/shopcarts/{CUSTOMER_ID}/items/5")
+            self.assertEqual((resp.get_json()["quantities"], resp.get_json()["version_id"]), (5, 2))
+            self.assertEqual(ShopCart.find_by_customer_id_and_product_id(CUSTOMER_ID, 5).quantities, 2)
+            resp = client.get("/health/write-buffer")
+            self.assertEqual(resp.get_json()["coalesced"], 2)
+            store.close()
+            item = ShopCart.find_by_customer_id_and_product_id(CUSTOMER_ID, 5)
+            self.assertEqual((item.quantities, item.version_id), (5, 2))
+        finally:
+            store.close()
+            app.config["WRITE_BEHIND_WINDOW_MS"] = 0
+            client.delete(f"/api/shopcarts/{CUSTOMER_ID}")
@@ -0,0 +1,83 @@
+"""
+Test cases for the request timing
+
+"""
+import re
+import threading
+import unittest
+from flask import Flask
+from flask_restx import Model, fields
+from sqlalchemy import create_engine, text
+from service.common.marshallers import marshal_with
+from service.common.timing import QueryCounter, current_timer, init_timing
+
+item_model = Model("Item", {"id": fields.Integer})
+
+
+def make_app(server_timing):
+    """ A Flask app with one route that runs two statements on SQLite """
+    flask_app = Flask(__name__)
+    flask_app.config["SERVER_TIMING"] = server_timing
+    engine = create_engine("sqlite://")
+
+    @flask_app.route("/items")
+    @marshal_with(item_model, as_list=True)
+    def items():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            rows = conn.execute(text("SELECT 1 AS id UNION SELECT 2")).all()
+        return [{"id": row.id} for row in rows], 200
+
+    init_timing(flask_app)
+    return flask_app
+
+
+class TestRequestTiming(unittest.TestCase):
+    """ Test Cases for init_timing """
+
+    def test_server_timing(self):
+        """It should count the statements of a request and send the timings"""
+        client = make_app(True).test_client()
+        with self.assertLogs("flask.app", level="INFO") as logs:
+            resp = client.get("/items")
+        self.assertEqual(resp.get_json(), [{"id": 1}, {"id": 2}])
+        header = resp.headers["Server-Timing"]
+        self.assertRegex(header, r'^db;dur=[\d.]+;desc="2 queries", marshal;dur=[\d.]+, json;dur=[\d.]+, total;dur=[\d.]+$')
+        line = [message for message in logs.output if "timing " in message][0]
+        self.assertIn("method=GET path=/items status=200", line)
+        self.assertIn("db_queries=2", line)
+        total = float(re.search(r"total;dur=([\d.]+)", header).group(1))
+        self.assertGreaterEqual(total, float(re.search(r"db;dur=([\d.]+)", header).group(1)))
+
+    def test_off(self):
+        """It should register nothing when SERVER_TIMING is off"""
+        flask_app = make_app(False)
+        self.assertEqual(flask_app.before_request_funcs, {})
+        self.assertEqual(flask_app.after_request_funcs, {})
+        resp = flask_app.test_client().get("/items")
+        self.assertNotIn("Server-Timing", resp.headers)
+
+    def test_outside_request(self):
+        """It should have no timer outside a request"""
+        self.assertIsNone(current_timer())
+
+
+class TestQueryCounter(unittest.TestCase):
+    """ Test Cases for QueryCounter """
+
+    def test_count(self):
+        """It should count the statements of its own thread inside the block"""
+        engine = create_engine("sqlite://")
+
+        def query():
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+
+        with QueryCounter() as queries:
+            query()
+            thread = threading.Thread(target=query)
+            thread.start()
+            thread.join()
+        query()
+        self.assertEqual(queries.count, 1)
+        self.assertEqual(queries.statements, ["SELECT 1"])